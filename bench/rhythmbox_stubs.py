@@ -0,0 +1,406 @@
+"""
+Rhythmbox stand-ins for benchmarking
+
+Provides just enough of gi.repository and Rhythmbox's rb module for rhythmsub
+to be imported and driven outside of Rhythmbox: a single-threaded main loop,
+rb.Loader and rb.ChunkLoader implemented with urllib on worker threads, and an
+in-memory RhythmDB which counts its commits. The loaders ask for gzip and
+decompress bodies before handing them over, as gvfs does.
+
+Copyright (c) 2013 Luke Carrier
+Released under the terms of the GPLv3
+"""
+
+import enum
+import heapq
+import itertools
+import queue
+import sys
+import threading
+import time
+import types
+import urllib.request
+import zlib
+
+"""
+Main loop.
+
+Runs idle and timeout callbacks the way GLib does, plus callbacks posted from
+worker threads, until there's nothing left to do.
+"""
+class MainLoop:
+    # Idle callbacks, keyed by source ID
+    __idles = None
+
+    # The thread running the loop
+    __thread = None
+
+    # Source ID sequence
+    __ids = None
+
+    # Callbacks posted from other threads
+    __posted = None
+
+    # Timeout callbacks, as a heap of (due, ID, callback, args)
+    __timeouts = None
+
+    # Number of worker threads which will post callbacks
+    __workers = None
+    __workers_lock = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self):
+        self.__idles    = {}
+        self.__ids      = itertools.count(1)
+        self.__posted   = queue.Queue()
+        self.__timeouts = []
+
+        self.__workers      = 0
+        self.__workers_lock = threading.Lock()
+
+        self.__thread = threading.current_thread()
+
+    """
+    Add an idle callback.
+
+    Like GLib's, this may be called from any thread.
+    """
+    def idle_add(self, callback, *args, **kwargs):
+        id = next(self.__ids)
+
+        if threading.current_thread() is self.__thread:
+            self.__idles[id] = (callback, args)
+        else:
+            self.post(self.__idles.__setitem__, id, (callback, args))
+
+        return id
+
+    """
+    Run a callback on the main loop from another thread.
+    """
+    def post(self, callback, *args):
+        self.__posted.put((callback, args))
+
+    """
+    Run the loop until it runs out of work or the timeout (in seconds) passes.
+
+    Work done on threads other than the loop's own workers (e.g. a thread pool)
+    can't be seen; pass an idle function which returns False while it's in
+    progress. Returns False on timeout.
+    """
+    def run(self, timeout=600, idle=None):
+        end = time.monotonic() + timeout
+
+        while time.monotonic() < end:
+            busy = False
+
+            while True:
+                try:
+                    callback, args = self.__posted.get_nowait()
+                except queue.Empty:
+                    break
+                callback(*args)
+                busy = True
+
+            now = time.monotonic()
+            while self.__timeouts and self.__timeouts[0][0] <= now:
+                due, id, interval, callback, args = \
+                        heapq.heappop(self.__timeouts)
+                if callback(*args):
+                    heapq.heappush(self.__timeouts,
+                                   (now + interval, id, interval, callback,
+                                    args))
+                busy = True
+
+            for id, (callback, args) in list(self.__idles.items()):
+                if id in self.__idles and not callback(*args):
+                    self.__idles.pop(id, None)
+                busy = True
+
+            if not busy:
+                if not self.__timeouts and not self.__workers \
+                        and self.__posted.empty() \
+                        and (idle is None or idle()):
+                    return True
+
+                time.sleep(0.001)
+
+        return False
+
+    """
+    Remove an idle or timeout callback.
+    """
+    def source_remove(self, id):
+        self.__idles.pop(id, None)
+        self.__timeouts = [timeout for timeout in self.__timeouts
+                           if timeout[1] != id]
+        heapq.heapify(self.__timeouts)
+
+    """
+    Add a timeout callback.
+    """
+    def timeout_add(self, interval, callback, *args):
+        id = next(self.__ids)
+        heapq.heappush(self.__timeouts,
+                       (time.monotonic() + interval / 1000, id, interval / 1000,
+                        callback, args))
+        return id
+
+    """
+    Run a function on a worker thread.
+
+    The loop keeps running until the function returns.
+    """
+    def start_worker(self, function):
+        def run():
+            try:
+                function()
+            finally:
+                with self.__workers_lock:
+                    self.__workers -= 1
+
+        with self.__workers_lock:
+            self.__workers += 1
+        threading.Thread(target=run, daemon=True).start()
+
+
+# The main loop used by all of the stand-ins
+LOOP = MainLoop()
+
+
+class RhythmDBPropType(enum.Enum):
+    ALBUM        = 1
+    ARTIST       = 2
+    BITRATE      = 3
+    DATE         = 4
+    DISC_NUMBER  = 5
+    DURATION     = 6
+    ENTRY_ID     = 7
+    FILE_SIZE    = 8
+    GENRE        = 9
+    LOCATION     = 10
+    MEDIA_TYPE   = 11
+    TITLE        = 12
+    TRACK_NUMBER = 13
+    YEAR         = 14
+
+
+"""
+RhythmDB entry.
+"""
+class RhythmDBEntry:
+    # Entry type and properties
+    entry_type = None
+    props      = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self, entry_type, location):
+        self.entry_type = entry_type
+        self.props      = {RhythmDBPropType.LOCATION: location}
+
+    """
+    Create an entry and add it to the database.
+    """
+    @staticmethod
+    def new(db, entry_type, location):
+        entry = RhythmDBEntry(entry_type, location)
+        db.entries[location] = entry
+        return entry
+
+    def get_entry_type(self):
+        return self.entry_type
+
+    def get_string(self, prop):
+        return self.props.get(prop, "")
+
+    def get_uint64(self, prop):
+        return self.props.get(prop, 0)
+
+    def get_ulong(self, prop):
+        return self.props.get(prop, 0)
+
+
+"""
+In-memory RhythmDB.
+"""
+class RhythmDB:
+    # Number of commits and property changes
+    commits = None
+    sets    = None
+
+    # Entries, keyed by location
+    entries = None
+
+    # Time of the first commit to change anything since this was last cleared
+    first_change = None
+
+    # Number of property changes as of the last commit
+    __sets_committed = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self):
+        self.commits = 0
+        self.entries = {}
+        self.sets    = 0
+
+        self.__sets_committed = 0
+
+    def commit(self):
+        self.commits += 1
+
+        if self.first_change is None and self.sets > self.__sets_committed:
+            self.first_change = time.monotonic()
+        self.__sets_committed = self.sets
+
+    def entry_delete(self, entry):
+        self.entries.pop(entry.get_string(RhythmDBPropType.LOCATION), None)
+
+    def entry_foreach_by_type(self, entry_type, callback, *data):
+        for entry in list(self.entries.values()):
+            if entry.entry_type is entry_type:
+                callback(entry, *data)
+
+    def entry_lookup_by_location(self, location):
+        return self.entries.get(location)
+
+    def entry_set(self, entry, prop, value):
+        entry.props[prop] = value
+        self.sets += 1
+
+
+class GObjectObject:
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class RhythmDBEntryType(GObjectObject):
+    def __init__(self, name=None, **kwargs):
+        self.name = name
+
+
+class BrowserSource(GObjectObject):
+    def notify_status_changed(self):
+        pass
+
+
+# Headers sent by the loaders
+LOADER_HEADERS = {"Accept-Encoding": "gzip"}
+
+"""
+Get a decompressor for a response's body, or None if it isn't compressed.
+"""
+def get_decompressor(response):
+    if response.headers.get("Content-Encoding", "").lower() != "gzip":
+        return None
+
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+"""
+rb.Loader, fetching with urllib on a worker thread.
+"""
+class Loader:
+    def get_url(self, url, callback, *args):
+        def run():
+            try:
+                request = urllib.request.Request(url, headers=LOADER_HEADERS)
+                with urllib.request.urlopen(request) as response:
+                    decompressor = get_decompressor(response)
+                    data         = response.read()
+                if decompressor is not None:
+                    data = decompressor.decompress(data) + decompressor.flush()
+            except Exception:
+                data = None
+
+            LOOP.post(callback, data, *args)
+
+        LOOP.start_worker(run)
+
+
+"""
+rb.ChunkLoader, fetching with urllib on a worker thread.
+"""
+class ChunkLoader:
+    # Has the transfer been cancelled?
+    __cancelled = None
+
+    def cancel(self):
+        self.__cancelled = True
+
+    def get_url_chunks(self, url, chunk_size, want_size, callback, *args):
+        self.__cancelled = False
+
+        def run():
+            try:
+                request = urllib.request.Request(url, headers=LOADER_HEADERS)
+                with urllib.request.urlopen(request) as response:
+                    decompressor = get_decompressor(response)
+                    while not self.__cancelled:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                        if decompressor is not None:
+                            chunk = decompressor.decompress(chunk)
+                        if chunk:
+                            LOOP.post(callback, chunk, 0, *args)
+                    if decompressor is not None and not self.__cancelled:
+                        chunk = decompressor.flush()
+                        if chunk:
+                            LOOP.post(callback, chunk, 0, *args)
+                LOOP.post(callback, None, 0, *args)
+            except Exception as e:
+                LOOP.post(callback, e, 0, *args)
+
+        LOOP.start_worker(run)
+
+
+"""
+Install the stand-ins in place of gi.repository and rb.
+
+Must be called before rhythmsub is imported. cache_dir is returned by the
+user_cache_dir() functions.
+"""
+def install(cache_dir):
+    gi         = types.ModuleType("gi")
+    repository = types.ModuleType("gi.repository")
+    gi.repository = repository
+
+    def add_module(name, **attrs):
+        module = types.ModuleType("gi.repository.%s" %name)
+        module.__dict__.update(attrs)
+        setattr(repository, name, module)
+        sys.modules[module.__name__] = module
+
+    add_module("GObject", Object=GObjectObject,
+               property=lambda **kwargs: None,
+               type_register=lambda cls: None,
+               new=lambda cls, **kwargs: cls(**kwargs))
+    add_module("GLib", PRIORITY_DEFAULT=0, PRIORITY_DEFAULT_IDLE=200,
+               filename_to_uri=lambda filename, hostname:
+                               "file://" + urllib.request.pathname2url(filename),
+               get_user_cache_dir=lambda: cache_dir,
+               idle_add=LOOP.idle_add, source_remove=LOOP.source_remove,
+               timeout_add=LOOP.timeout_add)
+    add_module("Gdk", threads_add_idle=lambda priority, callback, data:
+                                              LOOP.idle_add(callback, data))
+    add_module("GdkPixbuf")
+    add_module("Gio", Settings=dict)
+    add_module("Gtk")
+    add_module("Peas", Activatable=object)
+    add_module("PeasGtk", Configurable=object)
+    add_module("RB", BrowserSource=BrowserSource, RhythmDBEntry=RhythmDBEntry,
+               RhythmDBEntryType=RhythmDBEntryType,
+               RhythmDBPropType=RhythmDBPropType,
+               user_cache_dir=lambda: cache_dir)
+
+    rb = types.ModuleType("rb")
+    rb.ChunkLoader      = ChunkLoader
+    rb.Loader           = Loader
+    rb.find_plugin_file = lambda plugin, filename: None
+
+    sys.modules.update({"gi": gi, "gi.repository": repository, "rb": rb})
@@ -0,0 +1,732 @@
+"""
+Synthetic Subsonic server
+
+Serves a generated library through the parts of the Subsonic REST API which
+Rhythmsub uses, so that synchronisation can be benchmarked without a real
+server. Latency and failures can be injected into every response, and
+responses are gzip compressed for clients which ask for it.
+
+Run it directly to serve a library until interrupted:
+
+    $ python3 bench/subsonic_server.py --artists 1000 --albums 5 --songs 12
+
+Copyright (c) 2013 Luke Carrier
+Released under the terms of the GPLv3
+"""
+
+import argparse
+import bisect
+import gzip
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Synthetic library.
+
+Each artist has the same number of albums, and each album the same number of
+songs, until touch() adds albums. In the folder structure albums sit directly
+beneath their artists, or beneath per-year folders if year_folders is set, and
+songs sit depth levels beneath their albums, with single "Disc" folders in
+between.
+
+The artists are split between music folders in proportion to folder_weights,
+each folder holding a contiguous range of them.
+"""
+class SyntheticLibrary:
+    # Creation time of the generated albums
+    CREATED = "2013-01-01T00:00:00.000Z"
+
+    # Number of albums and songs per album per artist, and folder depth
+    albums  = None
+    artists = None
+    depth   = None
+    songs   = None
+
+    # Do albums sit in per-year folders beneath their artists?
+    year_folders = None
+
+    # Albums added by touch(), as lists of creation times keyed by artist
+    added = None
+
+    # Range of artists in each music folder, keyed by folder ID
+    folders = None
+
+    # Index modification time, in milliseconds since the epoch
+    last_modified = None
+
+    # Running total of songs before each artist, for paging through songs
+    __song_offsets = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self, artists=100, albums=5, songs=12, depth=1,
+                 folder_weights=(1,), year_folders=False):
+        self.artists      = artists
+        self.albums       = albums
+        self.songs        = songs
+        self.depth        = max(1, depth)
+        self.year_folders = year_folders
+
+        self.folders = {}
+        total        = sum(folder_weights)
+        start        = 0
+        for i, weight in enumerate(folder_weights):
+            end = start + artists * weight // total \
+                    if i < len(folder_weights) - 1 else artists
+            self.folders[i + 1] = range(start, end)
+            start = end
+
+        self.added         = {}
+        self.last_modified = 1357000000000
+
+        self.__update_song_offsets()
+
+    """
+    Recompute the running total of songs before each artist.
+    """
+    def __update_song_offsets(self):
+        offsets = [0]
+        for artist in range(self.artists):
+            offsets.append(offsets[-1] + self.album_count(artist) * self.songs)
+
+        self.__song_offsets = offsets
+
+    """
+    Get the number of albums by an artist.
+    """
+    def album_count(self, artist):
+        return self.albums + len(self.added.get(artist, ()))
+
+    """
+    Get an album's creation time.
+    """
+    def album_created(self, artist, album):
+        if album < self.albums:
+            return self.CREATED
+
+        return self.added[artist][album - self.albums]
+
+    """
+    Get the ID of the folder an album sits in.
+    """
+    def album_parent(self, artist, album):
+        if self.year_folders:
+            return "y%d-%d" %(artist, self.album_year(artist, album))
+
+        return "d%d" %artist
+
+    """
+    Get an album as a folder, as listed by its parent and getAlbumList.
+    """
+    def album_folder(self, artist, album):
+        return {
+            "id":       "d%d-%d" %(artist, album),
+            "parent":   self.album_parent(artist, album),
+            "isDir":    True,
+            "title":    "Album %d" %album,
+            "artist":   "Artist %d" %artist,
+            "coverArt": "d%d-%d" %(artist, album),
+            "created":  self.album_created(artist, album),
+        }
+
+    """
+    Get an album's year.
+    """
+    def album_year(self, artist, album):
+        return 2000 + album % 20
+
+    """
+    Get an album, as listed by getArtist and getAlbumList2.
+    """
+    def album_id3(self, artist, album):
+        return {
+            "id":        "al%d-%d" %(artist, album),
+            "name":      "Album %d" %album,
+            "artist":    "Artist %d" %artist,
+            "artistId":  "ar%d" %artist,
+            "coverArt":  "al%d-%d" %(artist, album),
+            "songCount": self.songs,
+            "duration":  self.songs * 240,
+            "year":      self.album_year(artist, album),
+            "created":   self.album_created(artist, album),
+        }
+
+    """
+    Get the artists in a music folder, or in all of them if folder is None.
+    """
+    def folder_artists(self, folder=None):
+        if folder is None:
+            return range(self.artists)
+
+        return self.folders.get(int(folder), range(0))
+
+    """
+    Get the newest albums, as (artist, album) pairs.
+    """
+    def newest_albums(self, size, offset, folder=None):
+        artists = self.folder_artists(folder)
+        added   = sorted(((created, artist, album)
+                          for artist, albums in self.added.items()
+                          if artist in artists
+                          for album, created in enumerate(albums, self.albums)),
+                         reverse=True)
+
+        result = [(artist, album) for created, artist, album
+                  in added[offset:offset + size]]
+
+        base  = artists.start * self.albums
+        start = max(0, offset - len(added))
+        end   = min(len(artists) * self.albums,
+                    offset + size - len(added))
+        result.extend(divmod(base + i, self.albums)
+                      for i in range(start, end))
+
+        return result
+
+    """
+    Get a song.
+
+    The path identifies the song's folder: its artist, its album and a zero
+    per folder level beneath the album.
+    """
+    def song(self, artist, album, track):
+        path = "-".join(map(str, (artist, album) + (0,) * (self.depth - 1)))
+
+        return {
+            "id":          "s%d-%d-%d" %(artist, album, track),
+            "parent":      "d%s" %path,
+            "isDir":       False,
+            "title":       "Song %d" %track,
+            "album":       "Album %d" %album,
+            "artist":      "Artist %d" %artist,
+            "track":       track + 1,
+            "year":        self.album_year(artist, album),
+            "genre":       "Genre %d" %(artist % 25),
+            "coverArt":    "d%d-%d" %(artist, album),
+            "size":        8000000 + track,
+            "contentType": "audio/mpeg",
+            "suffix":      "mp3",
+            "duration":    240,
+            "bitRate":     256,
+            "path":        "Artist %d/Album %d/%02d Song %d.mp3"
+                                   %(artist, album, track + 1, track),
+            "isVideo":     False,
+            "created":     self.album_created(artist, album),
+            "albumId":     "al%d-%d" %(artist, album),
+            "artistId":    "ar%d" %artist,
+            "type":        "music",
+        }
+
+    """
+    Get a page of songs, in library order.
+    """
+    def songs_page(self, size, offset, folder=None):
+        artists = self.folder_artists(folder)
+        offsets = self.__song_offsets
+        result  = []
+
+        offset += offsets[artists.start] if artists else 0
+        artist  = bisect.bisect_right(offsets, offset) - 1
+        while len(result) < size and artist < artists.stop:
+            first = max(0, offset - offsets[artist])
+            last  = min(offsets[artist + 1] - offsets[artist],
+                        first + size - len(result))
+
+            for i in range(first, last):
+                album, track = divmod(i, self.songs)
+                result.append(self.song(artist, album, track))
+
+            artist += 1
+
+        return result
+
+    """
+    Get a folder's name, parent and children.
+
+    Artists' folders have no parent. Returns None if the folder doesn't exist.
+    """
+    def directory(self, id):
+        try:
+            path = [int(i) for i in id[1:].split("-")]
+        except ValueError:
+            return None
+
+        artist = path[0]
+        if id[:1] not in ("d", "y") or not 0 <= artist < self.artists:
+            return None
+
+        albums = range(self.album_count(artist))
+        if id.startswith("y"):
+            if not self.year_folders or len(path) != 2:
+                return None
+
+            children = [self.album_folder(artist, album) for album in albums
+                        if self.album_year(artist, album) == path[1]]
+            if not children:
+                return None
+
+            return str(path[1]), "d%d" %artist, children
+
+        if len(path) > self.depth + 1:
+            return None
+
+        if len(path) == 1:
+            if not self.year_folders:
+                return "Artist %d" %artist, None, \
+                        [self.album_folder(artist, album) for album in albums]
+
+            years = {}
+            for album in albums:
+                year    = self.album_year(artist, album)
+                created = self.album_created(artist, album)
+                years[year] = max(years.get(year, created), created)
+
+            return "Artist %d" %artist, None, [{
+                "id":      "y%d-%d" %(artist, year),
+                "parent":  id,
+                "isDir":   True,
+                "title":   str(year),
+                "created": created,
+            } for year, created in sorted(years.items())]
+
+        album = path[1]
+        if album not in albums:
+            return None
+
+        if len(path) == 2:
+            parent = self.album_parent(artist, album)
+        else:
+            parent = id.rsplit("-", 1)[0]
+
+        if len(path) <= self.depth:
+            return "Album %d" %album, parent, [{
+                "id":      "%s-0" %id,
+                "parent":  id,
+                "isDir":   True,
+                "title":   "Disc 1",
+                "created": self.album_created(artist, album),
+            }]
+
+        return "Album %d" %album, parent, [self.song(artist, album, track)
+                                           for track in range(self.songs)]
+
+    """
+    Generate the audio of a song, as streamed at up to max_bit_rate Kbps in
+    format, from time_offset seconds in.
+
+    The audio is filler of the song's size, scaled down to the bit rate. Songs
+    are transcoded if their bit rate is capped or they're asked for in a format
+    other than MP3, in which case time_offset is honoured. Returns the audio and
+    whether it was transcoded, or None if the song doesn't exist.
+    """
+    def stream(self, id, max_bit_rate=0, format=None, time_offset=0):
+        try:
+            artist, album, track = map(int, id[1:].split("-"))
+        except ValueError:
+            return None
+
+        if not id.startswith("s") or not 0 <= artist < self.artists \
+                or not 0 <= album < self.album_count(artist) \
+                or not 0 <= track < self.songs:
+            return None
+
+        song = self.song(artist, album, track)
+        size = song["size"]
+        if 0 < max_bit_rate < song["bitRate"]:
+            size = size * max_bit_rate // song["bitRate"]
+
+        filler = ("%s\n" %id).encode()
+        audio  = (filler * (size // len(filler) + 1))[:size]
+
+        transcoded = size != song["size"] \
+                or format not in (None, "raw", song["suffix"])
+        if transcoded and time_offset:
+            audio = audio[size * time_offset // song["duration"]:]
+
+        return audio, transcoded
+
+    """
+    Add a new album to each of the first few artists.
+
+    The index modification time moves on, as it would on a real server.
+    """
+    def touch(self, artists=1):
+        created = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+
+        for artist in range(min(artists, self.artists)):
+            self.added.setdefault(artist, []).append(created)
+
+        self.last_modified = int(time.time() * 1000)
+        self.__update_song_offsets()
+
+
+"""
+Synthetic server request handler.
+
+Subsonic methods are served beneath /rest/. The benchmark harness controls the
+server through /bench/stats and /bench/touch, which aren't counted as requests.
+"""
+class SyntheticRequestHandler(BaseHTTPRequestHandler):
+    disable_nagle_algorithm = True
+    protocol_version        = "HTTP/1.1"
+
+    """
+    Handle a GET request.
+    """
+    def do_GET(self):
+        url    = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        server = self.server
+
+        if url.path == "/bench/stats":
+            self.__send(200, {"audio_bytes":    server.audio_bytes,
+                              "requests":       server.requests,
+                              "response_bytes": server.response_bytes})
+            return
+        elif url.path == "/bench/touch":
+            with server.lock:
+                server.library.touch(int(params.get("artists", 1)))
+            self.__send(200, {})
+            return
+
+        with server.lock:
+            server.requests += 1
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if random.random() < server.error_rate:
+            self.__send(503, None)
+            return
+
+        method  = url.path.rsplit("/", 1)[-1]
+        if method.endswith(".view"):
+            method = method[:-len(".view")]
+
+        handler = getattr(self, "_method_%s" %method, None)
+        if handler is None:
+            self.__send_error(70, "Requested method not found")
+            return
+
+        try:
+            with server.lock:
+                result = handler(server.library, params)
+        except (KeyError, ValueError):
+            self.__send_error(10, "Required parameter is missing")
+            return
+
+        if result is None:
+            self.__send_error(70, "Requested data was not found")
+        elif isinstance(result, tuple):
+            self.__send_audio(*result)
+        else:
+            result.update({"status": "ok", "version": "1.10.1"})
+            self.__send(200, {"subsonic-response": result})
+
+    """
+    Don't log requests.
+    """
+    def log_message(self, format, *args):
+        pass
+
+    """
+    Send a response, compressed if the client accepts gzip.
+    """
+    def __send(self, status, body):
+        data = b"" if body is None \
+                   else json.dumps(body, separators=(",", ":")).encode()
+
+        compress = self.server.compress and data \
+                and "gzip" in self.headers.get("Accept-Encoding", "")
+        if compress:
+            data = gzip.compress(data, compresslevel=5)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+        if not self.path.startswith("/bench/"):
+            with self.server.lock:
+                self.server.response_bytes += len(data)
+
+    """
+    Send audio, honouring a Range request unless it's been transcoded, as
+    Subsonic does.
+    """
+    def __send_audio(self, data, transcoded):
+        match = re.match(r"bytes=(\d*)-(\d*)$",
+                         self.headers.get("Range", "").strip())
+        if transcoded or not match or not any(match.groups()):
+            status, start, end = 200, 0, len(data)
+        elif not match.group(1):
+            status, start, end = 206, max(0, len(data) - int(match.group(2))), \
+                                 len(data)
+        else:
+            status = 206
+            start  = int(match.group(1))
+            end    = min(int(match.group(2) or len(data) - 1) + 1, len(data))
+
+        if start >= len(data) and status == 206:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" %len(data))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(status)
+        self.send_header("Content-Type", "audio/mpeg")
+        if status == 206:
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" %(start, end - 1, len(data)))
+        if not transcoded:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        # Clients hang up part of the way through songs when they seek
+        for position in range(start, end, 65536):
+            chunk = data[position:min(position + 65536, end)]
+            try:
+                self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+                break
+
+            with self.server.lock:
+                self.server.audio_bytes += len(chunk)
+
+    """
+    Send a Subsonic error response.
+    """
+    def __send_error(self, code, message):
+        self.__send(200, {"subsonic-response": {
+            "status":  "failed",
+            "version": "1.10.1",
+            "error":   {"code": code, "message": message},
+        }})
+
+    def _method_getAlbum(self, library, params):
+        artist, album = map(int, params["id"][2:].split("-"))
+        if not 0 <= artist < library.artists \
+                or not 0 <= album < library.album_count(artist):
+            return None
+
+        result         = library.album_id3(artist, album)
+        result["song"] = [library.song(artist, album, track)
+                          for track in range(library.songs)]
+        return {"album": result}
+
+    def _method_getAlbumList(self, library, params):
+        albums = library.newest_albums(int(params.get("size", 10)),
+                                       int(params.get("offset", 0)),
+                                       params.get("musicFolderId"))
+
+        return {"albumList": {"album": [library.album_folder(artist, album)
+                                        for artist, album in albums]}}
+
+    def _method_getAlbumList2(self, library, params):
+        albums = library.newest_albums(int(params.get("size", 10)),
+                                       int(params.get("offset", 0)),
+                                       params.get("musicFolderId"))
+
+        return {"albumList2": {"album": [library.album_id3(artist, album)
+                                         for artist, album in albums]}}
+
+    def _method_getArtist(self, library, params):
+        artist = int(params["id"][2:])
+        if not 0 <= artist < library.artists:
+            return None
+
+        return {"artist": {
+            "id":         params["id"],
+            "name":       "Artist %d" %artist,
+            "albumCount": library.album_count(artist),
+            "album":      [library.album_id3(artist, album)
+                           for album in range(library.album_count(artist))],
+        }}
+
+    def _method_getArtists(self, library, params):
+        return {"artists": {"ignoredArticles": "The El La", "index": [{
+            "name":   "A",
+            "artist": [{
+                "id":         "ar%d" %artist,
+                "name":       "Artist %d" %artist,
+                "albumCount": library.album_count(artist),
+            } for artist in library.folder_artists(
+                    params.get("musicFolderId"))],
+        }]}}
+
+    def _method_getIndexes(self, library, params):
+        result = {
+            "ignoredArticles": "The El La",
+            "lastModified":    library.last_modified,
+        }
+
+        if int(params.get("ifModifiedSince", 0)) < library.last_modified:
+            result["index"] = [{"name": "A", "artist": [{
+                "id":   "d%d" %artist,
+                "name": "Artist %d" %artist,
+            } for artist in library.folder_artists(
+                    params.get("musicFolderId"))]}]
+
+        return {"indexes": result}
+
+    def _method_getLicense(self, library, params):
+        return {"license": {"valid": True}}
+
+    def _method_getMusicDirectory(self, library, params):
+        directory = library.directory(params["id"])
+        if directory is None:
+            return None
+
+        name, parent, children = directory
+        result = {"id": params["id"], "name": name, "child": children}
+        if parent is not None:
+            result["parent"] = parent
+
+        return {"directory": result}
+
+    def _method_getMusicFolders(self, library, params):
+        return {"musicFolders": {"musicFolder": [
+                {"id": folder, "name": "Folder %d" %folder}
+                for folder in sorted(library.folders)]}}
+
+    def _method_ping(self, library, params):
+        return {}
+
+    def _method_search3(self, library, params):
+        return {"searchResult3": {"song": library.songs_page(
+                int(params.get("songCount", 20)),
+                int(params.get("songOffset", 0)),
+                params.get("musicFolderId"))}}
+
+    def _method_stream(self, library, params):
+        return library.stream(params["id"], int(params.get("maxBitRate", 0)),
+                              params.get("format"),
+                              int(params.get("timeOffset", 0)))
+
+
+"""
+Synthetic Subsonic server.
+
+latency is the delay before each response, in seconds, and error_rate the
+fraction of requests which fail with HTTP 503. Responses are only compressed if
+compress is set.
+"""
+class SyntheticServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Should responses be compressed for clients which accept gzip?
+    compress = None
+
+    # Injected latency, in seconds, and fraction of requests which fail
+    error_rate = None
+    latency    = None
+
+    # The SyntheticLibrary being served, and its lock
+    library = None
+    lock    = None
+
+    # Number of bytes of audio, of Subsonic requests, and of the bodies of
+    # their responses as sent, served
+    audio_bytes    = None
+    requests       = None
+    response_bytes = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self, address, library, latency=0, error_rate=0,
+                 compress=True):
+        super(SyntheticServer, self).__init__(address, SyntheticRequestHandler)
+
+        self.library    = library
+        self.latency    = latency
+        self.error_rate = error_rate
+        self.compress   = compress
+
+        self.lock           = threading.Lock()
+        self.audio_bytes    = 0
+        self.requests       = 0
+        self.response_bytes = 0
+
+    """
+    Get the base URL of the server.
+    """
+    def get_address(self):
+        return "http://%s:%d" %self.server_address[:2]
+
+
+"""
+Add the library and fault injection options to an argument parser.
+"""
+def add_arguments(parser):
+    parser.add_argument("--artists", type=int, default=100,
+                        help="number of artists (default: %(default)s)")
+    parser.add_argument("--albums", type=int, default=5,
+                        help="albums per artist (default: %(default)s)")
+    parser.add_argument("--songs", type=int, default=12,
+                        help="songs per album (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=1,
+                        help="folder levels from artists to songs "
+                             "(default: %(default)s)")
+    parser.add_argument("--year-folders", action="store_true",
+                        help="put albums in per-year folders beneath their "
+                             "artists")
+    parser.add_argument("--folders", default="1",
+                        help="comma-separated relative sizes of the music "
+                             "folders, e.g. 8,1,1 (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="delay before each response, in milliseconds "
+                             "(default: %(default)s)")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="fraction of requests which fail "
+                             "(default: %(default)s)")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="never compress responses")
+
+
+"""
+Parse the --folders option.
+"""
+def folder_weights(value):
+    return [max(1, int(weight)) for weight in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=4040,
+                        help="port to listen on, or 0 for any "
+                             "(default: %(default)s)")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    library = SyntheticLibrary(args.artists, args.albums, args.songs,
+                               args.depth, folder_weights(args.folders),
+                               args.year_folders)
+    server  = SyntheticServer((args.host, args.port), library,
+                              args.latency / 1000, args.error_rate,
+                              not args.no_compression)
+
+    print(server.get_address(), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,242 @@
+"""
+Rhythmsub synchronisation benchmark
+
+Drives RhythmsubCache, its queues and subsonic.Server against a synthetic
+Subsonic server, with Rhythmbox and RhythmDB replaced by the stand-ins in
+rhythmbox_stubs. The server runs in a child process so that its memory isn't
+counted against the synchronisation.
+
+    $ python3 bench/sync_benchmark.py --artists 1000 --crawl-mode id3
+
+Each scenario is run in turn against the same server, state store and
+database:
+
+    initial    first synchronisation, with an empty store
+    unchanged  the server's index hasn't changed
+    changed    --touch artists have each gained an album
+    restart    a new session with an empty database, as after restarting
+               Rhythmbox, restored from the snapshot before updating
+    full       a full synchronisation, revalidating every directory
+
+Copyright (c) 2013 Luke Carrier
+Released under the terms of the GPLv3
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import rhythmbox_stubs
+import subsonic_server
+
+# Scenarios which can be run, in their default order
+SCENARIOS = ("initial", "unchanged", "changed", "restart", "full")
+
+"""
+Synthetic server running in a child process.
+"""
+class ServerProcess:
+    # Base URL of the server
+    address = None
+
+    # The child process
+    __process = None
+
+    """
+    Initialiser.
+
+    Starts the server with the library and fault injection options in args.
+    """
+    def __init__(self, args):
+        command = [sys.executable,
+                   os.path.join(BENCH_DIR, "subsonic_server.py"),
+                   "--port", "0", "--artists", str(args.artists),
+                   "--albums", str(args.albums), "--songs", str(args.songs),
+                   "--depth", str(args.depth), "--folders", args.folders,
+                   "--latency", str(args.latency),
+                   "--error-rate", str(args.error_rate)]
+        if args.no_compression:
+            command.append("--no-compression")
+        if args.year_folders:
+            command.append("--year-folders")
+
+        self.__process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                          universal_newlines=True)
+        self.address = self.__process.stdout.readline().strip()
+
+    """
+    Stop the server.
+    """
+    def close(self):
+        self.__process.terminate()
+        self.__process.wait()
+
+    """
+    Get the numbers of Subsonic requests served so far, and of bytes of their
+    responses' bodies as sent, which may have been compressed.
+    """
+    def get_stats(self):
+        stats = self.__control("stats")
+        return stats["requests"], stats["response_bytes"]
+
+    """
+    Add an album to each of the first few artists.
+    """
+    def touch(self, artists):
+        self.__control("touch?artists=%d" %artists)
+
+    """
+    Make a control request.
+    """
+    def __control(self, path):
+        with urllib.request.urlopen("%s/bench/%s" %(self.address, path)) \
+                as response:
+            return json.loads(response.read().decode())
+
+
+"""
+Get the peak resident set size of this process, in MiB.
+"""
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    subsonic_server.add_arguments(parser)
+    parser.add_argument("--crawl-mode", default="folders",
+                        choices=("folders", "id3", "search3"),
+                        help="how to crawl the library (default: %(default)s)")
+    parser.add_argument("--max-requests", type=int, default=8,
+                        help="requests in flight at once (default: %(default)s)")
+    parser.add_argument("--time-slice", type=int, default=8,
+                        help="milliseconds per idle handler run "
+                             "(default: %(default)s)")
+    parser.add_argument("--touch", type=int, default=10,
+                        help="artists changed by the changed scenario "
+                             "(default: %(default)s)")
+    parser.add_argument("--timeout", type=int, default=3600,
+                        help="seconds to allow each scenario "
+                             "(default: %(default)s)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show rhythmsub's debug log")
+    parser.add_argument("scenarios", nargs="*", default=SCENARIOS,
+                        metavar="scenario",
+                        help="scenarios to run, from %s (default: all)"
+                                %", ".join(SCENARIOS))
+    args = parser.parse_args()
+
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario: %s" %scenario)
+
+    state_dir = tempfile.TemporaryDirectory(prefix="rhythmsub-bench-")
+    rhythmbox_stubs.install(state_dir.name)
+
+    import rhythmsub
+    import rhythmsub_store
+    import subsonic
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    server_process = ServerProcess(args)
+    try:
+        db         = rhythmbox_stubs.RhythmDB()
+        entry_type = rhythmsub.RhythmsubDBEntryType()
+        scheduler  = rhythmsub.RhythmsubRequestScheduler(
+                rhythmsub.RhythmboxLoaderAsyncFetcher, args.max_requests)
+        server     = subsonic.Server(server_process.address, "bench", "bench",
+                                     "rhythmsub-bench", async_fetcher=scheduler)
+        store      = rhythmsub_store.RhythmsubStore(
+                os.path.join(state_dir.name, "rhythmsub.sqlite"))
+
+        def new_partition(music_folder_id):
+            return rhythmsub.RhythmsubCache(db, entry_type, server, scheduler,
+                                            store, args.time_slice,
+                                            args.crawl_mode,
+                                            music_folder_id=music_folder_id)
+
+        def new_library():
+            return rhythmsub.RhythmsubLibrary(server, scheduler, store,
+                                              new_partition, args.time_slice)
+        library = new_library()
+
+        print("%d artists, %d albums each, %d songs each, depth %d%s, "
+              "folders %s; %s crawl, %d requests in flight"
+                %(args.artists, args.albums, args.songs, args.depth,
+                  " beneath year folders" if args.year_folders else "",
+                  args.folders, args.crawl_mode, args.max_requests))
+        print("%-10s %9s %9s %9s %9s %9s %9s %10s %9s %9s %9s %9s"
+                %("scenario", "wall (s)", "first (s)", "requests", "entries",
+                  "writes", "commits", "commits/s", "failed", "recv KiB",
+                  "raw KiB", "RSS (MiB)"))
+
+        for scenario in args.scenarios:
+            full    = False
+            restore = False
+            if scenario == "changed":
+                server_process.touch(args.touch)
+            elif scenario == "restart":
+                db      = rhythmbox_stubs.RhythmDB()
+                library = new_library()
+                restore = True
+            elif scenario == "full":
+                full = True
+
+            requests, received = server_process.get_stats()
+            commits  = db.commits
+            writes   = db.sets
+            metrics  = scheduler.get_metrics()
+            start    = time.monotonic()
+
+            db.first_change = None
+
+            if restore:
+                library.restore(lambda: library.update(full))
+            else:
+                library.update(full)
+            finished = rhythmbox_stubs.LOOP.run(args.timeout,
+                                                scheduler.is_idle)
+
+            wall     = time.monotonic() - start
+            stats    = server_process.get_stats()
+            requests = stats[0] - requests
+            received = stats[1] - received
+            commits  = db.commits - commits
+            writes   = db.sets - writes
+            decoded  = scheduler.get_metrics()["decoded_bytes"] \
+                    - metrics["decoded_bytes"]
+
+            # Time until the first songs were committed, if any changed
+            if db.first_change is None:
+                first = "-"
+            else:
+                first = "%.2f" %(db.first_change - start)
+
+            print("%-10s %9.2f %9s %9d %9d %9d %9d %10.1f %9d %9.0f %9.0f "
+                  "%9.1f%s"
+                    %(scenario, wall, first, requests, len(db.entries),
+                      writes, commits, commits / wall if wall else 0,
+                      len(scheduler.get_dead_letters()), received / 1024,
+                      decoded / 1024, peak_rss(),
+                      "" if finished else " (timed out)"))
+
+        store.close()
+    finally:
+        server_process.close()
+        state_dir.cleanup()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
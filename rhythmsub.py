@@ -7,14 +7,32 @@ Copyright (c) 2013 Luke Carrier
 Released under the terms of the GPLv3
 """
 
-from collections import deque
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from gi.repository import Gdk, GdkPixbuf, Gio, GLib, GObject, Gtk, Peas, PeasGtk, RB
+import bisect
 import json
+import logging
+import os
+import random
 import rb
 import re
+import sys
+import threading
 import time
 
-from subsonic import Server as SubsonicServer
+from heapq import heappop, heappush
+from rhythmsub_audio import RhythmsubAudioCache, RhythmsubStreamResolver
+from rhythmsub_store import RhythmsubStore
+from subsonic import ContentDecoder, JSONItemStream, ResponseError, \
+                     Server as SubsonicServer, TransferCounter, parse_datetime
+
+# Rhythmbox doesn't configure Python's logging; set RHYTHMSUB_LOG_LEVEL (e.g. to
+# DEBUG) in the environment to see what we're up to
+if os.environ.get("RHYTHMSUB_LOG_LEVEL"):
+    logging.basicConfig(level=os.environ["RHYTHMSUB_LOG_LEVEL"].upper())
+
+logger = logging.getLogger("rhythmsub")
 
 """
 Rhythmsub Rhythbox plugin.
@@ -75,6 +93,8 @@ class Rhythmsub(GObject.Object, Peas.Activatable):
         shell.append_display_page(self.__source, group)
         shell.register_entry_type_for_source(self.__source, self.__entry_type)
 
+        self.__source.restore()
+
 
     """
     Deactivate the plugin.
@@ -99,16 +119,33 @@ class Rhythmsub(GObject.Object, Peas.Activatable):
 Rhythmsub cache queue.
 """
 class RhythmsubCacheQueue:
+    # Period over which the processing rate is measured, in seconds
+    RATE_WINDOW = 5
+
     # RhythmsubCache instance
     __cache = None
 
+    # Latency of the fetches which appended to the queue
+    __latency = None
+
+    # Logger for the queue
+    __logger = None
+
+    # Fetches which were given up on, and haven't completed since
+    __failed = None
+
     # State indicators
-    __is_refreshing = None # Awaiting an append
     __is_processing = None # process_one() is running
+    __pending       = None # Number of fetches awaiting an append
 
     # The name of the queue (used in log output)
     __name = None
 
+    # Number of items processed, and (time, count) samples from recent process()
+    # runs for measuring the rate
+    __processed = None
+    __samples   = None
+
     # The contents of the queue
     __queue = None
 
@@ -119,30 +156,72 @@ class RhythmsubCacheQueue:
     Initialiser.
     """
     def __init__(self, name, cache, server):
-        self.__name  = name
-        self._cache  = cache
-        self._server = server
+        self.__name   = name
+        self._cache   = cache
+        self._server  = server
+        self.__logger = logger.getChild(name)
 
-        self.__log("initialising")
-
-        self.__is_refreshing = False
+        self.__failed        = set()
         self.__is_processing = False
+        self.__latency       = RhythmsubLatencyHistogram()
+        self.__pending       = 0
+        self.__processed     = 0
         self.__queue         = deque()
+        self.__samples       = deque()
 
     """
-    Log a message.
+    Schedule item updates.
+
+    Items are appended to the back of the queue, or to the front if front is
+    True, in which case they keep their order.
     """
-    def __log(self, msg):
-        print("%s: %s" %(self.__name, msg))
+    def extend(self, items, front=False):
+        self.__logger.debug("adding %d items%s", len(items),
+                            " to the front" if front else "")
+        if front:
+            self.__queue.extendleft(reversed(items))
+        else:
+            self.__queue.extend(items)
+
+        self._cache.ensure_idle_handler_active()
 
     """
-    Schedule item updates.
+    Get the number of items in the queue.
+    """
+    def get_depth(self):
+        return len(self.__queue)
+
     """
-    def extend(self, items):
-        self.__log("adding %d items" %len(items))
-        self.__queue.extend(items)
+    Get the number of fetches which were given up on and haven't completed
+    since.
+    """
+    def get_failed(self):
+        return len(self.__failed)
+
+    """
+    Get the latency histogram of the fetches which appended to the queue.
+
+    Latencies run from the call to refreshing() to the matching call to
+    refreshed(), so include any time spent waiting for the scheduler.
+    """
+    def get_latency(self):
+        return self.__latency
+
+    """
+    Get a snapshot of the queue's metrics.
 
-        self.refreshed()
+    Returns a dictionary of the queue's depth, the number of items processed and
+    the rate at which they were processed over the last RATE_WINDOW seconds, the
+    number of fetches in flight to refill it, and their latency histogram.
+    """
+    def get_metrics(self):
+        return {
+            "depth":     self.get_depth(),
+            "in_flight": self.__pending,
+            "latency":   self.__latency,
+            "processed": self.__processed,
+            "rate":      self.get_rate(),
+        }
 
     """
     Get the name of the queue.
@@ -150,85 +229,309 @@ class RhythmsubCacheQueue:
     def get_name(self):
         return self.__name
 
+    """
+    Get the number of items processed per second over the last RATE_WINDOW
+    seconds.
+    """
+    def get_rate(self):
+        self.__expire_samples(time.monotonic())
+        return sum(count for sampled, count in self.__samples) \
+                / self.RATE_WINDOW
+
+    """
+    Is the queue empty?
+    """
+    def is_empty(self):
+        return not self.__queue
+
     """
     """
     def is_processing(self):
         return self.__is_processing
 
     """
+    Are there fetches due to append to the queue?
     """
     def is_refreshing(self):
-        return self.__is_refreshing
+        return self.__pending > 0
+
+    """
+    Should the queue hold off processing its items for now?
 
+    Queues whose items issue requests hold them back while the scheduler is
+    saturated, so that the items can still be promoted.
     """
-    Process a limited number of queue items.
+    def is_throttled(self):
+        return False
+
     """
-    def process(self, num_items=1):
-        self.__log("processing %d entries" %num_items)
+    Flush the results of a batch of process_one() calls.
 
-        try:
-            complete = False
-            item = self.__queue.popleft()
-            self.__log("processing %s" %item)
+    Called once at the end of every process() run which handled at least one
+    item, so that queues can batch up expensive work like database commits.
+    """
+    def flush(self):
+        pass
+
+    """
+    Process queue items until the deadline passes.
+
+    The deadline is a time.monotonic() value. Unless the queue is throttled, at
+    least one item is processed on every call, so that no queue is starved when
+    others overrun the deadline. Returns True if the queue has been emptied.
+    """
+    def process(self, deadline):
+        queue     = self.__queue
+        debug     = self.__logger.isEnabledFor(logging.DEBUG)
+        processed = 0
 
-            self.__is_processing = True
-            self.process_one(item)
+        self.__is_processing = True
+        try:
+            while queue and not self.is_throttled():
+                item = queue.popleft()
+                if debug:
+                    self.__logger.debug("processing %s", item)
+
+                self.process_one(item)
+                processed += 1
+
+                if time.monotonic() >= deadline:
+                    break
+        finally:
+            if processed:
+                self.flush()
+                self.__record(processed)
             self.__is_processing = False
 
-        except IndexError:
-            complete = True
-            self.__log("no items to process")
+        if debug and processed:
+            self.__logger.debug("processed %d items, %d remain", processed,
+                                len(queue))
+        return not queue
+
+    """
+    Move the items matching a predicate to the front of the queue.
+
+    The matching items keep their order, as do the rest. Returns the list of
+    items promoted.
+    """
+    def promote(self, predicate):
+        promoted = []
+        rest     = []
+        for item in self.__queue:
+            (promoted if predicate(item) else rest).append(item)
+
+        if promoted:
+            self.__logger.debug("promoting %d items", len(promoted))
+            self.__queue.clear()
+            self.__queue.extend(promoted)
+            self.__queue.extend(rest)
+
+            self._cache.ensure_idle_handler_active()
 
-        return complete
+        return promoted
 
     """
-    Trigger the idle handler to ensure processing.
+    Get a failure callback for a fetch which would have refreshed a queue.
+
+    The failed item is logged and the fetch marked as failed, so that the queue
+    doesn't report itself as refreshing forever. The scheduler keeps hold of
+    the request in its dead-letter list. refresh is the value returned by the
+    queue's refreshing() call.
+    """
+    def failure_cb(self, queue, item, refresh):
+        def real_failure_cb(error, attempts):
+            self.__logger.warning("giving up on %s after %d attempts: %s",
+                                  item, attempts, error)
+            queue.failed(refresh)
+
+        return real_failure_cb
+
     """
-    def refreshed(self):
-        self.__log("refreshed; ensuring idle handler is active")
-        self.__is_refreshing = False
+    Indicate that a fetch which would have appended to the queue was given up
+    on.
+
+    The queue stops waiting for it, but counts it as failed until it's
+    resubmitted and completes. Calls for fetches which have already settled are
+    ignored.
+    """
+    def failed(self, refresh):
+        self.__settle(refresh)
+        self.__failed.add(refresh)
+
         self._cache.ensure_idle_handler_active()
 
     """
-    Indicate that the queue is refreshing.
+    Indicate that a fetch has finished appending to the queue.
 
-    When queried by the idle handler, the queue reports that new items are being
-    added. This can sometimes prevent the idle handler from exiting prematurely.
+    Triggers the idle handler to ensure processing. Pass the value returned by
+    the matching call to refreshing(). A fetch settles once: the callbacks of
+    a resubmitted dead letter call this again, which is ignored unless
+    resubmitted() was called in between.
+    """
+    def refreshed(self, refresh):
+        self.__settle(refresh)
+        self.__failed.discard(refresh)
+
+        self._cache.ensure_idle_handler_active()
+
+    """
+    Indicate that a fetch will append to the queue.
 
-    You should call refreshed() when you're done, else the idle handler will
-    poll for all eternity.
+    When queried by the idle handler, the queue reports that new items are being
+    added until a matching call to refreshed() or failed(). Returns the fetch's
+    RhythmsubRefresh, to pass to them.
     """
     def refreshing(self):
-        self.__is_refreshing = True
+        self.__pending += 1
+        return RhythmsubRefresh()
+
+    """
+    Indicate that the fetches which failed have been resubmitted.
 
+    The queue reports that it's refreshing again until each of them settles.
+    """
+    def resubmitted(self):
+        for refresh in self.__failed:
+            if not refresh.pending:
+                refresh.pending = True
+                refresh.started = time.monotonic()
+                self.__pending += 1
+
+    """
+    Stop waiting for a fetch, recording its latency, unless it has already
+    settled.
+    """
+    def __settle(self, refresh):
+        if refresh.pending:
+            refresh.pending = False
+            self.__pending -= 1
+            self.__latency.observe(time.monotonic() - refresh.started)
+
+    """
+    Forget rate samples older than RATE_WINDOW seconds.
+    """
+    def __expire_samples(self, now):
+        samples = self.__samples
+        while samples and samples[0][0] < now - self.RATE_WINDOW:
+            samples.popleft()
+
+    """
+    Record the number of items processed by a process() run.
+    """
+    def __record(self, processed):
+        now = time.monotonic()
+
+        self.__processed += processed
+        self.__samples.append((now, processed))
+        self.__expire_samples(now)
+
+
+"""
+Rhythmsub queue refresh.
+
+Tracks a fetch which will append to a RhythmsubCacheQueue, so that it settles
+exactly once however many times its callbacks are called.
+"""
+class RhythmsubRefresh:
+    __slots__ = ("pending", "started")
 
+    """
+    Initialiser.
+    """
+    def __init__(self):
+        self.pending = True
+        self.started = time.monotonic()
+
+
+"""
+Rhythmsub cache artist queue.
+
+Artists are only expanded once the albums already discovered have been handed
+to the scheduler, so that songs start to appear long before every artist has
+been listed. Promoted artists' albums jump the album queue.
+"""
 class RhythmsubCacheArtistQueue(RhythmsubCacheQueue):
     # Album queue
     __album_queue = None
 
+    # IDs of promoted artists which haven't been expanded yet
+    __promoted = None
+
+    # Song queue, for songs filed directly beneath artists
+    __song_queue = None
+
     """
     Initialiser.
     """
-    def __init__(self, name, cache, server, album_queue):
-        super(self.__class__, self).__init__(name, cache, server)
+    def __init__(self, name, cache, server, album_queue, song_queue):
+        super(RhythmsubCacheArtistQueue, self).__init__(name, cache, server)
 
         self.__album_queue = album_queue
+        self.__promoted    = set()
+        self.__song_queue  = song_queue
+
+    """
+    Get the albums of an artist asynchronously.
+
+    The artist's directory is listed; subclasses may list them differently.
+    """
+    def get_albums_async(self, complete_cb, artist, priority, failure_cb):
+        self._cache.get_directory_async(complete_cb, artist, priority,
+                                        failure_cb)
  
+    """
+    Hold off expanding artists until the album queue has been drained.
+    """
+    def is_throttled(self):
+        return not self.__album_queue.is_empty() or self._cache.is_saturated()
+
     """
     Fetch all of the artists in the library and pass them to the album queue.
     """
     def process_one(self, artist):
         album_queue = self.__album_queue
+        song_queue  = self.__song_queue
+        promoted    = artist.id in self.__promoted
 
-        def complete_cb(resp):
+        def complete_cb(albums, songs):
             try:
-                album_queue.extend(resp.children)
-            except TypeError:
-                pass # there are no children
+                album_queue.extend(albums, promoted)
+                if songs:
+                    song_queue.extend(songs, promoted)
             finally:
-                album_queue.refreshed()
+                album_queue.refreshed(refresh)
+
+        if promoted:
+            self.__promoted.discard(artist.id)
+            priority = RhythmsubRequestScheduler.PRIORITY_HIGH
+        else:
+            priority = RhythmsubRequestScheduler.PRIORITY_LOW
+
+        refresh = album_queue.refreshing()
+        self.get_albums_async(complete_cb, artist, priority,
+                              self.failure_cb(album_queue, artist, refresh))
+
+    """
+    Move the artists matching a predicate to the front of the queue.
 
-        self._server.get_music_directory_async(complete_cb, artist["id"])
+    Their albums are placed at the front of the album queue as they arrive.
+    """
+    def promote(self, predicate):
+        promoted = super(RhythmsubCacheArtistQueue, self).promote(predicate)
+        self.__promoted.update(artist.id for artist in promoted)
+
+        return promoted
+
+
+"""
+Rhythmsub cache artist queue, organised by ID3 tags.
+
+Items are artists from getArtists rather than directories.
+"""
+class RhythmsubCacheID3ArtistQueue(RhythmsubCacheArtistQueue):
+    def get_albums_async(self, complete_cb, artist, priority, failure_cb):
+        self._cache.get_artist_albums_async(complete_cb, artist, priority,
+                                            failure_cb)
 
 
 class RhythmsubCacheAlbumQueue(RhythmsubCacheQueue):
@@ -239,239 +542,1956 @@ class RhythmsubCacheAlbumQueue(RhythmsubCacheQueue):
     Initialiser.
     """
     def __init__(self, name, cache, server, song_queue):
-        super(self.__class__, self).__init__(name, cache, server)
+        super(RhythmsubCacheAlbumQueue, self).__init__(name, cache, server)
 
         self.__song_queue = song_queue
- 
-    def process_one(self, album):
-        song_queue = self.__song_queue
-
-        def complete_cb(resp):
-            song_queue.extend(resp.children)
-            song_queue.refreshed()
-
-        self._server.get_music_directory_async(complete_cb, album["id"])
-
-
-class RhythmsubCacheSongQueue(RhythmsubCacheQueue):
-    # RhythmDB instance
-    __db = None
 
-    # RhythmsubDBEntryType
-    __entry_type = None
+    """
+    Get the contents of an album asynchronously.
 
+    The album's directory is listed; subclasses may list them differently.
     """
-    Initialiser.
+    def get_songs_async(self, complete_cb, album, priority, failure_cb):
+        self._cache.get_directory_async(complete_cb, album, priority,
+                                        failure_cb)
+ 
+    """
+    Hold off listing albums while the scheduler is saturated.
     """
-    def __init__(self, name, cache, server, db, entry_type):
-        super(self.__class__, self).__init__(name, cache, server)
+    def is_throttled(self):
+        return self._cache.is_saturated()
 
-        self.__db         = db
-        self.__entry_type = entry_type
- 
     """
-    Add/update one song.
+    Fetch the songs in an album and pass them to the song queue.
+
+    Subdirectories (e.g. one per disc) are queued as albums in their own right,
+    at the front of the queue so that albums are finished before others are
+    started.
     """
-    def process_one(self, song):
-        url = "rhythmsub://%s/%d" %(self._server.get_address(), song["id"])
+    def process_one(self, album):
+        song_queue = self.__song_queue
 
-        entry = self.__db.entry_lookup_by_location(url)
-        if entry is None:
-            entry = RB.RhythmDBEntry.new(self.__db, self.__entry_type, url)
+        def complete_cb(directories, songs):
+            try:
+                if directories:
+                    self.extend(directories, True)
+                song_queue.extend(songs)
+            finally:
+                song_queue.refreshed(refresh)
 
-        try:
-            self.__db.entry_set(entry,  RB.RhythmDBPropType.ALBUM,        song["album"])
-            self.__db.entry_set(entry,  RB.RhythmDBPropType.ARTIST,       song["artist"])
-            self.__db.entry_set(entry,  RB.RhythmDBPropType.TITLE,        song["title"])
-            self.__db.entry_set(entry,  RB.RhythmDBPropType.DATE,         song["year"])
-        except KeyError:
-            return False
+        refresh = song_queue.refreshing()
+        self.get_songs_async(complete_cb, album,
+                             RhythmsubRequestScheduler.PRIORITY_HIGH,
+                             self.failure_cb(song_queue, album, refresh))
 
-        try: self.__db.entry_set(entry, RB.RhythmDBPropType.DURATION,     song["duration"])
-        except KeyError: pass
 
-        try: self.__db.entry_set(entry, RB.RhythmDBPropType.FILE_SIZE,    song["size"])
-        except KeyError: pass
+"""
+Rhythmsub cache album queue, organised by ID3 tags.
 
-        try: self.__db.entry_set(entry, RB.RhythmDBPropType.GENRE,        song["genre"])
-        except KeyError: pass
+Items are albums from getArtist rather than directories.
+"""
+class RhythmsubCacheID3AlbumQueue(RhythmsubCacheAlbumQueue):
+    def get_songs_async(self, complete_cb, album, priority, failure_cb):
+        self._cache.get_album_songs_async(complete_cb, album, priority,
+                                          failure_cb)
 
-        try: self.__db.entry_set(entry, RB.RhythmDBPropType.TRACK_NUMBER, song["track"])
-        except KeyError: pass
 
-        self.__db.commit()
+class RhythmsubCacheSongQueue(RhythmsubCacheQueue):
+    # Number of songs to restore from the snapshot per idle callback
+    RESTORE_BATCH_SIZE = 500
 
+    # Number of changed songs to hold back before saving them to the snapshot
+    SNAPSHOT_BATCH_SIZE = 5000
 
-"""
-Rhythmsub local content cache.
+    # Number of stale entries to delete per idle callback when sweeping
+    SWEEP_BATCH_SIZE = 500
+
+    # Have any entries changed since the last commit?
+    __changed = None
 
-This class is responsible for maintaining the local RhythmDB cache of content
-in the remote Subsonic server.
-"""
-class RhythmsubCache:
     # RhythmDB instance
     __db = None
 
-    # The queues
-    __queues = None
+    # Our entries, keyed by location, indexed from RhythmDB once per generation
+    # so that songs don't have to be looked up one by one
+    __entries = None
 
-    # The Subsonic server instance
-    __server = None
+    # RhythmsubDBEntryType
+    __entry_type = None
 
-    """
-    Initialiser.
+    # Generation of the running update, and the generation which last touched
+    # each entry, keyed by location
+    __generation = None
+    __stamps     = None
 
-    Prepare queues.
-    """
-    def __init__(self, db, entry_type, server):
-        self.__db         = db
-        self.__entry_type = entry_type
-        self.__server     = server
+    # Prefix of the locations of our entries
+    __location_prefix = None
 
-        self.__queues = {
-            "song": RhythmsubCacheSongQueue  ("song", self, self.__server, self.__db, self.__entry_type),
-        }
-        self.__queues["album"]  = RhythmsubCacheAlbumQueue ("album",  self, self.__server, self.__queues["song"])
-        self.__queues["artist"] = RhythmsubCacheArtistQueue("artist", self, self.__server, self.__queues["album"])
+    # RhythmsubStore instance holding the snapshot of our songs, if any, and
+    # the key it's stored under
+    __store     = None
+    __store_key = None
 
-        self.__idle_handler_active = False
+    # Changed songs not yet saved to the snapshot, keyed by location
+    __unsaved = None
 
     """
-    Cache idle callback.
+    Initialiser.
 
-    Registered as an idle callback with Gdk; checks for and performs DB updates
-    in the background until all queues are empty.
+    The locations of the queue's entries all start with location_prefix, which
+    identifies the partition of the library they belong to. If a store is
+    specified, a snapshot of the songs is kept in it under store_key, from
+    which the entries can be restored in later sessions.
     """
-    def __idle_handler(self, data):
-        print("queue processing: run started at %d" %time.time())
-        incomplete = []
+    def __init__(self, name, cache, server, db, entry_type, location_prefix,
+                 store=None, store_key=None):
+        super(RhythmsubCacheSongQueue, self).__init__(name, cache, server)
 
-        for name, queue in self.__queues.items():
-            print("queue processing: %s" %name)
+        self.__db              = db
+        self.__entry_type      = entry_type
+        self.__location_prefix = location_prefix
+        self.__store           = store
+        self.__store_key       = store_key
 
-            if queue.is_processing():
-                print("already processing")
-                incomplete.append(name)
-            else:
-                queue.process()
+        self.__changed    = False
+        self.__generation = 0
+        self.__stamps     = {}
+        self.__unsaved    = {}
 
-            if queue.is_refreshing():
-                print("refreshing")
-                incomplete.append(name)
+    """
+    Delete the entries at the specified locations, and commit.
+    """
+    def delete(self, locations):
+        entries = self.__get_entries()
+
+        for location in locations:
+            # Entries written elsewhere (e.g. placeholders) aren't indexed
+            entry = entries.pop(location, None)
+            if entry is None:
+                entry = self.__db.entry_lookup_by_location(location)
+            if entry is not None:
+                self.__db.entry_delete(entry)
+            self.__stamps.pop(location, None)
+            self.__unsaved.pop(location, None)
 
-        if len(incomplete) == 0:
-            self.__idle_handler_active = False
-            return False
+        self.__db.commit()
+        self.__changed = False
 
-        print("queue processing: run completed with %s queues incomplete at %d"
-                %(", ".join(set(incomplete)), time.time()))
-        return True
+        if self.__store is not None:
+            self.__store.delete_songs(self.__store_key, locations)
 
+    """
+    Get the location of a song's entry.
+    """
+    def get_location(self, song):
+        return "%s%s" %(self.__location_prefix, song.id)
 
     """
-    Ensure the idle handler is running.
+    Get the prefix of the locations of the queue's entries.
+    """
+    def get_location_prefix(self):
+        return self.__location_prefix
 
-    This should be called whenever a queue is extended in order to ensure its
-    contents gets processed.
     """
-    def ensure_idle_handler_active(self):
-        if self.__idle_handler_active == False:
-            Gdk.threads_add_idle(GLib.PRIORITY_DEFAULT_IDLE, self.__idle_handler, {})
-            self.__idle_handler_active = True
+    Start a new generation.
 
+    Every entry added or updated from now on is stamped with it. Our entries
+    are indexed afresh when the first song of the generation is processed, in
+    case any were removed from RhythmDB behind our back.
     """
-    Update the local cache of Subsonic content.
+    def next_generation(self):
+        self.__entries     = None
+        self.__generation += 1
+        return self.__generation
+ 
     """
-    def update(self):
-        print("called")
+    Add/update one song.
 
-        artist_queue = self.__queues["artist"]
+    Changed songs are saved to the snapshot in batches.
+    """
+    def process_one(self, song):
+        if song.title is None:
+            return False
 
-        def complete_cb(resp):
-            artist_queue.extend(resp.index)
-            artist_queue.refreshed()
+        url = self.get_location(song)
+        self.__stamps[url] = self.__generation
 
-        self.__server.get_indexes_async(complete_cb)
+        if self.__write(url, song) and self.__store is not None:
+            self.__unsaved[url] = song
 
-        self.ensure_idle_handler_active()
+    """
+    Commit the batch of songs, if any of them changed.
+    """
+    def flush(self):
+        if self.__changed:
+            self.__db.commit()
+            self.__changed = False
 
+        if len(self.__unsaved) >= self.SNAPSHOT_BATCH_SIZE:
+            self.save()
 
-"""
-Rhythmsub configuration dialogue.
-"""
-class RhythmsubConfigDialog(GObject.Object, PeasGtk.Configurable):
-    # GObject type name
-    __gtype_name = 'RhythmsubConfigDialog'
+    """
+    Restore our entries from the snapshot.
 
-    # Rhythmbox shell object
-    object = GObject.property(type=GObject.Object)
+    Songs are restored RESTORE_BATCH_SIZE at a time from an idle callback,
+    committing after each batch, without any network use. complete_cb is called
+    with the number of songs restored once they all have been.
+    """
+    def restore(self, complete_cb):
+        if self.__store is None:
+            complete_cb(0)
+            return
+
+        state = {
+            "after": "", # location of the last song restored
+            "count": 0,  # number of songs restored
+        }
 
-    # Configuration dialogue's root widget
-    __config_dialog = None
+        def restore_cb(data):
+            songs = self.__store.get_songs(self.__store_key, state["after"],
+                                           self.RESTORE_BATCH_SIZE)
 
-    # Settings from GIO
-    __settings = None
+            for location, song in songs:
+                self.__write(location, RhythmsubSong(*song))
+            if self.__changed:
+                self.__db.commit()
+                self.__changed = False
 
-    # GTK UI builder
-    __ui = None
+            state["count"] += len(songs)
+            if len(songs) == self.RESTORE_BATCH_SIZE:
+                state["after"] = songs[-1][0]
+                return True
+
+            complete_cb(state["count"])
+            return False
+
+        Gdk.threads_add_idle(GLib.PRIORITY_DEFAULT_IDLE, restore_cb, None)
 
     """
-    Create the configuration widget for display in plugin preferences.
+    Save the changed songs held back to the snapshot.
     """
-    def do_create_configure_widget(self):
-        self.__settings = Rhythmsub.get_settings()
+    def save(self):
+        if self.__unsaved:
+            self.__store.set_songs(self.__store_key, self.__unsaved.items())
+            self.__unsaved.clear()
 
-        self.__ui = Gtk.Builder()
-        self.__ui.add_from_file(rb.find_plugin_file(self, "preferences.ui"))
-        self.__config_dialog = self.__ui.get_object("rhythmsub-preferences")
+    """
+    Get our entries, keyed by location, indexing them if necessary.
+    """
+    def __get_entries(self):
+        if self.__entries is None:
+            entries = self.__entries = {}
+            prefix  = self.__location_prefix
 
-        for input in ["address", "username", "password"]:
-            input_object = self.__ui.get_object("server-" + input + "-entry")
-            input_object.set_text(self.__settings[input])
-            input_object.connect("changed", self.handle_change)
+            def index_cb(entry, *data):
+                location = entry.get_string(RB.RhythmDBPropType.LOCATION)
+                if location.startswith(prefix):
+                    entries[location] = entry
 
-        return self.__config_dialog
+            self.__db.entry_foreach_by_type(self.__entry_type, index_cb)
+
+        return self.__entries
 
     """
-    Handle a value change event within the plugin's preferences.
+    Add/update the entry for a song at a location.
 
-    Given a widget object, alter the corresponding value in GIO.
+    Only properties which differ from the entry's are set, since every change
+    is signalled to the browser and property views; a song which hasn't changed
+    costs nothing. Returns True if the entry changed.
     """
-    def handle_change(self, widget):
-        widget_name = Gtk.Buildable.get_name(widget)
-        prop_name   = re.match("^server-(.+?)-entry$", widget_name).group(1)
+    def __write(self, url, song):
+        entries = self.__get_entries()
+        changed = False
 
-        value = widget.get_text()
+        # Only songs new to the index need looking up, in case an entry was
+        # left at their location (e.g. by a previous activation)
+        entry = entries.get(url)
+        if entry is None:
+            entry = self.__db.entry_lookup_by_location(url)
+            if entry is None:
+                entry   = RB.RhythmDBEntry.new(self.__db, self.__entry_type,
+                                               url)
+                changed = True
+            entries[url] = entry
+
+        for prop, get, value in (
+                (RB.RhythmDBPropType.ALBUM,        entry.get_string, song.album),
+                (RB.RhythmDBPropType.ARTIST,       entry.get_string, song.artist),
+                (RB.RhythmDBPropType.TITLE,        entry.get_string, song.title),
+                (RB.RhythmDBPropType.DATE,         entry.get_ulong,  song.year),
+                (RB.RhythmDBPropType.DURATION,     entry.get_ulong,  song.duration),
+                (RB.RhythmDBPropType.FILE_SIZE,    entry.get_uint64, song.size),
+                (RB.RhythmDBPropType.GENRE,        entry.get_string, song.genre),
+                (RB.RhythmDBPropType.TRACK_NUMBER, entry.get_ulong,  song.track)):
+            if value is not None and get(prop) != value:
+                self.__db.entry_set(entry, prop, value)
+                changed = True
+
+        self.__changed = self.__changed or changed
+        return changed
 
-        self.__settings[prop_name] = value
+    """
+    Remove entries which weren't touched by the current generation.
+
+    Only call this once an update has visited every song in its partition, or
+    songs which simply weren't visited will be removed; other partitions'
+    entries are left alone. Stale entries are deleted SWEEP_BATCH_SIZE at a
+    time from an idle callback, committing after each batch, and are removed
+    from the snapshot straight away. Returns the number of entries to be
+    removed.
+    """
+    def sweep(self):
+        db         = self.__db
+        generation = self.__generation
+        prefix     = self.__location_prefix
+        stamps     = self.__stamps
+        entries    = self.__entries or {}
+        unsaved    = self.__unsaved
+        locations  = []
+        stale      = []
+
+        def collect_cb(entry, *data):
+            location = entry.get_string(RB.RhythmDBPropType.LOCATION)
+            if location.startswith(prefix) \
+                    and stamps.get(location) != generation:
+                stamps.pop(location, None)
+                entries.pop(location, None)
+                unsaved.pop(location, None)
+                locations.append(location)
+                stale.append(entry)
+
+        def delete_cb(data):
+            batch = stale[-self.SWEEP_BATCH_SIZE:]
+            del stale[-self.SWEEP_BATCH_SIZE:]
+
+            for entry in batch:
+                db.entry_delete(entry)
+            db.commit()
+
+            return len(stale) > 0
+
+        db.entry_foreach_by_type(self.__entry_type, collect_cb)
+        if locations and self.__store is not None:
+            self.__store.delete_songs(self.__store_key, locations)
+
+        count = len(stale)
+        if count:
+            Gdk.threads_add_idle(GLib.PRIORITY_DEFAULT_IDLE, delete_cb, None)
+
+        return count
 
 
 """
-"""
-class RhythmsubDBEntryType(RB.RhythmDBEntryType):
-    def __init__(self):
-        RB.RhythmDBEntryType.__init__(self, name="rhythmsub-entry-type")
+Rhythmsub lazy loader.
 
+In lazy browsing mode only the artist index is synchronised up front. Until an
+artist is loaded it's represented in RhythmDB by a placeholder entry, so that
+it still appears in the browser. Loading an artist walks its albums and queues
+their songs, which replace the placeholder.
 
+Only the most recently used artists are kept loaded; the songs of the rest are
+removed again and their placeholders restored, so that memory and network use
+follow what is browsed rather than the size of the library.
 """
-Rhythmsub database source.
-"""
-class RhythmsubSource(RB.BrowserSource):
-    # Rhythmsub content cache
-    __cache = None
+class RhythmsubLazyLoader:
+    # Number of placeholder entries to write per idle callback
+    PLACEHOLDER_BATCH_SIZE = 500
+
+    # Album and artist queues, whose fetch methods are used to walk artists
+    __album_queue  = None
+    __artist_queue = None
+
+    # Maximum number of artists kept loaded
+    __capacity = None
 
     # RhythmDB instance
     __db = None
 
-    # RhythmsubDBEntryType instance
+    # RhythmsubDBEntryType
     __entry_type = None
 
-    # Settings from GIO
-    __settings = None
+    # Artists in the index, keyed by ID
+    __index = None
 
-    # Subsonic instance
+    # Locations of the songs of each loaded artist, keyed by artist ID, least
+    # recently used first
+    __loaded = None
+
+    # IDs of the artists being loaded
+    __loading = None
+
+    # Artists awaiting placeholders, and whether they're being written
+    __pending = None
+    __writing = None
+
+    # Names of the artists with placeholders, keyed by artist ID
+    __placeholders = None
+
+    # Song queue
+    __song_queue = None
+
+    """
+    Initialiser.
+
+    capacity is the number of artists to keep loaded.
+    """
+    def __init__(self, db, entry_type, artist_queue, album_queue, song_queue,
+                 capacity):
+        self.__db           = db
+        self.__entry_type   = entry_type
+        self.__artist_queue = artist_queue
+        self.__album_queue  = album_queue
+        self.__song_queue   = song_queue
+        self.__capacity     = max(1, capacity)
+
+        self.__index        = {}
+        self.__loaded       = OrderedDict()
+        self.__loading      = set()
+        self.__pending      = deque()
+        self.__placeholders = {}
+        self.__writing      = False
+
+    """
+    Get the number of artists loaded.
+    """
+    def get_loaded(self):
+        return len(self.__loaded)
+
+    """
+    Is an artist being loaded?
+    """
+    def is_loading(self):
+        return len(self.__loading) > 0
+
+    """
+    Load an artist's songs.
+
+    Artists which are already loaded are only marked as recently used, unless
+    refresh is True, in which case they're walked again and songs which have
+    disappeared are removed. Returns True if the artist is being walked.
+    """
+    def load(self, artist, refresh=False):
+        if artist.id in self.__loading:
+            return False
+        if artist.id in self.__loaded and not refresh:
+            self.__loaded.move_to_end(artist.id)
+            return False
+
+        logger.debug("loading artist %s", artist)
+        self.__loading.add(artist.id)
+
+        songs = []
+        state = {
+            "failed":  False, # has any part of the walk failed?
+            "pending": 0,     # number of listings outstanding
+        }
+
+        def walk(get_children_async, item):
+            state["pending"] += 1
+            get_children_async(listed_cb, item,
+                               RhythmsubRequestScheduler.PRIORITY_HIGH,
+                               failure_cb)
+
+        def listed_cb(directories, new_songs):
+            songs.extend(new_songs)
+            for directory in directories:
+                walk(self.__album_queue.get_songs_async, directory)
+            finished()
+
+        def failure_cb(error, attempts):
+            logger.warning("failed to load artist %s: %s", artist, error)
+            state["failed"] = True
+            finished()
+            return True
+
+        def finished():
+            state["pending"] -= 1
+            if state["pending"] > 0:
+                return
+
+            self.__loading.discard(artist.id)
+            if state["failed"]:
+                # Keep the placeholder, or what we had, for another attempt
+                return
+
+            self.__loaded_cb(artist, songs)
+
+        walk(self.__artist_queue.get_albums_async, artist)
+        return True
+
+    """
+    Load the artists whose names match a predicate.
+
+    At most limit artists are loaded. Returns the number of matching artists.
+    """
+    def load_matching(self, predicate, limit):
+        count = 0
+        for artist in self.__index.values():
+            if count >= limit:
+                break
+
+            if artist.name is not None and predicate(artist.name):
+                self.load(artist)
+                count += 1
+
+        return count
+
+    """
+    Replace the artist index.
+
+    Placeholders are written for artists which aren't loaded, and loaded
+    artists are refreshed. Artists which have disappeared are removed.
+    """
+    def set_index(self, index):
+        self.__index = dict((artist.id, artist) for artist in index)
+
+        stale = []
+        for artist_id in list(self.__placeholders):
+            if artist_id not in self.__index:
+                del self.__placeholders[artist_id]
+                stale.append(self.__placeholder_location(artist_id))
+        for artist_id in list(self.__loaded):
+            if artist_id not in self.__index:
+                stale.extend(self.__loaded.pop(artist_id))
+        if stale:
+            self.__song_queue.delete(stale)
+
+        self.__add_placeholders([artist for artist in index
+                                 if artist.id not in self.__loaded])
+        for artist_id in list(self.__loaded):
+            self.load(self.__index[artist_id], True)
+
+    """
+    Queue placeholders for artists, and start writing them.
+    """
+    def __add_placeholders(self, artists):
+        self.__pending.extend(artists)
+
+        if self.__pending and not self.__writing:
+            self.__writing = True
+            Gdk.threads_add_idle(GLib.PRIORITY_DEFAULT_IDLE,
+                                 self.__write_placeholders, None)
+
+    """
+    Replace an artist's placeholder, or previous songs, with its songs.
+
+    Evicts the least recently used artists if we're over capacity.
+    """
+    def __loaded_cb(self, artist, songs):
+        locations = [self.__song_queue.get_location(song) for song in songs]
+
+        # Refreshed artists keep their place in the eviction order
+        stale = set(self.__loaded.get(artist.id, ())).difference(locations)
+        if artist.id in self.__placeholders:
+            del self.__placeholders[artist.id]
+            stale.add(self.__placeholder_location(artist.id))
+        if stale:
+            self.__song_queue.delete(stale)
+
+        self.__loaded[artist.id] = locations
+        if songs:
+            self.__song_queue.extend(songs, True)
+
+        while len(self.__loaded) > self.__capacity:
+            self.__unload(next(iter(self.__loaded)))
+
+    """
+    Get the location of an artist's placeholder entry.
+    """
+    def __placeholder_location(self, artist_id):
+        return "%sartist/%s" %(self.__song_queue.get_location_prefix(),
+                               artist_id)
+
+    """
+    Remove a loaded artist's songs and restore its placeholder.
+    """
+    def __unload(self, artist_id):
+        logger.debug("unloading artist %s", artist_id)
+        self.__song_queue.delete(self.__loaded.pop(artist_id))
+
+        artist = self.__index.get(artist_id)
+        if artist is not None:
+            self.__add_placeholders((artist,))
+
+    """
+    Write queued placeholders.
+
+    Idle callback writing PLACEHOLDER_BATCH_SIZE placeholders per run and
+    committing after each batch.
+    """
+    def __write_placeholders(self, data):
+        db      = self.__db
+        pending = self.__pending
+
+        for i in range(min(len(pending), self.PLACEHOLDER_BATCH_SIZE)):
+            artist = pending.popleft()
+            if artist.id in self.__loaded or artist.name is None \
+                    or self.__placeholders.get(artist.id) == artist.name:
+                continue
+
+            location = self.__placeholder_location(artist.id)
+            entry    = db.entry_lookup_by_location(location)
+            if entry is None:
+                entry = RB.RhythmDBEntry.new(db, self.__entry_type, location)
+            db.entry_set(entry, RB.RhythmDBPropType.ARTIST, artist.name)
+            self.__placeholders[artist.id] = artist.name
+
+        db.commit()
+
+        if pending:
+            return True
+
+        self.__writing = False
+        return False
+
+
+"""
+Rhythmsub local content cache.
+
+This class is responsible for maintaining the local RhythmDB cache of content
+in the remote Subsonic server.
+"""
+class RhythmsubCache:
+    # Crawl modes: walk the folder structure, or the ID3 tag structure, or page
+    # through all songs with search3 (falling back to the folder structure)
+    CRAWL_FOLDERS = "folders"
+    CRAWL_ID3     = "id3"
+    CRAWL_SEARCH3 = "search3"
+
+    # Number of songs per search3 page, and pages to keep in flight
+    BULK_PAGE_SIZE = 500
+    BULK_WINDOW    = 4
+
+    # Number of artists kept loaded in lazy browsing mode, and the most loaded
+    # by a single promotion
+    LAZY_ARTISTS     = 100
+    LAZY_MATCH_LIMIT = 20
+
+    # Album creation times within this many seconds of the last update are
+    # considered new, since they're usually in the server's unknown time zone
+    CHANGE_MARGIN = 86400
+
+    # Number of albums to request per page when looking for new albums
+    NEWEST_PAGE_SIZE = 500
+
+    # Number of folders between new albums and their artists we'll climb
+    # through before falling back to crawling every artist
+    MAX_PARENT_DEPTH = 8
+
+    # How the library is crawled
+    __crawl_mode = None
+
+    # RhythmDB instance
+    __db = None
+
+    # RhythmsubLazyLoader instance, in lazy browsing mode
+    __lazy_loader = None
+
+    # ID of the music folder synchronised, or None for the whole library
+    __music_folder_id = None
+
+    # The queues
+    __queues = None
+
+    # RhythmsubRequestScheduler instance used by the server
+    __scheduler = None
+
+    # The Subsonic server instance
+    __server = None
+
+    # RhythmsubStore instance, and the key our state is stored under
+    __store     = None
+    __store_key = None
+
+    # State of the running update, if any: whether it visits every song (and
+    # may therefore sweep away the rest), the artist index and its modification
+    # time, both persisted once the update completes, and whether cached
+    # directories must be revalidated with the server
+    __sync_complete      = None
+    __sync_full          = None
+    __sync_index         = None
+    __sync_last_modified = None
+    __syncing            = None
+
+    # IDs of folders the running update found new albums beneath, which must
+    # be revalidated even if their change markers haven't moved
+    __sync_changed = None
+
+    # Session ID of the running update, under which directory listings without
+    # a change marker are checkpointed until it finishes
+    __sync_session = None
+
+    # Have the entries left by previous sessions been restored from the
+    # snapshot?
+    __restored = None
+
+    # Has a complete update finished since the cache was created?
+    __synced = None
+
+    # Time the idle handler may spend on each run, in seconds
+    __time_slice = None
+
+    """
+    Initialiser.
+
+    Prepare queues. time_slice is the number of milliseconds the idle handler
+    may spend processing queue items on each run; keep it short enough that
+    the UI stays responsive.
+
+    The ID3 crawl mode costs a request per album, regardless of how deep or
+    messy the server's folder structure is, but requires tags to be in order.
+    The search3 crawl mode costs a request per BULK_PAGE_SIZE songs, but isn't
+    supported by all servers.
+
+    In lazy browsing mode updates only synchronise the artist index, and artists
+    are loaded as they're promoted, keeping the lazy_artists most recently used.
+    Artists are walked by folder or by ID3 tags; search3 isn't used.
+
+    If music_folder_id is specified only that music folder is synchronised, as
+    one partition of a RhythmsubLibrary; its state is stored separately.
+    """
+    def __init__(self, db, entry_type, server, scheduler, store,
+                 time_slice=8, crawl_mode=CRAWL_FOLDERS, lazy=False,
+                 lazy_artists=LAZY_ARTISTS, music_folder_id=None):
+        self.__db              = db
+        self.__entry_type      = entry_type
+        self.__server          = server
+        self.__scheduler       = scheduler
+        self.__store           = store
+        self.__crawl_mode      = crawl_mode
+        self.__music_folder_id = music_folder_id
+
+        self.set_time_slice(time_slice)
+
+        # Entries and stored state are kept apart for each partition
+        self.__store_key = server.get_address()
+        location_prefix  = "rhythmsub://%s/" %server.get_address()
+        if music_folder_id is not None:
+            self.__store_key = "%s?musicFolderId=%s" %(self.__store_key,
+                                                      music_folder_id)
+            location_prefix += "%s/" %music_folder_id
+
+        self.__restored     = False
+        self.__synced       = False
+        self.__syncing      = False
+        self.__sync_changed = set()
+
+        if crawl_mode == self.CRAWL_ID3:
+            album_queue_class  = RhythmsubCacheID3AlbumQueue
+            artist_queue_class = RhythmsubCacheID3ArtistQueue
+        else:
+            album_queue_class  = RhythmsubCacheAlbumQueue
+            artist_queue_class = RhythmsubCacheArtistQueue
+
+        # Lazily loaded songs come and go, so aren't worth a snapshot
+        snapshot_store = None if lazy else store
+
+        self.__queues = {
+            "song": RhythmsubCacheSongQueue  ("song", self, self.__server, self.__db, self.__entry_type, location_prefix, snapshot_store, self.__store_key),
+        }
+        self.__queues["album"]  = album_queue_class ("album",  self, self.__server, self.__queues["song"])
+        self.__queues["artist"] = artist_queue_class("artist", self, self.__server, self.__queues["album"], self.__queues["song"])
+
+        if lazy:
+            if crawl_mode == self.CRAWL_SEARCH3:
+                self.__crawl_mode = self.CRAWL_FOLDERS
+
+            self.__lazy_loader = RhythmsubLazyLoader(
+                    self.__db, self.__entry_type, self.__queues["artist"],
+                    self.__queues["album"], self.__queues["song"],
+                    lazy_artists)
+
+        self.__idle_handler_active = False
+
+    """
+    Cache idle callback.
+
+    Registered as an idle callback with Gdk; checks for and performs DB updates
+    in the background until all queues are empty. Queues which are only
+    awaiting fetches don't keep the handler alive: they reactivate it when their
+    items arrive.
+
+    Each run drains as many items as fit in the time slice, sharing it between
+    the queues in turn: songs, then albums, then artists, so that work on the
+    artists already discovered goes before discovering more. Throttled queues
+    don't keep the handler alive either; the scheduler reactivates it once its
+    backlog drains.
+    """
+    def __idle_handler(self, data):
+        deadline = time.monotonic() + self.__time_slice
+
+        for name, queue in self.__queues.items():
+            if queue.is_processing():
+                logger.debug("%s queue already processing", name)
+            else:
+                queue.process(deadline)
+
+        # Items served from the store are appended to the queues processed
+        # before them during the same run
+        incomplete = [name for name, queue in self.__queues.items()
+                      if not queue.is_empty()]
+
+        if len(incomplete) == 0:
+            self.__idle_handler_active = False
+
+            if self.__syncing and not self.__is_busy():
+                self.__update_finished()
+
+            return False
+
+        if all(self.__queues[name].is_throttled() for name in incomplete):
+            self.__idle_handler_active = False
+            self.__scheduler.add_drain_cb(self.ensure_idle_handler_active)
+            return False
+
+        return True
+
+
+    """
+    Get the children of an item asynchronously, via the store.
+
+    Items whose change marker matches the one we cached them with are served
+    from the store without a request, unless a full update is running.
+    Otherwise fetch is called with a callback which expects lists of directory
+    and song records. The key distinguishes the namespaces of different types
+    of item.
+    """
+    def __get_children_async(self, complete_cb, key, item, fetch):
+        address = self.__server.get_address()
+        marker  = item.marker
+        reuse   = not self.__sync_full and str(key) not in self.__sync_changed
+
+        # Listings we couldn't otherwise cache are kept until the update
+        # finishes, so that it can be resumed if it's interrupted
+        if marker is None and self.__sync_session is not None:
+            marker = self.__sync_session
+            reuse  = True
+
+        if marker is not None and reuse:
+            children = self.__store.get_directory(address, key, marker)
+            try:
+                directories = [RhythmsubDirectory(*d) for d in children[0]]
+                songs       = [RhythmsubSong(*s)      for s in children[1]]
+            except (IndexError, TypeError):
+                # Not cached, or cached with a different record layout
+                pass
+            else:
+                complete_cb(directories, songs)
+                return
+
+        def real_complete_cb(directories, songs):
+            if marker is not None:
+                self.__store.set_directory(address, key, marker,
+                                           (directories, songs))
+
+            complete_cb(directories, songs)
+
+        fetch(real_complete_cb)
+
+    """
+    Get the songs of an album, organised by ID3 tags, asynchronously.
+
+    complete_cb is called with lists of directory and song records; the former
+    is always empty.
+    """
+    def get_album_songs_async(self, complete_cb, album, priority=0,
+                              failure_cb=None):
+        def fetch(real_complete_cb):
+            self.__server.get_album_async(
+                    lambda resp: real_complete_cb(
+                            [], [RhythmsubSong.from_response(song)
+                                 for song in resp.songs]),
+                    album.id, priority, failure_cb)
+
+        self.__get_children_async(complete_cb, "album:%s" %album.id, album,
+                                  fetch)
+
+    """
+    Get the albums of an artist, organised by ID3 tags, asynchronously.
+
+    complete_cb is called with lists of directory and song records; the latter
+    is always empty.
+    """
+    def get_artist_albums_async(self, complete_cb, artist, priority=0,
+                                failure_cb=None):
+        def fetch(real_complete_cb):
+            self.__server.get_artist_async(
+                    lambda resp: real_complete_cb(
+                            [RhythmsubDirectory.from_response(album)
+                             for album in resp.albums], []),
+                    artist.id, priority, failure_cb)
+
+        self.__get_children_async(complete_cb, "artist:%s" %artist.id,
+                                  artist, fetch)
+
+    """
+    Get the children of a directory asynchronously.
+
+    complete_cb is called with lists of directory and song records.
+    """
+    def get_directory_async(self, complete_cb, directory, priority=0,
+                            failure_cb=None):
+        def fetch(real_complete_cb):
+            self.__server.get_music_directory_async(
+                    lambda resp: real_complete_cb(
+                            *split_children(resp.children)),
+                    directory.id, priority, failure_cb)
+
+        self.__get_children_async(complete_cb, directory.id, directory,
+                                  fetch)
+
+    """
+    Remove every entry added by the cache.
+
+    Used when a partition's music folder disappears from the server. The stored
+    state is forgotten too, so that the folder is crawled from scratch if it
+    reappears.
+    """
+    def clear(self):
+        song_queue = self.__queues["song"]
+        song_queue.next_generation()
+        logger.info("removing %d entries", song_queue.sweep())
+
+        if self.__lazy_loader is not None:
+            self.__lazy_loader.set_index([])
+
+        self.__restored = False
+        self.__synced   = False
+        self.__store.set_last_modified(self.__store_key, None)
+        self.__store.clear_checkpoint(self.__store_key)
+        self.__store.clear_songs(self.__store_key)
+
+    """
+    Ensure the idle handler is running.
+
+    This should be called whenever a queue is extended in order to ensure its
+    contents gets processed.
+    """
+    def ensure_idle_handler_active(self):
+        if self.__idle_handler_active == False:
+            Gdk.threads_add_idle(GLib.PRIORITY_DEFAULT_IDLE, self.__idle_handler, {})
+            self.__idle_handler_active = True
+
+    """
+    Get a snapshot of the cache's metrics.
+
+    Returns a dictionary with the metrics of each queue, keyed by name, and of
+    the request scheduler.
+    """
+    def get_metrics(self):
+        return {
+            "queues":   dict((name, queue.get_metrics())
+                             for name, queue in self.__queues.items()),
+            "requests": self.__scheduler.get_metrics(),
+        }
+
+    """
+    Are enough requests waiting that queues should stop issuing more?
+
+    Keeping the scheduler's backlog short leaves the rest of the work in the
+    queues, where it can still be promoted.
+    """
+    def is_saturated(self):
+        return self.__scheduler.get_waiting() \
+                >= self.__scheduler.get_max_in_flight()
+
+    """
+    Is an update running?
+    """
+    def is_updating(self):
+        return self.__syncing
+
+    """
+    Promote the artists and albums with names matching a predicate.
+
+    Matching items which are still queued move to the front of their queues,
+    and the albums of matching artists are fetched ahead of any others. In lazy
+    browsing mode, up to LAZY_MATCH_LIMIT matching artists are loaded instead.
+    Used to bring forward what the user is browsing or searching for. Returns
+    the number of items promoted.
+    """
+    def promote(self, predicate):
+        if self.__lazy_loader is not None:
+            return self.__lazy_loader.load_matching(predicate,
+                                                    self.LAZY_MATCH_LIMIT)
+
+        count = 0
+        for name in ("artist", "album"):
+            count += len(self.__queues[name].promote(
+                    lambda item: item.name is not None and predicate(item.name)))
+
+        if count:
+            logger.info("promoted %d items", count)
+        return count
+
+    """
+    Are any fetches outstanding?
+
+    Other partitions' requests don't count; our resubmitted dead letters do,
+    since our queues wait for them.
+    """
+    def __is_busy(self):
+        return any(queue.is_refreshing() for queue in self.__queues.values()) \
+                or (self.__lazy_loader is not None
+                    and self.__lazy_loader.is_loading())
+
+    """
+    Page through every song on the server with search3.
+
+    Songs go straight to the song queue as they're parsed, skipping the artist
+    and album queues.
+    The first page is fetched alone; if the server can't list the library this
+    way we fall back to crawling the folder structure. The rest are fetched
+    BULK_WINDOW pages at a time until we receive a short page.
+    """
+    def __bulk_update(self, index, last_modified, since):
+        song_queue = self.__queues["song"]
+        page_size  = self.BULK_PAGE_SIZE
+        state      = {
+            "end":  None, # offset of the first missing song, once known
+            "next": 0,    # offset of the next page to request
+        }
+
+        def fall_back(reason):
+            logger.info("bulk update unavailable (%s); crawling folders",
+                        reason)
+            self.__sync_complete = since is None
+            self.__index_loaded(index, last_modified, since)
+
+        def fetch_next_page():
+            offset = state["next"]
+            if state["end"] is not None and offset >= state["end"]:
+                return
+
+            # Retried pages deliver their songs again
+            seen = set()
+
+            def song_cb(song):
+                if song["id"] not in seen:
+                    seen.add(song["id"])
+                    song_queue.extend((RhythmsubSong.from_response(song),))
+
+            state["next"] += page_size
+            refresh = song_queue.refreshing()
+            self.__server.search3_songs_stream_async(
+                    song_cb, lambda: complete_cb(len(seen), offset, refresh),
+                    "", song_count=page_size, song_offset=offset,
+                    music_folder_id=self.__music_folder_id,
+                    priority=RhythmsubRequestScheduler.PRIORITY_HIGH,
+                    failure_cb=lambda error, attempts: failure_cb(
+                            error, offset, refresh))
+
+        def complete_cb(count, offset, refresh):
+            try:
+                if offset == 0 and not count and index:
+                    fall_back("no songs returned")
+                    return
+
+                if count < page_size:
+                    end = offset + count
+                    state["end"] = end if state["end"] is None \
+                                       else min(state["end"], end)
+                elif offset == 0:
+                    for i in range(self.BULK_WINDOW):
+                        fetch_next_page()
+                else:
+                    fetch_next_page()
+            finally:
+                song_queue.refreshed(refresh)
+
+        def failure_cb(error, offset, refresh):
+            if offset == 0:
+                song_queue.refreshed(refresh)
+                fall_back(error)
+                return True
+
+            song_queue.failed(refresh)
+
+        self.__sync_complete      = True
+        self.__sync_index         = index
+        self.__sync_last_modified = last_modified
+        fetch_next_page()
+
+    """
+    Queue the artists of a freshly fetched index.
+
+    Without a previous update to compare against, all of them are queued. In
+    lazy browsing mode the index is handed to the lazy loader instead.
+    """
+    def __index_loaded(self, index, last_modified, since):
+        self.__sync_index         = index
+        self.__sync_last_modified = last_modified
+
+        if self.__lazy_loader is not None:
+            self.__lazy_loader.set_index(index)
+        elif since is None:
+            self.__queues["artist"].extend(index)
+        else:
+            self.__queue_changed_artists(index, since)
+
+    """
+    Queue the artists which changed since the last update.
+
+    The index doesn't tell us which artists changed, so we consider those which
+    are new or were renamed, plus the artists of albums created since the last
+    update. Albums are scanned newest first until we reach ones older than the
+    last update.
+
+    In the folder structure albums needn't sit directly beneath their artists
+    (e.g. Artist/Year/Album), so we climb from their parents to the artists in
+    the index; see __find_artists(). If that fails, every artist is crawled.
+    """
+    def __queue_changed_artists(self, index, since):
+        artist_queue = self.__queues["artist"]
+        known        = self.__store.get_artists(self.__store_key)
+        threshold    = since / 1000 - self.CHANGE_MARGIN
+        artist_ids   = set(str(artist.id) for artist in index)
+        parents      = set()
+
+        changed = set(str(artist.id) for artist in index
+                      if known.get(str(artist.id)) != artist.name)
+
+        if self.__crawl_mode == self.CRAWL_ID3:
+            get_album_list_async = self.__server.get_album_list2_async
+            parent_key           = "artistId"
+        else:
+            get_album_list_async = self.__server.get_album_list_async
+            parent_key           = "parent"
+
+        def fetch_page(offset):
+            refresh = artist_queue.refreshing()
+            get_album_list_async(
+                    lambda resp: complete_cb(resp, offset, refresh),
+                    "newest", self.NEWEST_PAGE_SIZE, offset,
+                    self.__music_folder_id,
+                    failure_cb=artist_queue.failure_cb(artist_queue,
+                                                       "newest albums",
+                                                       refresh))
+
+        def complete_cb(resp, offset, refresh):
+            try:
+                for album in resp.albums:
+                    try:
+                        created = parse_datetime(album["created"]).timestamp()
+                    except (KeyError, ValueError):
+                        created = None
+
+                    if created is not None and created < threshold:
+                        break
+                    parents.add(str(album.get(parent_key)))
+                else:
+                    if len(resp.albums) == self.NEWEST_PAGE_SIZE:
+                        fetch_page(offset + self.NEWEST_PAGE_SIZE)
+                        return
+
+                changed.update(parents & artist_ids)
+                unplaced = parents - artist_ids
+                if not unplaced:
+                    queue_changed(changed)
+                elif self.__crawl_mode == self.CRAWL_ID3:
+                    queue_changed(None)
+                else:
+                    self.__find_artists(
+                            unplaced, artist_ids,
+                            lambda found: queue_changed(
+                                    None if found is None else changed | found))
+            finally:
+                artist_queue.refreshed(refresh)
+
+        def queue_changed(changed):
+            if changed is None:
+                logger.info("unable to find the artists of new albums; "
+                            "crawling every artist")
+                self.__sync_full = True
+                artist_queue.extend(index)
+                return
+
+            logger.info("%d artists changed since last update", len(changed))
+            artist_queue.extend([artist for artist in index
+                                 if str(artist.id) in changed])
+
+        fetch_page(0)
+
+    """
+    Find the artists in the index which folders sit beneath, asynchronously.
+
+    Climbs from each folder through its parents until it reaches one of the
+    artist_ids. The folders passed through are revalidated by the running
+    update, since their change markers needn't move when albums are added
+    beneath them. complete_cb is called with the IDs of the artists found, or
+    None if any folder couldn't be placed.
+    """
+    def __find_artists(self, directory_ids, artist_ids, complete_cb):
+        artist_queue = self.__queues["artist"]
+        found        = set()
+        visited      = set(directory_ids)
+        state        = {"lost": False, "pending": 0}
+
+        def climb(id, depth):
+            if depth > self.MAX_PARENT_DEPTH or id == "None":
+                state["lost"] = True
+                return
+
+            state["pending"] += 1
+            refresh = artist_queue.refreshing()
+            self.__server.get_music_directory_async(
+                    lambda resp: directory_cb(resp, depth, refresh), id,
+                    RhythmsubRequestScheduler.PRIORITY_HIGH,
+                    failure_cb=lambda error, attempts: failure_cb(
+                            error, id, refresh))
+
+        def directory_cb(resp, depth, refresh):
+            try:
+                self.__sync_changed.add(str(resp.id))
+
+                parent = str(resp.parent)
+                if parent in artist_ids:
+                    found.add(parent)
+                elif parent not in visited:
+                    visited.add(parent)
+                    climb(parent, depth + 1)
+            finally:
+                finished()
+                artist_queue.refreshed(refresh)
+
+        def failure_cb(error, id, refresh):
+            logger.warning("unable to find the artist of folder %s: %s", id,
+                           error)
+            state["lost"] = True
+            finished()
+            artist_queue.refreshed(refresh)
+            return True
+
+        def finished():
+            state["pending"] -= 1
+            if not state["pending"]:
+                complete_cb(None if state["lost"] else found)
+
+        for id in directory_ids:
+            climb(id, 1)
+
+        if not state["pending"]:
+            complete_cb(None)
+
+    """
+    Finish an update once all of its work has completed.
+
+    The index is only persisted if every one of the partition's requests
+    succeeded, so that anything missed is picked up by the next update.
+    Likewise, entries for songs which weren't seen are only removed after a
+    successful update which visited every song. The checkpoint is kept until
+    then too, so that a later update can resume.
+    """
+    def __update_finished(self):
+        self.__syncing      = False
+        self.__sync_session = None
+        self.__sync_changed = set()
+        index, self.__sync_index = self.__sync_index, None
+
+        # The snapshot must be complete before the index is persisted
+        self.__queues["song"].save()
+
+        # The scheduler is shared between partitions, so only count the
+        # fetches our own queues gave up on
+        failed = sum(queue.get_failed() for queue in self.__queues.values())
+        if failed:
+            logger.warning("update incomplete; %d requests failed", failed)
+            return
+
+        self.__store.clear_checkpoint(self.__store_key)
+
+        if index is not None:
+            self.__store.set_artists(self.__store_key, index)
+            self.__store.set_last_modified(self.__store_key,
+                                           self.__sync_last_modified)
+
+            if self.__sync_complete:
+                self.__synced = True
+                logger.info("removing %d stale entries",
+                            self.__queues["song"].sweep())
+
+        logger.info("update finished")
+
+    """
+    Restore the entries left by previous updates from the snapshot.
+
+    The update which follows needn't fetch anything if the index hasn't changed
+    since the last one which succeeded. complete_cb is called once the entries
+    have been restored.
+    """
+    def restore(self, complete_cb):
+        def restored_cb(count):
+            logger.info("restored %d entries", count)
+            self.__restored = count > 0
+            complete_cb()
+
+        self.__queues["song"].restore(restored_cb)
+
+    """
+    Start checkpointing the running update under a new session ID.
+
+    Directories checkpointed under any previous session are forgotten.
+    """
+    def __new_checkpoint(self, last_modified, full):
+        if self.__lazy_loader is not None:
+            return
+
+        self.__store.clear_checkpoint(self.__store_key)
+        self.__sync_session = "checkpoint:%016x" %random.getrandbits(64)
+        self.__store.set_checkpoint(self.__store_key, self.__sync_session,
+                                    last_modified, full)
+
+    """
+    Change the number of milliseconds the idle handler may spend on each run.
+    """
+    def set_time_slice(self, time_slice):
+        self.__time_slice = max(1, time_slice) / 1000
+
+    """
+    Update the local cache of Subsonic content.
+
+    Requests which failed during previous updates are retried first. Unless a
+    full update is requested, only artists which changed since the last
+    complete update are crawled, and nothing at all if the index hasn't
+    changed.
+
+    getIndexes is always used to detect changes, since getArtists doesn't
+    support ifModifiedSince; in ID3 crawl mode the artists are then fetched
+    with getArtists. In search3 crawl mode any change causes the whole library
+    to be paged through, which is still cheaper than walking changed artists.
+
+    RhythmDB doesn't keep our entries between sessions, so the first complete
+    update in each session crawls every artist; unchanged directories are still
+    served from the store. If the entries were restored from the snapshot, it
+    waits until the index has changed since the last update. Entries for songs
+    which have disappeared from the server are removed after updates which
+    crawl everything.
+
+    Updates are checkpointed as they go: every directory listing fetched is
+    stored, including those without a change marker, under the update's
+    session ID. If Rhythmbox exits before an update finishes, the next one
+    resumes it, replaying what was already crawled from the store and only
+    fetching the rest (though a full update still revalidates directories with
+    change markers). The checkpoint is abandoned if the index has changed
+    since.
+
+    In lazy browsing mode the whole index is fetched every time, and the loaded
+    artists are refreshed.
+    """
+    def update(self, full=False):
+        if self.__syncing:
+            logger.info("update already in progress")
+            return
+
+        logger.info("update started")
+        self.__syncing = True
+
+        checkpoint = None
+        if self.__lazy_loader is None:
+            checkpoint = self.__store.get_checkpoint(self.__store_key)
+        if checkpoint is None:
+            self.__new_checkpoint(None, full)
+        else:
+            logger.info("resuming interrupted update")
+            self.__sync_session = checkpoint[0]
+            full = full or checkpoint[2]
+
+        self.__sync_full    = full
+        self.__sync_changed = set()
+
+        if full:
+            self.__server.clear_cache()
+
+        retried = self.__scheduler.retry_dead_letters()
+        if retried:
+            logger.info("retrying %d failed requests", retried)
+        for queue in self.__queues.values():
+            queue.resubmitted()
+
+        self.__queues["song"].next_generation()
+
+        # Until there's been a complete update, restored entries are only
+        # checked for changes to the index; any change has everything crawled
+        artist_queue = self.__queues["artist"]
+        since        = None
+        if not full and (self.__synced or self.__restored):
+            since = self.__store.get_last_modified(self.__store_key)
+        crawl_since = since if self.__synced else None
+        self.__sync_complete = crawl_since is None \
+                and self.__lazy_loader is None
+
+        # The index is parsed incrementally; when crawling all folders the
+        # artists are queued as soon as they arrive, unless we have to check
+        # that a checkpoint is still valid first
+        index  = []
+        seen   = set()
+        stream = since is None and self.__crawl_mode == self.CRAWL_FOLDERS \
+                and self.__lazy_loader is None and checkpoint is None
+
+        def artist_cb(artist):
+            # Retried requests deliver their artists again
+            if artist["id"] in seen:
+                return
+
+            seen.add(artist["id"])
+            artist = RhythmsubArtist.from_response(artist)
+            index.append(artist)
+            if stream:
+                artist_queue.extend((artist,))
+
+        def complete_cb(last_modified):
+            try:
+                if checkpoint is not None \
+                        and checkpoint[1] not in (None, last_modified):
+                    logger.info("index changed; abandoning checkpoint")
+                    self.__new_checkpoint(last_modified, full)
+                elif self.__sync_session is not None:
+                    self.__store.set_checkpoint(self.__store_key,
+                                                self.__sync_session,
+                                                last_modified, full)
+
+                if since is not None and not index:
+                    logger.info("index unchanged since last update")
+                elif self.__crawl_mode == self.CRAWL_SEARCH3:
+                    self.__bulk_update(index, last_modified, crawl_since)
+                elif self.__crawl_mode == self.CRAWL_ID3:
+                    artists_refresh = artist_queue.refreshing()
+                    self.__server.get_artists_async(
+                            lambda artists_resp: artists_cb(artists_resp,
+                                                            last_modified,
+                                                            artists_refresh),
+                            self.__music_folder_id,
+                            failure_cb=artist_queue.failure_cb(
+                                    artist_queue, "artists", artists_refresh))
+                elif stream:
+                    self.__sync_index         = index
+                    self.__sync_last_modified = last_modified
+                else:
+                    self.__index_loaded(index, last_modified, crawl_since)
+            finally:
+                artist_queue.refreshed(refresh)
+
+        def artists_cb(resp, last_modified, refresh):
+            try:
+                self.__index_loaded([RhythmsubArtist.from_response(artist)
+                                     for artist in resp.artists],
+                                    last_modified, crawl_since)
+            finally:
+                artist_queue.refreshed(refresh)
+
+        refresh = artist_queue.refreshing()
+        self.__server.get_indexes_stream_async(
+                artist_cb, complete_cb, self.__music_folder_id, since,
+                failure_cb=artist_queue.failure_cb(artist_queue, "index",
+                                                   refresh))
+
+        self.ensure_idle_handler_active()
+
+
+"""
+Rhythmsub library.
+
+Synchronises a server's library as one partition per music folder, each a
+RhythmsubCache with its own queues, progress and stored state. Partitions
+update concurrently, sharing the scheduler's request budget, so that a huge
+folder doesn't hold up the others; one can also be updated on its own.
+
+Servers which can't list their music folders are synchronised as a single
+partition covering the whole library.
+
+The music folders are remembered, so that the partitions can be restored from
+their snapshots at startup without any network use.
+"""
+class RhythmsubLibrary:
+    # Is the list of music folders being fetched?
+    __listing = None
+
+    # Names of the partitions, keyed by music folder ID
+    __names = None
+
+    # Function creating the RhythmsubCache for a music folder ID
+    __partition_factory = None
+
+    # Partitions, keyed by music folder ID (None for the whole library)
+    __partitions = None
+
+    # Are the partitions being restored?
+    __restoring = None
+
+    # RhythmsubRequestScheduler instance used by the server
+    __scheduler = None
+
+    # The Subsonic server instance
+    __server = None
+
+    # RhythmsubStore instance
+    __store = None
+
+    # Total time the partitions' idle handlers may spend on each run, in
+    # milliseconds
+    __time_slice = None
+
+    """
+    Initialiser.
+
+    partition_factory is called with a music folder ID, or None for the whole
+    library, and returns a RhythmsubCache for it. time_slice is shared between
+    the partitions, whose idle handlers all run on each main loop iteration.
+    """
+    def __init__(self, server, scheduler, store, partition_factory,
+                 time_slice=8):
+        self.__server            = server
+        self.__scheduler         = scheduler
+        self.__store             = store
+        self.__partition_factory = partition_factory
+        self.__time_slice        = time_slice
+
+        self.__listing    = False
+        self.__names      = {}
+        self.__partitions = OrderedDict()
+        self.__restoring  = False
+
+    """
+    Get a snapshot of the library's metrics.
+
+    Returns a dictionary with the queue metrics of each partition and whether
+    it's updating, keyed by name, and the metrics of the request scheduler.
+    """
+    def get_metrics(self):
+        partitions = OrderedDict()
+        for music_folder_id, partition in self.__partitions.items():
+            partitions[self.__names[music_folder_id]] = {
+                "queues":   partition.get_metrics()["queues"],
+                "updating": partition.is_updating(),
+            }
+
+        return {
+            "partitions": partitions,
+            "requests":   self.__scheduler.get_metrics(),
+        }
+
+    """
+    Get the partitions.
+
+    Returns a list of (music folder ID, name) pairs.
+    """
+    def get_partitions(self):
+        return [(music_folder_id, self.__names[music_folder_id])
+                for music_folder_id in self.__partitions]
+
+    """
+    Is any partition updating?
+
+    The library counts as updating while it's being restored, since updates
+    have to wait until it has been.
+    """
+    def is_updating(self):
+        return self.__listing or self.__restoring \
+                or any(partition.is_updating()
+                       for partition in self.__partitions.values())
+
+    """
+    Promote the artists and albums with names matching a predicate in every
+    partition.
+
+    Returns the number of items promoted.
+    """
+    def promote(self, predicate):
+        return sum(partition.promote(predicate)
+                   for partition in self.__partitions.values())
+
+    """
+    Restore the partitions from their snapshots.
+
+    Partitions are created for the music folders seen by the last update, and
+    their entries restored. complete_cb is called once they all have been.
+    """
+    def restore(self, complete_cb):
+        folders = self.__store.get_music_folders(self.__server.get_address())
+        if not folders or self.__partitions or self.__restoring:
+            complete_cb()
+            return
+
+        self.__set_partitions(folders)
+
+        state = {
+            "pending": len(self.__partitions), # partitions being restored
+        }
+
+        def restored_cb():
+            state["pending"] -= 1
+            if not state["pending"]:
+                self.__restoring = False
+                complete_cb()
+
+        self.__restoring = True
+        for partition in list(self.__partitions.values()):
+            partition.restore(restored_cb)
+
+    """
+    Update the library, or a single music folder.
+
+    Updating the whole library fetches the list of music folders first, adding
+    partitions for new folders and clearing away those which have gone.
+    """
+    def update(self, full=False, music_folder_id=None):
+        if self.__restoring:
+            logger.info("library still being restored")
+            return
+
+        if music_folder_id is not None:
+            partition = self.__partitions.get(music_folder_id)
+            if partition is None:
+                logger.warning("no partition for music folder %s",
+                               music_folder_id)
+            else:
+                partition.update(full)
+            return
+
+        if self.__listing:
+            logger.info("update already in progress")
+            return
+
+        def complete_cb(resp):
+            self.__listing = False
+            self.__set_partitions([(folder["id"], folder.get("name"))
+                                   for folder in resp.music_folders])
+            update_all()
+
+        def failure_cb(error, attempts):
+            self.__listing = False
+            logger.warning("unable to list music folders: %s", error)
+            if not self.__partitions:
+                self.__set_partitions([])
+            update_all()
+            return True
+
+        def update_all():
+            for partition in self.__partitions.values():
+                partition.update(full)
+
+        self.__listing = True
+        self.__server.get_music_folders_async(
+                complete_cb, RhythmsubRequestScheduler.PRIORITY_HIGH,
+                failure_cb)
+
+    """
+    Replace the partitions with those for a list of music folders.
+
+    folders is a list of (ID, name) pairs; if it's empty, a single partition
+    covers the whole library. Partitions which are no longer needed are cleared,
+    and the time slice is shared between those which remain.
+    """
+    def __set_partitions(self, folders):
+        if not folders:
+            folders = [(None, "Library")]
+        self.__store.set_music_folders(self.__server.get_address(), folders)
+
+        wanted = OrderedDict(folders)
+        for music_folder_id in list(self.__partitions):
+            if music_folder_id not in wanted:
+                logger.info("music folder %s removed",
+                            self.__names[music_folder_id])
+                self.__partitions.pop(music_folder_id).clear()
+
+        for music_folder_id, name in wanted.items():
+            if music_folder_id not in self.__partitions:
+                self.__partitions[music_folder_id] = \
+                        self.__partition_factory(music_folder_id)
+            self.__names[music_folder_id] = name or str(music_folder_id)
+
+        time_slice = max(1, self.__time_slice // len(self.__partitions))
+        for partition in self.__partitions.values():
+            partition.set_time_slice(time_slice)
+
+
+# Properties of a directory entry which make up its change marker
+DIRECTORY_MARKER_KEYS = ("created", "title", "name", "artist", "album", "year",
+                         "genre", "coverArt", "childCount", "songCount",
+                         "duration")
+
+"""
+Compute the change marker of a directory from its entry in its parent.
+
+Subsonic doesn't expose modification times for directories, so we use the
+properties which change along with their contents. Entries without a creation
+time (e.g. artists in the index) have no marker and must always be fetched.
+"""
+def directory_marker(directory):
+    if "created" not in directory:
+        return None
+
+    return json.dumps([directory.get(key) for key in DIRECTORY_MARKER_KEYS],
+                      separators=(",", ":"))
+
+
+"""
+Intern a string property of a record.
+
+Artist, album and genre names repeat across thousands of songs; interning them
+means each is only held in memory once.
+"""
+def intern_property(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+"""
+Split the children of a directory into directory and song records.
+"""
+def split_children(children):
+    directories = []
+    songs       = []
+
+    for child in children:
+        if child.get("isDir"):
+            directories.append(RhythmsubDirectory.from_response(child))
+        else:
+            songs.append(RhythmsubSong.from_response(child))
+
+    return directories, songs
+
+
+"""
+Rhythmsub artist record.
+
+Queues hold compact, tuple-backed records containing only the properties the
+synchronisation needs, rather than the server's responses.
+"""
+class RhythmsubArtist(namedtuple("RhythmsubArtist", ("id", "name"))):
+    __slots__ = ()
+
+    # Artists never have a change marker
+    marker = None
+
+    """
+    Build a record from an artist in a response.
+    """
+    @classmethod
+    def from_response(cls, artist):
+        return cls(artist["id"], artist.get("name"))
+
+
+"""
+Rhythmsub directory record.
+
+Represents a folder in the folder structure, or an album in the ID3 structure.
+"""
+class RhythmsubDirectory(namedtuple("RhythmsubDirectory",
+                                    ("id", "name", "marker"))):
+    __slots__ = ()
+
+    """
+    Build a record from a directory or an album in a response.
+    """
+    @classmethod
+    def from_response(cls, directory):
+        return cls(directory["id"],
+                   directory.get("title", directory.get("name")),
+                   directory_marker(directory))
+
+
+"""
+Rhythmsub song record.
+"""
+class RhythmsubSong(namedtuple("RhythmsubSong",
+                               ("id", "title", "album", "artist", "year",
+                                "duration", "size", "genre", "track"))):
+    __slots__ = ()
+
+    """
+    Build a record from a song in a response.
+    """
+    @classmethod
+    def from_response(cls, song):
+        return cls(song["id"], song.get("title"),
+                   intern_property(song.get("album")),
+                   intern_property(song.get("artist")), song.get("year"),
+                   song.get("duration"), song.get("size"),
+                   intern_property(song.get("genre")), song.get("track"))
+
+
+"""
+Rhythmsub latency histogram.
+
+Counts latencies in buckets with the upper bounds in BOUNDS, in milliseconds,
+plus a final bucket for anything slower.
+"""
+class RhythmsubLatencyHistogram:
+    # Upper bounds of the buckets, in milliseconds
+    BOUNDS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    # Number of latencies in each bucket
+    __counts = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self):
+        self.__counts = [0] * (len(self.BOUNDS) + 1)
+
+    """
+    Get the buckets.
+
+    Returns a list of (upper bound, count) pairs; the bound of the last bucket
+    is None.
+    """
+    def get_buckets(self):
+        return list(zip(self.BOUNDS + (None,), self.__counts))
+
+    """
+    Get the number of latencies recorded.
+    """
+    def get_count(self):
+        return sum(self.__counts)
+
+    """
+    Estimate a percentile.
+
+    Returns the upper bound of the bucket containing the percentile, or None if
+    there are no latencies or the percentile is beyond the last bound.
+    """
+    def get_percentile(self, percentile):
+        target  = self.get_count() * percentile / 100
+        running = 0
+
+        if not target:
+            return None
+
+        for bound, count in self.get_buckets():
+            running += count
+            if running >= target:
+                return bound
+
+    """
+    Record a latency, in seconds.
+    """
+    def observe(self, latency):
+        self.__counts[bisect.bisect_left(self.BOUNDS, latency * 1000)] += 1
+
+
+"""
+Rhythmsub configuration dialogue.
+"""
+class RhythmsubConfigDialog(GObject.Object, PeasGtk.Configurable):
+    # GObject type name
+    __gtype_name = 'RhythmsubConfigDialog'
+
+    # Rhythmbox shell object
+    object = GObject.property(type=GObject.Object)
+
+    # Configuration dialogue's root widget
+    __config_dialog = None
+
+    # Settings from GIO
+    __settings = None
+
+    # GTK UI builder
+    __ui = None
+
+    """
+    Create the configuration widget for display in plugin preferences.
+    """
+    def do_create_configure_widget(self):
+        self.__settings = Rhythmsub.get_settings()
+
+        self.__ui = Gtk.Builder()
+        self.__ui.add_from_file(rb.find_plugin_file(self, "preferences.ui"))
+        self.__config_dialog = self.__ui.get_object("rhythmsub-preferences")
+
+        for input in ["address", "username", "password"]:
+            input_object = self.__ui.get_object("server-" + input + "-entry")
+            input_object.set_text(self.__settings[input])
+            input_object.connect("changed", self.handle_change)
+
+        return self.__config_dialog
+
+    """
+    Handle a value change event within the plugin's preferences.
+
+    Given a widget object, alter the corresponding value in GIO.
+    """
+    def handle_change(self, widget):
+        widget_name = Gtk.Buildable.get_name(widget)
+        prop_name   = re.match("^server-(.+?)-entry$", widget_name).group(1)
+
+        value = widget.get_text()
+
+        self.__settings[prop_name] = value
+
+
+"""
+Rhythmsub database entry type.
+
+Our entries' locations can't be played themselves; the stream resolver turns
+them into URIs which can.
+"""
+class RhythmsubDBEntryType(RB.RhythmDBEntryType):
+    # RhythmsubStreamResolver instance
+    __resolver = None
+
+    def __init__(self):
+        RB.RhythmDBEntryType.__init__(self, name="rhythmsub-entry-type")
+
+    """
+    Get the URI to play an entry from.
+    """
+    def do_get_playback_uri(self, entry):
+        if self.__resolver is None:
+            return None
+
+        return self.__resolver.resolve(
+                entry.get_string(RB.RhythmDBPropType.LOCATION),
+                entry.get_ulong(RB.RhythmDBPropType.DURATION) or None)
+
+    """
+    Set the resolver mapping our entries' locations to playable URIs.
+    """
+    def set_resolver(self, resolver):
+        self.__resolver = resolver
+
+
+"""
+Rhythmsub database source.
+"""
+class RhythmsubSource(RB.BrowserSource):
+    # Interval between status updates during an update, in milliseconds
+    STATUS_INTERVAL = 1000
+
+    # RhythmDB instance
+    __db = None
+
+    # RhythmsubDBEntryType instance
+    __entry_type = None
+
+    # Rhythmsub library, partitioned by music folder
+    __library = None
+
+    # Settings from GIO
+    __settings = None
+
+    # Status bar progress and text
+    __progress      = None
+    __progress_text = None
+    __text          = None
+
+    # RhythmsubRequestScheduler instance used by the server
+    __scheduler = None
+
+    # Subsonic instance
     __server = None
 
+    # RhythmsubStore instance
+    __store = None
+
+    # Handler ID of the shell player's playing-song-changed signal
+    __playing_song_changed_id = None
+
+    # RhythmsubStreamResolver instance
+    __resolver = None
+
+    # Are we watching the browser's property views?
+    __watching_views = None
+
     """
     Initialiser.
 
@@ -482,12 +2502,30 @@ class RhythmsubSource(RB.BrowserSource):
     def __init__(self, **kwargs):
         super(RhythmsubSource, self).__init__(self, **kwargs)
 
-        self.__settings = Rhythmsub.get_settings()
-        self.__server   = SubsonicServer(self.__settings["address"],
-                                         self.__settings["username"],
-                                         self.__settings["password"],
-                                         "Rhythmsub",
-                                         async_fetcher=RhythmboxLoaderAsyncFetcher)
+        self.__settings  = Rhythmsub.get_settings()
+        self.__store     = RhythmsubStore(os.path.join(RB.user_cache_dir(),
+                                                       "rhythmsub",
+                                                       "rhythmsub.sqlite"))
+        self.__scheduler = RhythmsubRequestScheduler(
+                RhythmboxLoaderAsyncFetcher,
+                self.__settings["max-requests"])
+        self.__server    = SubsonicServer(self.__settings["address"],
+                                          self.__settings["username"],
+                                          self.__settings["password"],
+                                          "Rhythmsub",
+                                          async_fetcher=self.__scheduler)
+
+        cache_size = self.__settings["audio-cache-size"]
+        if cache_size > 0:
+            audio_cache = RhythmsubAudioCache(
+                    os.path.join(RB.user_cache_dir(), "rhythmsub", "audio"),
+                    cache_size * 2**20)
+        else:
+            audio_cache = None
+
+        self.__resolver = RhythmsubStreamResolver(
+                self.__server, audio_cache, self.__settings["max-bit-rate"],
+                self.__settings["stream-format"] or None)
 
     """
     Page tree double click handler.
@@ -495,22 +2533,190 @@ class RhythmsubSource(RB.BrowserSource):
     We use this as a cue to update the local song cache.
     """
     def do_activate(self):
-        self.__shell      = self.props.shell
-        self.__db         = self.__shell.props.db
-        self.__entry_type = self.props.entry_type
+        self.__ensure_library()
 
-        if not self.__cache:
-            self.__cache = RhythmsubCache(self.__db, self.__entry_type, self.__server)
-        self.__cache.update()
+        if not self.__library.is_updating():
+            self.__library.update()
+            GLib.timeout_add(self.STATUS_INTERVAL, self.__update_status)
+            self.__update_status()
+
+    """
+    Restore the library left by previous sessions, then update it.
+
+    Called when the plugin is activated, so that the library can be browsed
+    straight away, even offline.
+    """
+    def restore(self):
+        self.__ensure_library()
+        self.__library.restore(self.do_activate)
 
     """
     Page tree single click handler.
 
     One day we'll probably treat the first single click on our entry type as a
-    cue to update the local cache.
+    cue to update the local cache. For now we start watching the browser, so
+    that the artists and albums selected in it can be promoted.
     """
     def do_selected(self):
-        pass
+        if self.__watching_views:
+            return
+
+        for view in self.get_property_views():
+            view.connect("property-selected", self.__property_selected_cb)
+        self.__watching_views = True
+
+    """
+    Search handler.
+
+    Artists and albums whose names contain the search text are promoted, so
+    that the results fill in first.
+    """
+    def do_search(self, search, cur_text, new_text):
+        RB.BrowserSource.do_search(self, search, cur_text, new_text)
+
+        if self.__library is not None and new_text:
+            text = new_text.lower()
+            self.__library.promote(lambda name: text in name.lower())
+
+    """
+    Stop prefetching and serving songs as the source is removed.
+    """
+    def do_delete_thyself(self):
+        if self.__playing_song_changed_id is not None:
+            self.__shell.props.shell_player.disconnect(
+                    self.__playing_song_changed_id)
+            self.__playing_song_changed_id = None
+            self.__entry_type.set_resolver(None)
+
+        self.__resolver.close()
+
+        RB.BrowserSource.do_delete_thyself(self)
+
+    """
+    Get status bar progress/status text.
+    """
+    def do_get_status(self, status, progress_text, progress):
+        if self.__progress is None:
+            return (status, progress_text, progress)
+
+        return (self.__text, self.__progress_text, self.__progress)
+
+    """
+    Create the library and start resolving our entries for playback, if we
+    haven't already.
+    """
+    def __ensure_library(self):
+        if self.__library:
+            return
+
+        self.__shell      = self.props.shell
+        self.__db         = self.__shell.props.db
+        self.__entry_type = self.props.entry_type
+
+        self.__library = RhythmsubLibrary(
+                self.__server, self.__scheduler, self.__store,
+                self.__new_partition, self.__settings["idle-time-slice"])
+
+        self.__entry_type.set_resolver(self.__resolver)
+        self.__playing_song_changed_id = \
+                self.__shell.props.shell_player.connect(
+                        "playing-song-changed",
+                        self.__playing_song_changed_cb)
+
+    """
+    Get the entries due to play after an entry, as far as we can tell.
+
+    Queued entries play first, then those following the entry in the source
+    it's playing from. Shuffled play orders can't be predicted.
+    """
+    def __get_upcoming(self, entry, count):
+        location = entry.get_string(RB.RhythmDBPropType.LOCATION)
+        queue    = self.__shell.props.queue_source.props.query_model
+        upcoming = [row[0] for row in queue
+                    if row[0].get_string(RB.RhythmDBPropType.LOCATION)
+                            != location]
+
+        source = self.__shell.props.shell_player.get_playing_source()
+        if source is not None:
+            model = source.props.query_model
+            while entry is not None and len(upcoming) < count:
+                entry = model.get_next_from_entry(entry)
+                if entry is not None:
+                    upcoming.append(entry)
+
+        return upcoming[:count]
+
+    """
+    Create the partition of the library for a music folder.
+    """
+    def __new_partition(self, music_folder_id):
+        return RhythmsubCache(self.__db, self.__entry_type, self.__server,
+                              self.__scheduler, self.__store,
+                              self.__settings["idle-time-slice"],
+                              self.__settings["crawl-mode"],
+                              self.__settings["lazy-browsing"],
+                              self.__settings["lazy-artists"],
+                              music_folder_id)
+
+    """
+    Show the progress of the running update in the status bar.
+
+    Called periodically during an update; returns False to stop once the
+    update is complete. Progress is the fraction of the songs found so far
+    which have been processed, across all partitions. Once it's complete, the
+    bytes of responses decoded this session are shown. gvfs decompresses
+    responses before Rhythmbox's loaders hand them over, so the bytes on the
+    wire, and the savings of compression, can't be seen here.
+    """
+    def __update_status(self):
+        metrics    = self.__library.get_metrics()
+        partitions = metrics["partitions"].values()
+        requests   = metrics["requests"]
+
+        processed = sum(partition["queues"]["song"]["processed"]
+                        for partition in partitions)
+
+        if not self.__library.is_updating():
+            # A progress above 1 hides the progress bar
+            self.__set_status(2.0, "", "%d songs synchronised, "
+                                       "%.1f MiB of responses"
+                                           %(processed,
+                                             requests["decoded_bytes"] / 2**20))
+            return False
+
+        found    = processed + sum(partition["queues"]["song"]["depth"]
+                                   for partition in partitions)
+        rate     = sum(partition["queues"]["song"]["rate"]
+                       for partition in partitions)
+        updating = sum(1 for partition in partitions if partition["updating"])
+        self.__set_status(processed / found if found else -1.0,
+                          "Synchronising",
+                          "%d of %d songs, %.0f/s, %d requests in flight, "
+                          "%d of %d folders remaining"
+                                  %(processed, found, rate,
+                                    requests["in_flight"], updating,
+                                    len(partitions)))
+        return True
+
+    """
+    Prefetch the songs due to play after the one which has started.
+    """
+    def __playing_song_changed_cb(self, player, entry):
+        if entry is None:
+            return
+
+        self.__resolver.prefetch([
+                upcoming.get_string(RB.RhythmDBPropType.LOCATION)
+                for upcoming in self.__get_upcoming(
+                        entry, self.__settings["prefetch-tracks"])
+                if upcoming.get_entry_type() == self.__entry_type])
+
+    """
+    Promote the artist or album selected in one of the browser's views.
+    """
+    def __property_selected_cb(self, view, name):
+        if self.__library is not None and name:
+            self.__library.promote(lambda candidate: candidate == name)
 
     """
     Set status bar progress/status text.
@@ -528,27 +2734,591 @@ class RhythmsubSource(RB.BrowserSource):
 
 
 """
-Rhythmbox asynchronous fetcher class.
+Rhythmsub request scheduler.
+
+Sits in front of an asynchronous fetcher and limits the number of requests in
+flight at any one time. Opening a loader for every request in a large library
+exhausts the process' file descriptors and crashes gvfsd-http, so requests
+beyond the limit wait in a priority queue and are dispatched, in FIFO order
+within each priority, as earlier requests complete.
+
+Failed requests are retried after a jittered exponential backoff. Requests
+which exhaust their attempts are handed to their failure callback and parked
+in a dead-letter list, from which they can be resubmitted later.
+
+Instances are drop-in async_fetchers for the Subsonic Server class.
+"""
+class RhythmsubRequestScheduler:
+    # Request priorities; lower values are dispatched first
+    PRIORITY_HIGH    = 0
+    PRIORITY_DEFAULT = 50
+    PRIORITY_LOW     = 100
+
+    # Requests which exhausted their attempts
+    __dead_letters = None
+
+    # Functions to call once fewer than the maximum number of requests in
+    # flight are waiting
+    __drain_cbs = None
+
+    # Backoff before the first retry and the upper limit, in milliseconds
+    __backoff_base = None
+    __backoff_max  = None
+
+    # The wrapped asynchronous fetcher
+    __fetcher = None
+
+    # Number of requests currently in flight
+    __in_flight = None
+
+    # Latency of each attempt, from dispatch to completion or failure
+    __latency = None
+
+    # Maximum number of attempts per request
+    __max_attempts = None
+
+    # Maximum number of requests in flight
+    __max_in_flight = None
+
+    # Number of requests waiting for their backoff to expire
+    __retrying = None
+
+    # Monotonic counter, keeping the wait queue FIFO within a priority
+    __sequence = None
+
+    # Heap of waiting requests as (priority, sequence, request)
+    __waiting = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self, fetcher, max_in_flight=8, max_attempts=4,
+                 backoff_base=500, backoff_max=30000):
+        self.__fetcher       = fetcher
+        self.__max_in_flight = max(1, max_in_flight)
+        self.__max_attempts  = max(1, max_attempts)
+        self.__backoff_base  = backoff_base
+        self.__backoff_max   = backoff_max
+
+        self.__dead_letters = []
+        self.__drain_cbs    = []
+        self.__in_flight    = 0
+        self.__latency      = RhythmsubLatencyHistogram()
+        self.__retrying     = 0
+        self.__sequence     = 0
+        self.__waiting      = []
+
+    """
+    Schedule a request.
+
+    The request is dispatched immediately if there's a free slot, otherwise it
+    waits its turn. complete_cb is called with the decoded response, or with
+    the result of parse_cb if specified; see RhythmboxLoaderAsyncFetcher. If
+    all attempts fail, failure_cb is called with the last error and the number
+    of attempts made; it may return True to indicate that it has dealt with the
+    failure, in which case the request isn't kept as a dead letter.
+    """
+    def get(self, url, complete_cb, failure_cb=None,
+            priority=PRIORITY_DEFAULT, parse_cb=None):
+        self.__enqueue(RhythmsubRequest(url, complete_cb, failure_cb,
+                                        priority, parse_cb=parse_cb))
+
+    """
+    Schedule a request whose response is parsed incrementally.
+
+    As get(), but item_cb is called with each (key, value) pair for the keys as
+    they arrive and complete_cb is called without arguments. Items delivered
+    before a failed attempt will be delivered again by the retry.
+    """
+    def get_stream(self, url, keys, item_cb, complete_cb, failure_cb=None,
+                   priority=PRIORITY_DEFAULT):
+        self.__enqueue(RhythmsubRequest(url, complete_cb, failure_cb,
+                                        priority, keys, item_cb))
+
+    """
+    Call a function once the backlog drains.
+
+    The function is called, once, as soon as fewer requests are waiting than
+    may be in flight; straight away if that's already the case.
+    """
+    def add_drain_cb(self, drain_cb):
+        self.__drain_cbs.append(drain_cb)
+        self.__drained()
+
+    """
+    Get requests which exhausted their attempts.
+    """
+    def get_dead_letters(self):
+        return list(self.__dead_letters)
+
+    """
+    Get the number of requests currently in flight.
+    """
+    def get_in_flight(self):
+        return self.__in_flight
+
+    """
+    Get the maximum number of requests in flight.
+    """
+    def get_max_in_flight(self):
+        return self.__max_in_flight
+
+    """
+    Get the latency histogram of the attempts made so far.
+    """
+    def get_latency(self):
+        return self.__latency
+
+    """
+    Get a snapshot of the scheduler's metrics.
+
+    Returns a dictionary of the numbers of requests in flight, waiting and dead,
+    the latency histogram and the numbers of response bytes received and
+    decoded, which differ by the savings of compression where the fetcher
+    decompresses responses itself. Fetchers which don't count the bytes they
+    transfer report none.
+    """
+    def get_metrics(self):
+        if hasattr(self.__fetcher, "get_transfer"):
+            received, decoded = self.__fetcher.get_transfer().get_counts()
+        else:
+            received, decoded = 0, 0
+
+        return {
+            "dead_letters":   len(self.__dead_letters),
+            "decoded_bytes":  decoded,
+            "in_flight":      self.__in_flight,
+            "latency":        self.__latency,
+            "received_bytes": received,
+            "waiting":        self.get_waiting(),
+        }
+
+    """
+    Get the number of requests waiting for a free slot or a retry.
+    """
+    def get_waiting(self):
+        return len(self.__waiting) + self.__retrying
+
+    """
+    Is the scheduler idle?
+
+    True when there's nothing in flight, waiting or backing off.
+    """
+    def is_idle(self):
+        return self.__in_flight == 0 and self.get_waiting() == 0
+
+    """
+    Resubmit requests which exhausted their attempts.
+
+    Each request gets a fresh set of attempts. Returns the number of requests
+    resubmitted.
+    """
+    def retry_dead_letters(self):
+        dead_letters, self.__dead_letters = self.__dead_letters, []
+
+        for request in dead_letters:
+            request.attempts = 0
+            request.error    = None
+            self.__enqueue(request)
+
+        return len(dead_letters)
+
+    """
+    Change the maximum number of requests in flight.
+
+    Raising the limit dispatches waiting requests straight away; lowering it
+    lets the excess requests drain naturally.
+    """
+    def set_max_in_flight(self, max_in_flight):
+        self.__max_in_flight = max(1, max_in_flight)
+        self.__dispatch()
+
+    """
+    Compute the delay before the next attempt of a request.
+
+    Exponential in the number of attempts so far, with "equal jitter" to keep
+    requests which failed together from retrying together.
+    """
+    def __backoff(self, attempts):
+        delay = min(self.__backoff_max,
+                    self.__backoff_base * (2 ** (attempts - 1)))
+        return int(delay / 2 + random.uniform(0, delay / 2))
+
+    """
+    Dispatch waiting requests until we run out of slots or requests.
+    """
+    def __dispatch(self):
+        while self.__waiting and self.__in_flight < self.__max_in_flight:
+            priority, sequence, request = heappop(self.__waiting)
+
+            self.__in_flight   += 1
+            request.attempts   += 1
+            request.dispatched  = time.monotonic()
+
+            if request.item_cb is None:
+                self.__fetcher.get(request.url,
+                                   self.__wrap_complete_cb(request),
+                                   self.__wrap_failure_cb(request),
+                                   parse_cb=request.parse_cb)
+            else:
+                self.__fetcher.get_stream(request.url, request.keys,
+                                          request.item_cb,
+                                          self.__wrap_complete_cb(request),
+                                          self.__wrap_failure_cb(request))
+
+        self.__drained()
+
+    """
+    Call the drain callbacks if the backlog has drained.
+    """
+    def __drained(self):
+        if self.__drain_cbs and self.get_waiting() < self.__max_in_flight:
+            drain_cbs, self.__drain_cbs = self.__drain_cbs, []
+            for drain_cb in drain_cbs:
+                drain_cb()
+
+    """
+    Add a request to the wait queue and try to dispatch it.
+    """
+    def __enqueue(self, request):
+        heappush(self.__waiting, (request.priority, self.__sequence, request))
+        self.__sequence += 1
+
+        self.__dispatch()
+
+    """
+    Handle a failed attempt.
+
+    Schedule another attempt after a backoff, or give up on the request.
+    """
+    def __failed(self, request, error):
+        request.error = error
+        transient = getattr(error, "is_transient", lambda: True)()
+
+        if transient and request.attempts < self.__max_attempts:
+            self.__retrying += 1
+            GLib.timeout_add(self.__backoff(request.attempts),
+                             self.__retry, request)
+            return
+
+        handled = False
+        if request.failure_cb is not None:
+            handled = request.failure_cb(error, request.attempts)
+
+        if not handled:
+            # subsonic.Server hands the callbacks of a failed request to the
+            # next identical one, so an older dead letter for the same URL has
+            # nothing left to deliver
+            if request.item_cb is None:
+                self.__dead_letters = [
+                        dead for dead in self.__dead_letters
+                        if dead.item_cb is not None or dead.url != request.url]
+            self.__dead_letters.append(request)
+
+    """
+    Free a request's slot and dispatch the next waiting request.
+    """
+    def __release(self, request):
+        self.__latency.observe(time.monotonic() - request.dispatched)
+
+        self.__in_flight -= 1
+        self.__dispatch()
+
+    """
+    Requeue a request once its backoff expires.
+    """
+    def __retry(self, request):
+        self.__retrying -= 1
+        self.__enqueue(request)
+
+        return False
+
+    """
+    Wrap a request's completion callback.
+
+    The slot is always freed, and responses rejected by the callback count as
+    failed attempts.
+    """
+    def __wrap_complete_cb(self, request):
+        def real_complete_cb(*args):
+            try:
+                request.complete_cb(*args)
+            except ResponseError as e:
+                self.__failed(request, e)
+            finally:
+                self.__release(request)
+
+        return real_complete_cb
+
+    """
+    Wrap a request's failure callback such that its slot is always freed.
+    """
+    def __wrap_failure_cb(self, request):
+        def real_failure_cb(error, attempts=1):
+            try:
+                self.__failed(request, error)
+            finally:
+                self.__release(request)
+
+        return real_failure_cb
+
+
+"""
+Rhythmsub scheduled request.
+
+Tracks the callbacks and attempts of a request in a RhythmsubRequestScheduler.
+Streamed requests also carry the keys to extract and the item callback.
+"""
+class RhythmsubRequest:
+    __slots__ = ("attempts", "complete_cb", "dispatched", "error",
+                 "failure_cb", "item_cb", "keys", "parse_cb", "priority",
+                 "url")
+
+    """
+    Initialiser.
+    """
+    def __init__(self, url, complete_cb, failure_cb, priority, keys=None,
+                 item_cb=None, parse_cb=None):
+        self.url         = url
+        self.complete_cb = complete_cb
+        self.failure_cb  = failure_cb
+        self.priority    = priority
+        self.keys        = keys
+        self.item_cb     = item_cb
+        self.parse_cb    = parse_cb
+
+        self.attempts    = 0
+        self.dispatched  = None
+        self.error       = None
 
-Make asynchronous HTTP requests using Rhythmbox's loader class.
 
-XXX no attempt is made here to rate limit requests. Making a request higher than
-the maximum number of file descriptors that can be held by a process will
-probably crash gvfsd-http.
+"""
+Rhythmbox asynchronous fetcher class.
 
-XXX make it possible to retry requests, maybe with an additional on_failure
-callback. Somehow we'd need to track the number of attempts and pass it to the
-failure callback for more intelligent error handling.
+Make asynchronous HTTP requests using Rhythmbox's loader class. Don't use this
+directly for bulk requests; wrap it in a RhythmsubRequestScheduler instead.
+
+Exactly one of complete_cb and failure_cb is called for every request, so that
+schedulers can keep track of what's in flight. failure_cb is called with the
+error and the number of attempts, which is always one here; retries are the
+scheduler's job.
+
+Responses are decoded, and parsed by parse_cb if specified, on a pool of
+PARSE_THREADS worker threads, so that big responses don't stall the UI; so are
+the chunks of streamed responses, as they arrive. The results are handed back
+to the main loop with idle callbacks; complete_cb, item_cb and failure_cb are
+only ever called on the main loop, so they're free to touch RhythmDB.
+
+Rhythmbox's loaders can't set request headers, so compression is negotiated by
+the transport beneath them; gvfs asks for it and decompresses responses itself.
+Any gzip response which slips through is recognised by its magic number and
+decompressed here. The bytes handed over by the loaders are counted by the
+TransferCounter returned by get_transfer(); since they're usually decompressed
+already, and the loaders don't expose the size on the wire, the counts don't
+show the savings of compression.
 """
 class RhythmboxLoaderAsyncFetcher:
-    def get(url, complete_cb):
+    # Size of the chunks streamed responses are read in
+    CHUNK_SIZE = 65536
+
+    # Number of threads decoding and parsing responses
+    PARSE_THREADS = 2
+
+    # Thread pool decoding and parsing responses, created on first use
+    __parse_pool = None
+
+    # Bytes received and decoded by all requests
+    __transfer = TransferCounter()
+
+    """
+    Make a request.
+
+    complete_cb is called with the decoded response, or with the result of
+    parse_cb, which is called with the decoded response on a worker thread. Both
+    complete_cb and parse_cb may raise a ResponseError to reject the response.
+    """
+    def get(url, complete_cb, failure_cb=None, priority=None, parse_cb=None):
+        def fail(error):
+            if failure_cb is not None:
+                failure_cb(error, 1)
+
+        def deliver(result, error):
+            if error is not None:
+                fail(error)
+                return False
+
+            try:
+                complete_cb(result)
+            except ResponseError as e:
+                fail(e)
+
+            return False
+
+        def parse(resp):
+            try:
+                decoder = ContentDecoder.sniff(resp)
+                data    = decoder.decode(resp) + decoder.flush()
+                RhythmboxLoaderAsyncFetcher.__transfer.add(len(resp),
+                                                           len(data))
+
+                result = json.loads(data.decode("utf-8"))
+                if parse_cb is not None:
+                    result = parse_cb(result)
+            except Exception as e:
+                GLib.idle_add(deliver, None, e)
+            else:
+                GLib.idle_add(deliver, result, None)
+
         def real_complete_cb(resp, loader):
-            data = json.loads(resp.decode("utf-8"))
-            loader.rhythmsub_result = complete_cb(data)
+            # rb.Loader passes None for failed requests
+            if resp is None:
+                fail(IOError("failed to load response"))
+                return
+
+            RhythmboxLoaderAsyncFetcher.get_parse_pool().submit(parse, resp)
 
         loader = rb.Loader()
         loader.get_url(url, real_complete_cb, loader)
 
+    """
+    Get the thread pool responses are decoded and parsed on.
+    """
+    def get_parse_pool():
+        if RhythmboxLoaderAsyncFetcher.__parse_pool is None:
+            RhythmboxLoaderAsyncFetcher.__parse_pool = ThreadPoolExecutor(
+                    RhythmboxLoaderAsyncFetcher.PARSE_THREADS,
+                    thread_name_prefix="rhythmsub-parse")
+
+        return RhythmboxLoaderAsyncFetcher.__parse_pool
+
+    """
+    Get the counter of the bytes transferred by all requests.
+    """
+    def get_transfer():
+        return RhythmboxLoaderAsyncFetcher.__transfer
+
+    """
+    Make a request, parsing the response incrementally as it arrives.
+
+    item_cb is called with each (key, value) pair for the keys; see
+    subsonic.JSONItemStream. complete_cb is then called without arguments.
+
+    The chunks are decoded and parsed on the parse pool, one at a time and in
+    order, and the items each completes are handed back to the main loop.
+    """
+    def get_stream(url, keys, item_cb, complete_cb, failure_cb=None,
+                   priority=None):
+        transfer = RhythmboxLoaderAsyncFetcher.__transfer
+        stream   = JSONItemStream(keys)
+
+        # Chunks waiting to be parsed, and whether a worker is parsing them or
+        # has given up; guarded by the lock
+        chunks = deque()
+        lock   = threading.Lock()
+        parser = {"broken": False, "decoder": None, "running": False}
+
+        # Has the request failed? Only touched on the main loop
+        state = {"failed": False}
+
+        def fail(error, loader):
+            state["failed"] = True
+            loader.cancel()
+
+            if failure_cb is not None:
+                failure_cb(error, 1)
+
+        def deliver(items, error, finished, loader):
+            if state["failed"]:
+                return False
+
+            if error is not None:
+                fail(error, loader)
+                return False
+
+            try:
+                for key, value in items:
+                    item_cb(key, value)
+            except ResponseError as e:
+                fail(e, loader)
+                return False
+            except Exception as e:
+                # Malformed items mustn't leave the request hanging, so that
+                # its slot and the fetches awaiting it are released
+                logger.exception("unable to handle streamed response: %s", e)
+                fail(e, loader)
+                return False
+
+            if finished:
+                complete_cb()
+
+            return False
+
+        def parse(chunk):
+            decoder = parser["decoder"]
+
+            if chunk is None:
+                items = []
+                if decoder is not None:
+                    data = decoder.flush()
+                    transfer.add(0, len(data))
+                    items = stream.feed(data)
+
+                return items + stream.close()
+
+            if decoder is None:
+                decoder = parser["decoder"] = ContentDecoder.sniff(chunk)
+
+            data = decoder.decode(chunk)
+            transfer.add(len(chunk), len(data))
+            return stream.feed(data)
+
+        def drain(loader):
+            while True:
+                with lock:
+                    if not chunks:
+                        parser["running"] = False
+                        return
+
+                    chunk = chunks.popleft()
+                    if parser["broken"]:
+                        continue
+
+                try:
+                    items = parse(chunk)
+                except Exception as e:
+                    if not isinstance(e, ValueError):
+                        logger.exception("unable to parse streamed response: "
+                                         "%s", e)
+
+                    with lock:
+                        parser["broken"] = True
+                    GLib.idle_add(deliver, None, e, False, loader)
+                else:
+                    if items or chunk is None:
+                        GLib.idle_add(deliver, items, None, chunk is None,
+                                      loader)
+
+        def chunk_cb(result, total, loader):
+            if state["failed"]:
+                return
+
+            # rb.ChunkLoader passes exceptions for failed requests
+            if isinstance(result, Exception):
+                fail(result, loader)
+                return
+
+            with lock:
+                chunks.append(result)
+                if parser["running"]:
+                    return
+                parser["running"] = True
+
+            RhythmboxLoaderAsyncFetcher.get_parse_pool().submit(drain, loader)
+
+        loader = rb.ChunkLoader()
+        loader.get_url_chunks(url, RhythmboxLoaderAsyncFetcher.CHUNK_SIZE,
+                              False, chunk_cb, loader)
+
 
 # Not sure why this is necessary for only this object?
 GObject.type_register(RhythmsubSource)
@@ -0,0 +1,1070 @@
+"""
+Rhythmsub audio cache and stream proxy
+
+Caches the songs being played and prefetched on disk, as sparse files which are
+filled in as they're read, and serves them to GStreamer through an HTTP proxy on
+the loopback interface, so that seeking only fetches what hasn't been cached
+yet.
+
+Copyright (c) 2013 Luke Carrier
+Released under the terms of the GPLv3
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from gi.repository import GLib
+import bisect
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import secrets
+import threading
+import urllib.request
+
+from subsonic import ResponseError
+
+logger = logging.getLogger("rhythmsub")
+
+"""
+Rhythmsub byte range map.
+
+Records which ranges of a sparse file have been filled in, as sorted, disjoint
+[start, end) ranges. Adjacent and overlapping ranges are merged as they're
+added.
+"""
+class RhythmsubRangeMap:
+    # Starts and ends of the filled ranges, in order
+    __ends   = None
+    __starts = None
+
+    """
+    Initialiser.
+
+    ranges is an iterable of (start, end) pairs filled already.
+    """
+    def __init__(self, ranges=()):
+        self.__ends   = []
+        self.__starts = []
+
+        for start, end in ranges:
+            self.add(start, end)
+
+    """
+    Mark a range as filled.
+    """
+    def add(self, start, end):
+        if start >= end:
+            return
+
+        # Ranges from the first ending at or after start to the last starting
+        # at or before end touch the new one
+        first = bisect.bisect_left(self.__ends, start)
+        last  = bisect.bisect_right(self.__starts, end)
+        if first < last:
+            start = min(start, self.__starts[first])
+            end   = max(end, self.__ends[last - 1])
+
+        self.__starts[first:last] = [start]
+        self.__ends[first:last]   = [end]
+
+    """
+    Get the end of the filled range containing an offset.
+
+    Returns None if the offset hasn't been filled.
+    """
+    def get_filled_end(self, offset):
+        i = bisect.bisect_right(self.__starts, offset) - 1
+        if i >= 0 and offset < self.__ends[i]:
+            return self.__ends[i]
+
+        return None
+
+    """
+    Get the start of the first filled range after an offset, or None if there
+    isn't one.
+    """
+    def get_next_start(self, offset):
+        i = bisect.bisect_right(self.__starts, offset)
+        if i < len(self.__starts):
+            return self.__starts[i]
+
+        return None
+
+    """
+    Get the number of bytes filled.
+    """
+    def get_size(self):
+        return sum(self.__ends) - sum(self.__starts)
+
+    """
+    Has the whole of a range been filled?
+    """
+    def is_filled(self, start, end):
+        if start >= end:
+            return True
+
+        filled_end = self.get_filled_end(start)
+        return filled_end is not None and filled_end >= end
+
+    """
+    Get the filled ranges, as a list of [start, end] pairs.
+    """
+    def to_list(self):
+        return [[start, end] for start, end in zip(self.__starts, self.__ends)]
+
+
+"""
+Rhythmsub cached file record.
+
+length is None until the server has told us it, and seekable records whether
+the server honours Range requests for the song, or is None until we know.
+"""
+class RhythmsubCachedFile:
+    # Length of the song, in bytes
+    length = None
+
+    # RhythmsubRangeMap of the ranges cached
+    ranges = None
+
+    # Number of readers using the file, which mustn't be evicted while there
+    # are any
+    readers = None
+
+    # Does the server honour Range requests for the song?
+    seekable = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self, length=None, ranges=(), seekable=None):
+        self.length   = length
+        self.ranges   = RhythmsubRangeMap(ranges)
+        self.readers  = 0
+        self.seekable = seekable
+
+    """
+    Has the whole song been cached?
+    """
+    def is_complete(self):
+        return self.length is not None \
+                and self.ranges.is_filled(0, self.length)
+
+
+"""
+Rhythmsub audio cache.
+
+Keeps songs on disk, up to max_size bytes of them, evicting the least recently
+used to make room. Files are named after their cache keys, and their
+modification times record when they were last used, so that the order survives
+between sessions.
+
+Songs are cached as sparse files, filled in range by range as they're played or
+prefetched by RhythmsubAudioReaders. Alongside each incomplete file is a map of
+the ranges which have been filled, so that they survive between sessions too.
+
+Instances are thread safe: songs are read by the stream proxy's threads, and
+prefetched on a pool of PREFETCH_THREADS worker threads.
+"""
+class RhythmsubAudioCache:
+    # Number of threads prefetching songs
+    PREFETCH_THREADS = 2
+
+    # Suffix of the range maps of incomplete files, and of the partial files
+    # left by earlier versions
+    PARTIAL_SUFFIX = ".part"
+    RANGES_SUFFIX  = ".ranges"
+
+    # Directory holding the cached files
+    __directory = None
+
+    # RhythmsubCachedFiles keyed by cache key, least recently used first, and
+    # the total number of bytes cached
+    __files = None
+    __size  = None
+
+    # Guards __files, __prefetching and __size
+    __lock = None
+
+    # Maximum total size of the cached files, in bytes
+    __max_size = None
+
+    # Callbacks awaiting the prefetches in progress, as lists keyed by cache key
+    __prefetching = None
+
+    # Thread pool prefetching songs, created on first use
+    __prefetch_pool = None
+
+    """
+    Initialiser.
+
+    Files left in the directory by previous sessions are picked up.
+    """
+    def __init__(self, directory, max_size):
+        self.__directory = directory
+        self.__max_size  = max_size
+
+        self.__files       = OrderedDict()
+        self.__lock        = threading.Lock()
+        self.__prefetching = {}
+        self.__size        = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.__scan()
+
+    """
+    Mark a range of a file as filled, evicting others to make room for it.
+
+    For RhythmsubAudioReader; the data must have been written already.
+    """
+    def add_range(self, key, start, end):
+        with self.__lock:
+            ranges = self.__files[key].ranges
+            size   = ranges.get_size()
+            ranges.add(start, end)
+            self.__size += ranges.get_size() - size
+
+            self.__evict()
+
+    """
+    Prefetch a song into the cache, unless it's there already.
+
+    stream_url is called with a time offset in seconds to get the URL to fetch
+    the song from; see RhythmsubAudioReader. complete_cb, if specified, is
+    called on the main loop with the path of the cached file, or None if it
+    couldn't be cached. Concurrent prefetches of the same song are merged.
+    """
+    def fetch(self, key, stream_url, complete_cb=None):
+        path = self.get_path(key)
+        if path is not None:
+            if complete_cb is not None:
+                complete_cb(path)
+            return
+
+        with self.__lock:
+            if key in self.__prefetching:
+                if complete_cb is not None:
+                    self.__prefetching[key].append(complete_cb)
+                return
+
+            self.__prefetching[key] = [complete_cb] if complete_cb else []
+
+            if self.__prefetch_pool is None:
+                self.__prefetch_pool = ThreadPoolExecutor(
+                        self.PREFETCH_THREADS,
+                        thread_name_prefix="rhythmsub-prefetch")
+
+        def finish(path):
+            with self.__lock:
+                callbacks = self.__prefetching.pop(key)
+
+            for callback in callbacks:
+                callback(path)
+
+            return False
+
+        def prefetch():
+            logger.debug("prefetching %s", key)
+
+            try:
+                reader = self.open(key, stream_url)
+                try:
+                    for data in reader.read():
+                        pass
+                finally:
+                    reader.close()
+            except (OSError, ValueError, ResponseError) as e:
+                logger.warning("unable to prefetch %s: %s", key, e)
+
+            GLib.idle_add(finish, self.get_path(key))
+
+        self.__prefetch_pool.submit(prefetch)
+
+    """
+    Get the path of a file, cached or not.
+    """
+    def get_file(self, key):
+        return os.path.join(self.__directory, key)
+
+    """
+    Get the length of a song, or None if it isn't known yet.
+    """
+    def get_length(self, key):
+        with self.__lock:
+            return self.__files[key].length
+
+    """
+    Get the end of the cached range of a song containing an offset, or None if
+    the offset isn't cached.
+    """
+    def get_filled_end(self, key, offset):
+        with self.__lock:
+            return self.__files[key].ranges.get_filled_end(offset)
+
+    """
+    Get the start of the first cached range of a song after an offset, or None
+    if there isn't one.
+    """
+    def get_next_start(self, key, offset):
+        with self.__lock:
+            return self.__files[key].ranges.get_next_start(offset)
+
+    """
+    Get the path of a completely cached song, marking it as used.
+
+    Returns None unless the whole song is cached.
+    """
+    def get_path(self, key):
+        with self.__lock:
+            cached = self.__files.get(key)
+            if cached is None or not cached.is_complete():
+                return None
+
+            path = self.get_file(key)
+            try:
+                os.utime(path)
+            except OSError:
+                # Removed behind our back
+                self.__size -= self.__files.pop(key).ranges.get_size()
+                return None
+
+            self.__files.move_to_end(key)
+            return path
+
+    """
+    Does the server honour Range requests for a song?
+
+    Returns None if we don't know yet.
+    """
+    def is_seekable(self, key):
+        with self.__lock:
+            return self.__files[key].seekable
+
+    """
+    Open a song for reading, through the cache.
+
+    Returns a RhythmsubAudioReader, which must be closed once done with. The
+    file isn't evicted while it's open.
+    """
+    def open(self, key, stream_url, duration=None):
+        with self.__lock:
+            cached = self.__files.get(key)
+            if cached is None:
+                cached = self.__files[key] = RhythmsubCachedFile()
+            self.__files.move_to_end(key)
+            cached.readers += 1
+
+        try:
+            return RhythmsubAudioReader(self, key, stream_url, duration)
+        except:
+            self.release(key)
+            raise
+
+    """
+    Release a file opened by a reader, saving its range map.
+
+    For RhythmsubAudioReader.
+    """
+    def release(self, key):
+        with self.__lock:
+            cached = self.__files[key]
+            cached.readers -= 1
+            if cached.readers:
+                return
+
+            ranges_file = self.get_file(key) + self.RANGES_SUFFIX
+            try:
+                if cached.is_complete():
+                    if os.path.exists(ranges_file):
+                        os.remove(ranges_file)
+                else:
+                    with open(ranges_file, "w") as f:
+                        json.dump({
+                            "length":   cached.length,
+                            "ranges":   cached.ranges.to_list(),
+                            "seekable": cached.seekable,
+                        }, f)
+            except OSError as e:
+                logger.warning("unable to save range map of %s: %s", key, e)
+
+            self.__evict()
+
+    """
+    Record what the server told us of a song: its length, if known, and
+    whether it honours Range requests for it.
+
+    A song which turns out shorter than the server said is cut short; other
+    changes of length are ignored.
+    """
+    def set_length(self, key, length, seekable=None):
+        with self.__lock:
+            cached = self.__files[key]
+
+            if cached.length is None \
+                    or (length is not None and length < cached.length
+                        and cached.ranges.is_filled(0, length)):
+                cached.length = length
+            if seekable is not None:
+                cached.seekable = seekable
+
+    """
+    Remove the least recently used files until the cache fits its size.
+
+    Files open for reading are passed over. Must be called with the lock held.
+    """
+    def __evict(self):
+        for key in list(self.__files):
+            if self.__size <= self.__max_size:
+                break
+
+            cached = self.__files[key]
+            if cached.readers:
+                continue
+
+            logger.debug("evicting %s", key)
+            del self.__files[key]
+            self.__size -= cached.ranges.get_size()
+
+            for path in (self.get_file(key),
+                         self.get_file(key) + self.RANGES_SUFFIX):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning("unable to evict %s: %s", key, e)
+
+    """
+    Load the range map of an incomplete file.
+
+    Returns None if it can't be read.
+    """
+    def __load_ranges(self, ranges_file):
+        try:
+            with open(ranges_file) as f:
+                state = json.load(f)
+
+            return RhythmsubCachedFile(state["length"], state["ranges"],
+                                       state["seekable"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("discarding range map %s: %s", ranges_file, e)
+            return None
+
+    """
+    Index the files already in the directory, oldest first.
+    """
+    def __scan(self):
+        files = []
+
+        for entry in os.scandir(self.__directory):
+            if not entry.is_file() or entry.name.endswith(self.RANGES_SUFFIX):
+                continue
+
+            if entry.name.endswith(self.PARTIAL_SUFFIX):
+                os.remove(entry.path)
+                continue
+
+            ranges_file = entry.path + self.RANGES_SUFFIX
+            if os.path.exists(ranges_file):
+                cached = self.__load_ranges(ranges_file)
+                if cached is None:
+                    os.remove(entry.path)
+                    os.remove(ranges_file)
+                    continue
+            else:
+                size = entry.stat().st_size
+                if not size:
+                    os.remove(entry.path)
+                    continue
+                cached = RhythmsubCachedFile(size, [(0, size)], None)
+
+            files.append((entry.stat().st_mtime, entry.name, cached))
+
+        # Range maps whose files have gone
+        for entry in os.scandir(self.__directory):
+            if entry.name.endswith(self.RANGES_SUFFIX) \
+                    and not os.path.exists(entry.path[:-len(self.RANGES_SUFFIX)]):
+                os.remove(entry.path)
+
+        for last_used, key, cached in sorted(files, key=lambda f: f[:2]):
+            self.__files[key] = cached
+            self.__size += cached.ranges.get_size()
+
+        with self.__lock:
+            self.__evict()
+
+
+"""
+Rhythmsub audio reader.
+
+Reads a song through the audio cache: ranges which have been cached are read
+from disk, and the rest fetched from the server with Range requests and cached
+as they pass through.
+
+Servers can't seek within transcoded streams, so ignore Range requests for
+them. Reading such a song from part of the way through asks the server to
+start at the corresponding time offset instead, if the song's duration is
+known; what comes back only approximates the range asked for, so it's passed
+on but not cached. Without a duration, the song is read from the start and the
+bytes before the offset cached on the way.
+
+stream_url is called with a time offset in seconds to get the URL to fetch the
+song from.
+"""
+class RhythmsubAudioReader:
+    # Size of the chunks songs are read in
+    CHUNK_SIZE = 65536
+
+    # Content types of the documents Subsonic reports errors in
+    ERROR_CONTENT_TYPES = ("application/json", "application/xml", "text/xml")
+
+    # Seconds to wait for the server
+    TIMEOUT = 30
+
+    # RhythmsubAudioCache instance, and the song's cache key and file
+    __cache = None
+    __fd    = None
+    __key   = None
+
+    # Duration of the song in seconds, or None if it isn't known
+    __duration = None
+
+    # Function getting the song's stream URL
+    __stream_url = None
+
+    # Response being read from the server, the offset of the next byte it'll
+    # give and whether its bytes are exactly those of the song at the offset
+    __upstream          = None
+    __upstream_exact    = None
+    __upstream_position = None
+
+    """
+    Initialiser.
+
+    Use RhythmsubAudioCache.open() rather than calling this directly.
+    """
+    def __init__(self, cache, key, stream_url, duration=None):
+        self.__cache      = cache
+        self.__key        = key
+        self.__stream_url = stream_url
+        self.__duration   = duration
+
+        self.__fd = os.open(cache.get_file(key), os.O_RDWR | os.O_CREAT, 0o644)
+
+    """
+    Close the reader, and any response being read from the server.
+    """
+    def close(self):
+        self.__close_upstream()
+
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+            self.__cache.release(self.__key)
+
+    """
+    Get the length of the song, asking the server if need be.
+
+    The server is asked for the song from start, where reading is to begin, so
+    that its response can be read on from. Returns None if the server doesn't
+    know either, in which case the song can only be read from the start.
+    """
+    def get_length(self, start=0):
+        length = self.__cache.get_length(self.__key)
+        if length is None:
+            self.__open_upstream(start, None)
+            length = self.__cache.get_length(self.__key)
+
+        return length
+
+    """
+    Read the song from start to end, or to its end if that's None.
+
+    Yields the song's bytes in chunks, reading them from the cache where
+    possible.
+    """
+    def read(self, start=0, end=None):
+        position = start
+
+        while True:
+            length = self.__cache.get_length(self.__key)
+            stop   = length if end is None else end
+            if stop is not None and position >= stop:
+                break
+
+            filled_end = self.__cache.get_filled_end(self.__key, position)
+            if filled_end is not None:
+                size = min(filled_end - position, self.CHUNK_SIZE)
+                if stop is not None:
+                    size = min(size, stop - position)
+
+                data = os.pread(self.__fd, size, position)
+                if len(data) < size:
+                    raise ValueError("cached file %s truncated" %self.__key)
+            else:
+                limit = self.__cache.get_next_start(self.__key, position)
+                if stop is not None and (limit is None or stop < limit):
+                    limit = stop
+
+                if self.__upstream is None \
+                        or self.__upstream_position != position:
+                    self.__open_upstream(position, limit)
+
+                size = self.CHUNK_SIZE
+                if limit is not None:
+                    size = min(size, limit - position)
+
+                data = self.__upstream.read(size)
+                if not data:
+                    self.__finish_upstream(position)
+                    break
+
+                if self.__upstream_exact:
+                    os.pwrite(self.__fd, data, position)
+                    self.__cache.add_range(self.__key, position,
+                                           position + len(data))
+                self.__upstream_position += len(data)
+
+            position += len(data)
+            yield data
+
+    """
+    Close the response being read from the server, if any.
+    """
+    def __close_upstream(self):
+        if self.__upstream is not None:
+            self.__upstream.close()
+            self.__upstream = None
+
+    """
+    Handle the end of the response being read from the server.
+
+    Transcoded songs often turn out shorter than the server estimated; if we
+    read one from the start, we know its real length now.
+    """
+    def __finish_upstream(self, position):
+        exact = self.__upstream_exact
+        self.__close_upstream()
+
+        if exact and position and not self.__cache.is_seekable(self.__key):
+            self.__cache.set_length(self.__key, position)
+
+    """
+    Make a request to the server.
+
+    Raises ResponseError if the server reports an error in place of the song.
+    """
+    def __request(self, url, headers):
+        request  = urllib.request.Request(url, headers=headers)
+        response = urllib.request.urlopen(request, timeout=self.TIMEOUT)
+
+        content_type = response.headers.get_content_type()
+        if content_type in self.ERROR_CONTENT_TYPES:
+            response.close()
+            raise ResponseError("server returned %s in place of audio"
+                                        %content_type)
+
+        return response
+
+    """
+    Ask the server for the song from start to end (or its end if None).
+    """
+    def __open_upstream(self, start, end):
+        seekable = self.__cache.is_seekable(self.__key)
+
+        # Read on through a response which can't be resumed elsewhere
+        if self.__upstream is not None and self.__upstream_exact \
+                and seekable is False and self.__upstream_position <= start:
+            self.__skip_upstream(start)
+            return
+
+        self.__close_upstream()
+
+        length = self.__cache.get_length(self.__key)
+        if seekable is False and start and self.__duration and length:
+            self.__open_time_offset(start, length)
+            return
+
+        response = self.__request(self.__stream_url(0), {
+            "Range": "bytes=%d-%s" %(start, "" if end is None else end - 1),
+        })
+
+        if response.status == 206:
+            content_range = response.headers.get("Content-Range", "")
+            try:
+                length = int(content_range.rsplit("/", 1)[1])
+            except (IndexError, ValueError):
+                length = None
+            self.__cache.set_length(self.__key, length, True)
+
+            self.__upstream          = response
+            self.__upstream_exact    = True
+            self.__upstream_position = start
+            return
+
+        # The server ignored the range, and sent the song from the start
+        length = response.headers.get("Content-Length")
+        self.__cache.set_length(self.__key,
+                                int(length) if length else None, False)
+
+        self.__upstream          = response
+        self.__upstream_exact    = True
+        self.__upstream_position = 0
+
+        length = self.__cache.get_length(self.__key)
+        if start and self.__duration and length:
+            self.__close_upstream()
+            self.__open_time_offset(start, length)
+        else:
+            self.__skip_upstream(start)
+
+    """
+    Read on through the response being read from the server to start, caching
+    the bytes on the way.
+    """
+    def __skip_upstream(self, start):
+        while self.__upstream_position < start:
+            position = self.__upstream_position
+
+            data = self.__upstream.read(min(self.CHUNK_SIZE, start - position))
+            if not data:
+                self.__finish_upstream(position)
+                raise ValueError("song %s ended before offset %d"
+                                         %(self.__key, start))
+
+            os.pwrite(self.__fd, data, position)
+            self.__cache.add_range(self.__key, position, position + len(data))
+            self.__upstream_position += len(data)
+
+    """
+    Ask the server for the song from the time offset corresponding to start.
+    """
+    def __open_time_offset(self, start, length):
+        time_offset = start * self.__duration // length
+
+        self.__upstream          = self.__request(
+                self.__stream_url(time_offset), {})
+        self.__upstream_exact    = False
+        self.__upstream_position = start
+
+
+"""
+Rhythmsub stream proxy.
+
+Serves songs over HTTP on the loopback interface, through the audio cache, so
+that GStreamer's seeks read the ranges already cached from disk and only the
+rest is fetched from the server. Songs are served at /<token>/<cache key> once
+they've been added with add(), on threads of their own. The token is random,
+so that other local users can't guess the URLs, and only the MAX_STREAMS songs
+added most recently are served.
+"""
+class RhythmsubStreamProxy(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # Number of songs served at once
+    MAX_STREAMS = 16
+
+    # RhythmsubAudioCache instance
+    cache = None
+
+    # Guards __streams
+    __lock = None
+
+    # Songs being served, as (stream URL function, duration) pairs keyed by
+    # cache key, least recently added first
+    __streams = None
+
+    # Random prefix of the paths songs are served at
+    __token = None
+
+    """
+    Initialiser.
+
+    Starts serving straight away, on a port of the system's choosing.
+    """
+    def __init__(self, cache):
+        super(RhythmsubStreamProxy, self).__init__(
+                ("127.0.0.1", 0), RhythmsubStreamProxyHandler)
+
+        self.cache = cache
+
+        self.__lock    = threading.Lock()
+        self.__streams = OrderedDict()
+        self.__token   = secrets.token_urlsafe(16)
+
+        threading.Thread(target=self.serve_forever, name="rhythmsub-proxy",
+                         daemon=True).start()
+
+    """
+    Serve a song, forgetting the least recently added if there are too many.
+
+    Returns the URL it's served at.
+    """
+    def add(self, key, stream_url, duration=None):
+        with self.__lock:
+            self.__streams[key] = (stream_url, duration)
+            self.__streams.move_to_end(key)
+
+            while len(self.__streams) > self.MAX_STREAMS:
+                self.__streams.popitem(False)
+
+        return "http://127.0.0.1:%d/%s/%s" %(self.server_address[1],
+                                             self.__token, key)
+
+    """
+    Stop serving.
+    """
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+    """
+    Get a song being served, as a (stream URL function, duration) pair.
+
+    Returns None if the token is wrong or the song isn't being served.
+    """
+    def get_stream(self, token, key):
+        if not secrets.compare_digest(token, self.__token):
+            return None
+
+        with self.__lock:
+            return self.__streams.get(key)
+
+
+"""
+Rhythmsub stream proxy request handler.
+
+Honours single Range requests, so that GStreamer can seek.
+"""
+class RhythmsubStreamProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    """
+    Serve a song.
+    """
+    def do_GET(self):
+        token, _, key = self.path.lstrip("/").partition("/")
+        stream        = self.server.get_stream(token, key)
+        if stream is None:
+            self.send_error(404)
+            return
+
+        stream_url, duration = stream
+        try:
+            reader = self.server.cache.open(key, stream_url, duration)
+        except OSError as e:
+            logger.warning("unable to cache %s: %s", key, e)
+            self.send_error(500)
+            return
+
+        try:
+            self.__serve(key, reader)
+        except (BrokenPipeError, ConnectionResetError):
+            # GStreamer hangs up when it seeks
+            self.close_connection = True
+        except (OSError, ValueError, ResponseError) as e:
+            logger.warning("unable to stream %s: %s", key, e)
+            self.close_connection = True
+        finally:
+            reader.close()
+
+    """
+    Log requests at debug level.
+    """
+    def log_message(self, format, *args):
+        logger.debug("proxy: " + format, *args)
+
+    """
+    Parse the Range header, if any.
+
+    Returns the positions of the first and last bytes requested, either of
+    which may be None, or None for a missing or unsupported header. A missing
+    first position makes the last the length of a suffix.
+    """
+    def __parse_range(self):
+        match = re.match(r"bytes=(\d*)-(\d*)$",
+                         self.headers.get("Range", "").strip())
+        if not match or not any(match.groups()):
+            return None
+
+        return tuple(int(position) if position else None
+                     for position in match.groups())
+
+    """
+    Send the headers for, then the body of, the requested range of a song.
+    """
+    def __serve(self, key, reader):
+        requested   = self.__parse_range()
+        first, last = requested or (0, None)
+
+        try:
+            length = reader.get_length(first or 0)
+        except (OSError, ResponseError) as e:
+            logger.warning("unable to stream %s: %s", key, e)
+            self.send_error(502)
+            return
+
+        if length is None:
+            # Serve the whole song, ending the response by closing the
+            # connection
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            start, end = 0, None
+        else:
+            if first is None:
+                start, end = max(0, length - last), length
+            elif last is None:
+                start, end = first, length
+            else:
+                start, end = first, min(last + 1, length)
+
+            if requested is not None and start >= length:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" %length)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            if requested is None:
+                self.send_response(200)
+            else:
+                self.send_response(206)
+                self.send_header("Content-Range",
+                                 "bytes %d-%d/%d" %(start, end - 1, length))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start))
+            self.end_headers()
+
+        for data in reader.read(start, end):
+            self.wfile.write(data)
+
+
+"""
+Rhythmsub stream resolver.
+
+Maps the locations of our entries to URIs Rhythmbox can play: the cached copy
+of a song if the whole of it is cached, otherwise the stream proxy's URL for
+it, through which it's cached as it plays. Without a cache, songs are streamed
+straight from the server. Songs are streamed at up to max_bit_rate Kbps in
+format, transcoded by the server if need be; see
+subsonic.Server.get_stream_url().
+
+The songs due to play next can be prefetched into the cache, so that they start
+straight away and follow on gaplessly, however slow the link.
+"""
+class RhythmsubStreamResolver:
+    # RhythmsubAudioCache instance, or None if songs aren't cached, and the
+    # RhythmsubStreamProxy serving songs through it
+    __cache = None
+    __proxy = None
+
+    # Prefix of the locations of the server's entries
+    __location_prefix = None
+
+    # Transcoding options
+    __format       = None
+    __max_bit_rate = None
+
+    # The Subsonic server instance
+    __server = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self, server, cache=None, max_bit_rate=0, format=None):
+        self.__server       = server
+        self.__cache        = cache
+        self.__max_bit_rate = max_bit_rate
+        self.__format       = format
+
+        self.__location_prefix = "rhythmsub://%s/" %server.get_address()
+
+        if cache is not None:
+            self.__proxy = RhythmsubStreamProxy(cache)
+
+    """
+    Stop serving songs through the proxy.
+    """
+    def close(self):
+        if self.__proxy is not None:
+            self.__proxy.close()
+            self.__proxy = None
+
+    """
+    Get the ID of the song at a location.
+
+    Returns None for locations which aren't songs on the server, such as lazy
+    browsing's artist placeholders.
+    """
+    def get_song_id(self, location):
+        if not location.startswith(self.__location_prefix):
+            return None
+
+        # Songs are at [<music folder ID>/]<ID>, and placeholders at
+        # [<music folder ID>/]artist/<ID>
+        segments = location[len(self.__location_prefix):].split("/")
+        if len(segments) > 2 or segments[-2:-1] == ["artist"] \
+                or not segments[-1]:
+            return None
+
+        return segments[-1]
+
+    """
+    Prefetch the songs at the specified locations into the cache.
+    """
+    def prefetch(self, locations):
+        if self.__cache is None:
+            return
+
+        for location in locations:
+            song_id = self.get_song_id(location)
+            if song_id is not None:
+                self.__cache.fetch(self.__get_key(song_id),
+                                   functools.partial(self.__get_url, song_id))
+
+    """
+    Get the URI to play the song at a location from.
+
+    duration, in seconds, lets the proxy seek within transcoded songs. Returns
+    None if the location isn't a song.
+    """
+    def resolve(self, location, duration=None):
+        song_id = self.get_song_id(location)
+        if song_id is None:
+            return None
+
+        if self.__proxy is not None:
+            key  = self.__get_key(song_id)
+            path = self.__cache.get_path(key)
+            if path is not None:
+                return GLib.filename_to_uri(path, None)
+
+            return self.__proxy.add(key,
+                                    functools.partial(self.__get_url, song_id),
+                                    duration)
+
+        return self.__get_url(song_id)
+
+    """
+    Get the cache key of a song.
+
+    Copies transcoded differently are cached separately.
+    """
+    def __get_key(self, song_id):
+        key = "%s|%s|%d|%s" %(self.__server.get_address(), song_id,
+                              self.__max_bit_rate, self.__format or "")
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    """
+    Get the stream URL of a song, from a time offset in seconds.
+    """
+    def __get_url(self, song_id, time_offset=0):
+        return self.__server.get_stream_url(song_id, self.__max_bit_rate,
+                                            self.__format, time_offset)
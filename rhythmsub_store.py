@@ -0,0 +1,257 @@
+"""
+Rhythmsub local state store
+
+Persists library synchronisation state between Rhythmbox sessions in a small
+SQLite database, so that later synchronisations only need to fetch what has
+changed on the server.
+
+Copyright (c) 2013 Luke Carrier
+Released under the terms of the GPLv3
+"""
+
+import json
+import os
+import sqlite3
+
+"""
+Rhythmsub state store.
+
+All state is keyed by the address of the Subsonic server it was retrieved from,
+so that switching between servers doesn't mix up their libraries.
+"""
+class RhythmsubStore:
+    # Table definitions, applied on every open
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS sync_state (
+            address       TEXT PRIMARY KEY,
+            last_modified INTEGER
+        )""",
+        """CREATE TABLE IF NOT EXISTS artists (
+            address TEXT NOT NULL,
+            id      TEXT NOT NULL,
+            name    TEXT,
+            PRIMARY KEY (address, id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS directories (
+            address  TEXT NOT NULL,
+            id       TEXT NOT NULL,
+            marker   TEXT NOT NULL,
+            children TEXT NOT NULL,
+            PRIMARY KEY (address, id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS checkpoints (
+            address       TEXT PRIMARY KEY,
+            session       TEXT NOT NULL,
+            last_modified INTEGER,
+            full          INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS music_folders (
+            address TEXT PRIMARY KEY,
+            folders TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS songs (
+            address  TEXT NOT NULL,
+            location TEXT NOT NULL,
+            song     TEXT NOT NULL,
+            PRIMARY KEY (address, location)
+        )""",
+    )
+
+    # SQLite connection
+    __conn = None
+
+    """
+    Initialiser.
+
+    Opens (creating if necessary) the database at the specified path.
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.__conn = sqlite3.connect(path)
+        self.__conn.execute("PRAGMA journal_mode = WAL")
+        self.__conn.execute("PRAGMA synchronous = NORMAL")
+        for statement in self.SCHEMA:
+            self.__conn.execute(statement)
+        self.__conn.commit()
+
+    """
+    Close the database.
+    """
+    def close(self):
+        self.__conn.close()
+        self.__conn = None
+
+    """
+    Forget the checkpoint of an unfinished synchronisation.
+
+    Directories cached with its session ID as their marker are only meaningful
+    to the synchronisation, and are forgotten along with it.
+    """
+    def clear_checkpoint(self, address):
+        with self.__conn:
+            self.__conn.execute(
+                    "DELETE FROM directories WHERE marker IN (SELECT session FROM checkpoints WHERE address = ?)",
+                    (address,))
+            self.__conn.execute("DELETE FROM checkpoints WHERE address = ?",
+                                (address,))
+
+    """
+    Forget the snapshot of the songs synchronised.
+    """
+    def clear_songs(self, address):
+        with self.__conn:
+            self.__conn.execute("DELETE FROM songs WHERE address = ?",
+                                (address,))
+
+    """
+    Remove songs from the snapshot, by location.
+    """
+    def delete_songs(self, address, locations):
+        with self.__conn:
+            self.__conn.executemany(
+                    "DELETE FROM songs WHERE address = ? AND location = ?",
+                    ((address, location) for location in locations))
+
+    """
+    Get the artists seen by the last complete synchronisation.
+
+    Returns a dictionary of artist names, keyed by their IDs as strings.
+    """
+    def get_artists(self, address):
+        rows = self.__conn.execute(
+                "SELECT id, name FROM artists WHERE address = ?", (address,))
+
+        return dict(rows)
+
+    """
+    Get the checkpoint of an unfinished synchronisation.
+
+    Returns a tuple of its session ID, the index modification time it was
+    working from (or None if unknown) and whether it was a full one, or None if
+    there isn't one.
+    """
+    def get_checkpoint(self, address):
+        row = self.__conn.execute(
+                "SELECT session, last_modified, full FROM checkpoints WHERE address = ?",
+                (address,)).fetchone()
+
+        return (row[0], row[1], bool(row[2])) if row else None
+
+    """
+    Get the cached children of a directory.
+
+    Returns None unless the directory is cached with the specified change
+    marker.
+    """
+    def get_directory(self, address, id, marker):
+        row = self.__conn.execute(
+                "SELECT children FROM directories WHERE address = ? AND id = ? AND marker = ?",
+                (address, str(id), marker)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    """
+    Get the music folders seen by the last synchronisation.
+
+    Returns a list of (ID, name) pairs, or None if the server hasn't been
+    synchronised.
+    """
+    def get_music_folders(self, address):
+        row = self.__conn.execute(
+                "SELECT folders FROM music_folders WHERE address = ?",
+                (address,)).fetchone()
+
+        return [tuple(folder) for folder in json.loads(row[0])] if row else None
+
+    """
+    Get a page of the snapshot of the songs synchronised.
+
+    Returns a list of up to limit (location, song) pairs, ordered by location,
+    starting after the specified location. Pass the last location of each page
+    to get the next.
+    """
+    def get_songs(self, address, after="", limit=1000):
+        rows = self.__conn.execute(
+                "SELECT location, song FROM songs WHERE address = ? AND location > ? ORDER BY location LIMIT ?",
+                (address, after, limit))
+
+        return [(location, json.loads(song)) for location, song in rows]
+
+    """
+    Get the server's index modification time as of the last complete
+    synchronisation, or None if there hasn't been one.
+    """
+    def get_last_modified(self, address):
+        row = self.__conn.execute(
+                "SELECT last_modified FROM sync_state WHERE address = ?",
+                (address,)).fetchone()
+
+        return row[0] if row else None
+
+    """
+    Record the artists in the server's index.
+
+    artists is an iterable of (id, name) pairs. Replaces the existing set of
+    artists for the server.
+    """
+    def set_artists(self, address, artists):
+        with self.__conn:
+            self.__conn.execute("DELETE FROM artists WHERE address = ?",
+                                (address,))
+            self.__conn.executemany(
+                    "INSERT OR REPLACE INTO artists (address, id, name) VALUES (?, ?, ?)",
+                    ((address, str(id), name) for id, name in artists))
+
+    """
+    Record the checkpoint of a synchronisation in progress.
+    """
+    def set_checkpoint(self, address, session, last_modified, full):
+        with self.__conn:
+            self.__conn.execute(
+                    "INSERT OR REPLACE INTO checkpoints (address, session, last_modified, full) VALUES (?, ?, ?, ?)",
+                    (address, session, last_modified, int(full)))
+
+    """
+    Record the music folders seen by a synchronisation.
+    """
+    def set_music_folders(self, address, folders):
+        with self.__conn:
+            self.__conn.execute(
+                    "INSERT OR REPLACE INTO music_folders (address, folders) VALUES (?, ?)",
+                    (address, json.dumps(folders, separators=(",", ":"))))
+
+    """
+    Add songs to the snapshot, or replace them.
+
+    songs is an iterable of (location, song) pairs.
+    """
+    def set_songs(self, address, songs):
+        with self.__conn:
+            self.__conn.executemany(
+                    "INSERT OR REPLACE INTO songs (address, location, song) VALUES (?, ?, ?)",
+                    ((address, location, json.dumps(song, separators=(",", ":")))
+                     for location, song in songs))
+
+    """
+    Cache the children of a directory along with its change marker.
+    """
+    def set_directory(self, address, id, marker, children):
+        with self.__conn:
+            self.__conn.execute(
+                    "INSERT OR REPLACE INTO directories (address, id, marker, children) VALUES (?, ?, ?, ?)",
+                    (address, str(id), marker,
+                     json.dumps(children, separators=(",", ":"))))
+
+    """
+    Record the server's index modification time.
+
+    Pass None to forget it, forcing the next synchronisation to be a full one.
+    """
+    def set_last_modified(self, address, last_modified):
+        with self.__conn:
+            self.__conn.execute(
+                    "INSERT OR REPLACE INTO sync_state (address, last_modified) VALUES (?, ?)",
+                    (address, last_modified))
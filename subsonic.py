@@ -8,199 +8,1896 @@ Copyright (c) 2013 Luke Carrier
 Released under the terms of the GPLv3
 """
 
+import asyncio
+import codecs
+import collections
 import datetime
+import http.client
 import json
+import re
+import threading
+import time
+import urllib.error
 import urllib.parse
 import urllib.request
+import zlib
+
+"""
+Normalise a repeated element of a response to a list.
+
+Depending on the server, elements which only occur once may be represented by a
+bare object rather than a single-item list, and empty ones may be missing.
+"""
+def as_list(value):
+    if value is None:
+        return []
+    elif isinstance(value, dict):
+        return [value,]
+
+    return value
+
+
+"""
+Parse a timestamp from a response.
+
+Subsonic uses ISO 8601 timestamps, optionally with milliseconds and a "Z" UTC
+designator. Timestamps without a designator are in the server's local time,
+which we have no way of knowing, so they're treated as UTC.
+"""
+def parse_datetime(value):
+    value = value.rstrip("Z").split(".")[0]
+    timestamp = datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+    return timestamp.replace(tzinfo=datetime.timezone.utc)
+
 
 """
 Subsonic client class.
 
-Instances of this class represent Subsonic server instances.
+Instances of this class represent Subsonic server instances.
+"""
+class Server:
+    API_URL_FORMAT = "%s/rest/%s.view?%s"
+
+    # Methods whose responses are never cached
+    UNCACHED_METHODS = ("getIndexes", "ping")
+
+    # Keys extracted from streamed responses; see JSONItemStream. They're
+    # qualified so that songs alongside the index, which have artist names,
+    # aren't mistaken for index artists
+    ERROR_KEY    = "subsonic-response.error"
+    INDEXES_KEYS = ("index.artist", "indexes.lastModified")
+
+    __address       = None
+    __username      = None
+    __password      = None
+    __client_name   = None
+    __fetcher         = None
+    __async_fetcher   = None
+    __asyncio_fetcher = None
+
+    # Recently parsed responses as (expiry time, response), keyed by request,
+    # least recently used first; the maximum number of them and their lifetime
+    # in seconds
+    __cache      = None
+    __cache_size = None
+    __cache_ttl  = None
+
+    # URL-encoded parameters common to every request
+    __credentials = None
+
+    # Callbacks of asynchronous requests which failed for good, as lists of
+    # (complete_cb, failure_cb) pairs keyed by request
+    __failed = None
+
+    # Modification time of each music folder's index when we last saw it,
+    # keyed by music folder ID (None for the whole library)
+    __last_modified = None
+
+    # Callbacks awaiting asynchronous requests in flight, as lists of
+    # (complete_cb, failure_cb) pairs keyed by request
+    __waiting = None
+
+    """
+    Get an instance with the designated address, username and password.
+
+    The fetcher makes blocking requests; pass an HTTPConnectionPoolFetcher
+    instance to reuse connections between requests. The asyncio_fetcher makes
+    the requests of the coroutine (_aio) methods, and defaults to an
+    AsyncioStreamFetcher.
+
+    Up to cache_size parsed responses are kept for cache_ttl seconds and reused
+    by identical requests; pass a cache_size of 0 to disable this. Responses
+    are shared between callers, so mustn't be modified.
+    """
+    def __init__(self, address, username, password, client_name, fetcher=None,
+                 async_fetcher=None, cache_size=256, cache_ttl=60,
+                 asyncio_fetcher=None):
+        self.__address     = address
+        self.__username    = username
+        self.__password    = password
+        self.__client_name = client_name
+
+        if fetcher is None:
+            fetcher = UrllibRequestFetcher
+        self.__fetcher = fetcher
+
+        self.__async_fetcher = async_fetcher
+
+        if asyncio_fetcher is None:
+            asyncio_fetcher = AsyncioStreamFetcher()
+        self.__asyncio_fetcher = asyncio_fetcher
+
+        self.__cache         = collections.OrderedDict()
+        self.__cache_size    = cache_size
+        self.__cache_ttl     = cache_ttl
+        self.__failed        = {}
+        self.__last_modified = {}
+        self.__waiting       = {}
+
+        self.__credentials = urllib.parse.urlencode((
+            ("c", client_name),
+            ("f", "json"),
+            ("v", "1.10.1"),
+            ("u", username),
+            ("p", password),
+        ))
+
+    """
+    Perform a request to the API.
+
+    Guess the URL within the API based on our format string, the specified
+    address and the name of the method called; make a request to that URL and
+    return an instance of response_class representing the decoded JSON
+    response string.
+    """
+    def __get(self, method, response_class, params=None):
+        key    = self.__key(method, params)
+        parsed = self.__cache_get(key)
+
+        if parsed is None:
+            parsed = response_class(self.__fetcher.get(self.__url(key)))
+            self.__cache_put(key, parsed)
+
+        return parsed
+
+    """
+    Perform a request to the API asynchronously.
+
+    Behaviour is identical to __get(), but we instead use the __async_fetcher to
+    retreive the URL and call the specified complete_cb with the parsed response
+    upon its retreival. Cached responses are passed to complete_cb straight
+    away. Fetchers may decode and parse responses on another thread, but always
+    call complete_cb on the main loop.
+
+    The priority is a hint for fetchers which schedule their requests; lower
+    values are fetched first. failure_cb, if specified, is called with the
+    error and the number of attempts made if the request can't be completed.
+
+    Identical requests made while one is in flight share its response, or its
+    failure. complete_cb may raise a ResponseError to reject a response;
+    fetchers treat this in the same way as a failed request, and the retry is
+    delivered only to the callbacks which rejected it.
+
+    The callbacks of a request which failed for good, and which the fetcher
+    may resubmit later, are taken over by the next identical request instead,
+    so that they're called once and the fetcher doesn't give up on two copies
+    of the same request.
+    """
+    def __get_async(self, method, response_class, complete_cb, params=None,
+                    priority=0, failure_cb=None):
+        key    = self.__key(method, params)
+        parsed = self.__cache_get(key)
+
+        if parsed is not None:
+            complete_cb(parsed)
+            return
+
+        waiters = self.__waiting.get(key)
+        if waiters is not None:
+            waiters.append((complete_cb, failure_cb))
+            return
+
+        failed  = self.__failed.pop(key, [])
+        waiters = self.__waiting[key] = failed + [(complete_cb, failure_cb)]
+        del failed[:]
+
+        def real_complete_cb(parsed):
+            if self.__waiting.get(key) is waiters:
+                del self.__waiting[key]
+            if self.__failed.get(key) is waiters:
+                del self.__failed[key]
+            self.__cache_put(key, parsed)
+
+            delivered = list(waiters)
+            del waiters[:]
+
+            error = None
+            for waiter in delivered:
+                try:
+                    waiter[0](parsed)
+                except ResponseError as e:
+                    waiters.append(waiter)
+                    error = error or e
+
+            if error is not None:
+                self.__waiting.setdefault(key, waiters)
+                raise error
+
+        def real_failure_cb(error, attempts):
+            if self.__waiting.get(key) is waiters:
+                del self.__waiting[key]
+
+            # Requests which aren't handled by every waiter are kept by the
+            # fetcher, to be delivered to the rest if they're retried
+            delivered = list(waiters)
+            del waiters[:]
+
+            for waiter in delivered:
+                if waiter[1] is None or not waiter[1](error, attempts):
+                    waiters.append(waiter)
+
+            if waiters:
+                self.__failed[key] = waiters
+            elif self.__failed.get(key) is waiters:
+                del self.__failed[key]
+
+            return not waiters
+
+        self.__async_fetcher.get(self.__url(key), real_complete_cb,
+                                 failure_cb=real_failure_cb, priority=priority,
+                                 parse_cb=lambda resp: self.__parse(
+                                         response_class, resp))
+
+    """
+    Perform a request to the API with asyncio.
+
+    Behaviour is identical to __get(), but the request is made with the
+    __asyncio_fetcher, and unsuccessful or malformed responses raise a
+    ResponseError.
+    """
+    async def __get_aio(self, method, response_class, params=None):
+        key    = self.__key(method, params)
+        parsed = self.__cache_get(key)
+
+        if parsed is None:
+            resp   = await self.__asyncio_fetcher.get(self.__url(key))
+            parsed = self.__parse(response_class, resp)
+            self.__cache_put(key, parsed)
+
+        return parsed
+
+    """
+    Get a cached response, if it hasn't expired.
+    """
+    def __cache_get(self, key):
+        try:
+            expires, parsed = self.__cache[key]
+        except KeyError:
+            return None
+
+        if expires <= time.monotonic():
+            del self.__cache[key]
+            return None
+
+        self.__cache.move_to_end(key)
+        return parsed
+
+    """
+    Cache a response, evicting the least recently used ones beyond the limit.
+    """
+    def __cache_put(self, key, parsed):
+        if self.__cache_size <= 0 or key[0] in self.UNCACHED_METHODS:
+            return
+
+        self.__cache[key] = (time.monotonic() + self.__cache_ttl, parsed)
+        self.__cache.move_to_end(key)
+
+        while len(self.__cache) > self.__cache_size:
+            self.__cache.popitem(last=False)
+
+    """
+    Note the modification time of a music folder's index.
+
+    Cached responses predating a change to the library are forgotten.
+    """
+    def __index_seen(self, music_folder_id, last_modified):
+        previous = self.__last_modified.get(music_folder_id)
+        if previous is not None and last_modified != previous:
+            self.clear_cache()
+        self.__last_modified[music_folder_id] = last_modified
+
+    """
+    Identify a request by its method and parameters.
+    """
+    def __key(self, method, params):
+        if params:
+            return method, urllib.parse.urlencode(params)
+
+        return method, ""
+
+    """
+    Perform a request to the API, parsing the response incrementally.
+
+    Yields (key, value) pairs for the specified keys as they arrive; see
+    JSONItemStream. Raises a ResponseError if the server reports an error.
+    """
+    def __stream(self, method, keys, params=None):
+        stream = JSONItemStream(set(keys) | {self.ERROR_KEY})
+        url    = self.__url(self.__key(method, params))
+
+        def check(items):
+            for key, value in items:
+                if key == self.ERROR_KEY:
+                    raise ResponseError(value.get("message", "request failed"),
+                                        value.get("code"))
+                yield key, value
+
+        for chunk in self.__fetcher.get_chunks(url):
+            yield from check(stream.feed(chunk))
+        yield from check(stream.close())
+
+    """
+    Perform a request to the API asynchronously, parsing the response
+    incrementally.
+
+    item_cb is called with each (key, value) pair for the specified keys as
+    they arrive, then complete_cb is called with no arguments.
+    """
+    def __stream_async(self, method, item_cb, complete_cb, keys, params=None,
+                       priority=0, failure_cb=None):
+        def real_item_cb(key, value):
+            if key == self.ERROR_KEY:
+                raise ResponseError(value.get("message", "request failed"),
+                                    value.get("code"))
+            item_cb(key, value)
+
+        return self.__async_fetcher.get_stream(self.__url(self.__key(method,
+                                                                     params)),
+                                               set(keys) | {self.ERROR_KEY},
+                                               real_item_cb, complete_cb,
+                                               failure_cb=failure_cb,
+                                               priority=priority)
+
+    """
+    Parse a decoded response with a response class.
+
+    Unsuccessful or malformed responses are rejected with a ResponseError so
+    that the fetcher can retry them. Safe to call from any thread.
+    """
+    def __parse(self, response_class, resp):
+        try:
+            status = resp["subsonic-response"]["status"]
+        except (KeyError, TypeError):
+            raise ResponseError("malformed response")
+
+        if status != "ok":
+            error = resp["subsonic-response"].get("error", {})
+            raise ResponseError(error.get("message", "request failed"),
+                                error.get("code"))
+
+        try:
+            return response_class(resp)
+        except (KeyError, TypeError) as e:
+            raise ResponseError("malformed response: missing %s" %e)
+
+    """
+    Guess the URL of a request from its key.
+
+    urllib requires that we also handle parameters here, so we'll also append
+    method-specific parameters to the credentials required for all methods
+    (to facilitate authentication, client identification and API versioning).
+    """
+    def __url(self, key):
+        method, query = key
+
+        if query:
+            query = "%s&%s" %(self.__credentials, query)
+        else:
+            query = self.__credentials
+
+        return self.API_URL_FORMAT %(self.__address, method, query)
+
+    """
+    Forget all cached responses.
+
+    Call this before synchronising everything afresh. Fetching the index
+    does this automatically if the library has changed since it was last
+    fetched.
+    """
+    def clear_cache(self):
+        self.__cache.clear()
+
+    """
+    Get the server's address.
+    """
+    def get_address(self):
+        return self.__address
+
+    """
+    Get indexed structure of all artists.
+
+    http://www.subsonic.org/pages/api.jsp#getIndexes
+    """
+    def get_indexes(self, music_folder_id=None, if_modified_since=None):
+        params = self.get_indexes_params(music_folder_id, if_modified_since)
+        parsed = self.__get("getIndexes", GetIndexesResponse, params)
+
+        self.__index_seen(music_folder_id, parsed.last_modified)
+        return parsed
+
+    """
+    Get indexed structure of all artists asynchronously.
+    """
+    def get_indexes_async(self, complete_cb, music_folder_id=None,
+                          if_modified_since=None, priority=0, failure_cb=None):
+        def real_complete_cb(parsed):
+            self.__index_seen(music_folder_id, parsed.last_modified)
+            complete_cb(parsed)
+
+        params = self.get_indexes_params(music_folder_id, if_modified_since)
+        self.__get_async("getIndexes", GetIndexesResponse, real_complete_cb,
+                         params, priority, failure_cb)
+
+    """
+    Get indexed structure of all artists with asyncio.
+    """
+    async def get_indexes_aio(self, music_folder_id=None,
+                              if_modified_since=None):
+        params = self.get_indexes_params(music_folder_id, if_modified_since)
+        parsed = await self.__get_aio("getIndexes", GetIndexesResponse, params)
+
+        self.__index_seen(music_folder_id, parsed.last_modified)
+        return parsed
+
+    """
+    Get indexed structure of all artists, incrementally.
+
+    Yields each artist as it arrives, without holding the whole response in
+    memory. Nothing is yielded if the index hasn't been modified since
+    if_modified_since.
+    """
+    def iter_indexes(self, music_folder_id=None, if_modified_since=None):
+        params = self.get_indexes_params(music_folder_id, if_modified_since)
+
+        for key, value in self.__stream("getIndexes", self.INDEXES_KEYS,
+                                        params):
+            if key == "indexes.lastModified":
+                self.__index_seen(music_folder_id, value)
+            else:
+                yield value
+
+    """
+    Get indexed structure of all artists asynchronously and incrementally.
+
+    artist_cb is called with each artist as it arrives, then complete_cb is
+    called with the index's modification time.
+    """
+    def get_indexes_stream_async(self, artist_cb, complete_cb,
+                                 music_folder_id=None, if_modified_since=None,
+                                 priority=0, failure_cb=None):
+        state = {"last_modified": None}
+
+        def item_cb(key, value):
+            if key == "indexes.lastModified":
+                state["last_modified"] = value
+                self.__index_seen(music_folder_id, value)
+            else:
+                artist_cb(value)
+
+        params = self.get_indexes_params(music_folder_id, if_modified_since)
+        self.__stream_async("getIndexes", item_cb,
+                            lambda: complete_cb(state["last_modified"]),
+                            self.INDEXES_KEYS, params, priority, failure_cb)
+
+    """
+    Normalise parameters for the getIndexes method.
+    """
+    def get_indexes_params(self, music_folder_id, if_modified_since):
+        params = {}
+
+        if music_folder_id is not None:
+            params["musicFolderId"] = music_folder_id
+
+        if if_modified_since is not None:
+            params["ifModifiedSince"] = if_modified_since
+
+        return params
+
+    """
+    Get a list of albums.
+
+    The type is one of the orderings supported by the server, e.g. "newest" or
+    "alphabeticalByName". Servers return at most 500 albums per request.
+
+    http://www.subsonic.org/pages/api.jsp#getAlbumList
+    """
+    def get_album_list(self, type, size=10, offset=0, music_folder_id=None):
+        params = self.get_album_list_params(type, size, offset,
+                                            music_folder_id)
+        return self.__get("getAlbumList", GetAlbumListResponse, params)
+
+    """
+    Get a list of albums asynchronously.
+    """
+    def get_album_list_async(self, complete_cb, type, size=10, offset=0,
+                             music_folder_id=None, priority=0,
+                             failure_cb=None):
+        params = self.get_album_list_params(type, size, offset,
+                                            music_folder_id)
+        self.__get_async("getAlbumList", GetAlbumListResponse, complete_cb,
+                         params, priority, failure_cb)
+
+    """
+    Get a list of albums with asyncio.
+    """
+    async def get_album_list_aio(self, type, size=10, offset=0,
+                                 music_folder_id=None):
+        params = self.get_album_list_params(type, size, offset,
+                                            music_folder_id)
+        return await self.__get_aio("getAlbumList", GetAlbumListResponse,
+                                    params)
+
+    """
+    Normalise getAlbumList parameters.
+    """
+    def get_album_list_params(self, type, size, offset, music_folder_id):
+        params = {
+            "type":   type,
+            "size":   size,
+            "offset": offset,
+        }
+
+        if music_folder_id is not None:
+            params["musicFolderId"] = music_folder_id
+
+        return params
+
+    """
+    Get a list of albums, organised by ID3 tags.
+
+    Takes the same parameters as get_album_list().
+
+    http://www.subsonic.org/pages/api.jsp#getAlbumList2
+    """
+    def get_album_list2(self, type, size=10, offset=0, music_folder_id=None):
+        params = self.get_album_list_params(type, size, offset,
+                                            music_folder_id)
+        return self.__get("getAlbumList2", GetAlbumList2Response, params)
+
+    """
+    Get a list of albums, organised by ID3 tags, asynchronously.
+    """
+    def get_album_list2_async(self, complete_cb, type, size=10, offset=0,
+                              music_folder_id=None, priority=0,
+                              failure_cb=None):
+        params = self.get_album_list_params(type, size, offset,
+                                            music_folder_id)
+        self.__get_async("getAlbumList2", GetAlbumList2Response,
+                         complete_cb, params, priority, failure_cb)
+
+    """
+    Get a list of albums, organised by ID3 tags, with asyncio.
+    """
+    async def get_album_list2_aio(self, type, size=10, offset=0,
+                                  music_folder_id=None):
+        params = self.get_album_list_params(type, size, offset,
+                                            music_folder_id)
+        return await self.__get_aio("getAlbumList2", GetAlbumList2Response,
+                                    params)
+
+    """
+    Get an album and its songs, organised by ID3 tags.
+
+    http://www.subsonic.org/pages/api.jsp#getAlbum
+    """
+    def get_album(self, id):
+        params = self.get_id_params(id)
+        return self.__get("getAlbum", GetAlbumResponse, params)
+
+    """
+    Get an album and its songs, organised by ID3 tags, asynchronously.
+    """
+    def get_album_async(self, complete_cb, id, priority=0, failure_cb=None):
+        params = self.get_id_params(id)
+        self.__get_async("getAlbum", GetAlbumResponse, complete_cb,
+                         params, priority, failure_cb)
+
+    """
+    Get an album and its songs, organised by ID3 tags, with asyncio.
+    """
+    async def get_album_aio(self, id):
+        params = self.get_id_params(id)
+        return await self.__get_aio("getAlbum", GetAlbumResponse, params)
+
+    """
+    Get an artist and their albums, organised by ID3 tags.
+
+    http://www.subsonic.org/pages/api.jsp#getArtist
+    """
+    def get_artist(self, id):
+        params = self.get_id_params(id)
+        return self.__get("getArtist", GetArtistResponse, params)
+
+    """
+    Get an artist and their albums, organised by ID3 tags, asynchronously.
+    """
+    def get_artist_async(self, complete_cb, id, priority=0, failure_cb=None):
+        params = self.get_id_params(id)
+        self.__get_async("getArtist", GetArtistResponse, complete_cb,
+                         params, priority, failure_cb)
+
+    """
+    Get an artist and their albums, organised by ID3 tags, with asyncio.
+    """
+    async def get_artist_aio(self, id):
+        params = self.get_id_params(id)
+        return await self.__get_aio("getArtist", GetArtistResponse, params)
+
+    """
+    Get all artists, organised by ID3 tags.
+
+    http://www.subsonic.org/pages/api.jsp#getArtists
+    """
+    def get_artists(self, music_folder_id=None):
+        params = self.get_artists_params(music_folder_id)
+        return self.__get("getArtists", GetArtistsResponse, params)
+
+    """
+    Get all artists, organised by ID3 tags, asynchronously.
+    """
+    def get_artists_async(self, complete_cb, music_folder_id=None, priority=0,
+                          failure_cb=None):
+        params = self.get_artists_params(music_folder_id)
+        self.__get_async("getArtists", GetArtistsResponse, complete_cb,
+                         params, priority, failure_cb)
+
+    """
+    Get all artists, organised by ID3 tags, with asyncio.
+    """
+    async def get_artists_aio(self, music_folder_id=None):
+        params = self.get_artists_params(music_folder_id)
+        return await self.__get_aio("getArtists", GetArtistsResponse, params)
+
+    """
+    Normalise getArtists parameters.
+    """
+    def get_artists_params(self, music_folder_id):
+        params = {}
+
+        if music_folder_id is not None:
+            params["musicFolderId"] = music_folder_id
+
+        return params
+
+    """
+    Normalise parameters for methods which take only an ID.
+    """
+    def get_id_params(self, id):
+        return {
+            "id": id,
+        }
+
+    """
+    Search for artists, albums and songs, organised by ID3 tags.
+
+    Many servers accept an empty query, matching everything; paging through the
+    songs of such a search is the cheapest way of listing a whole library.
+
+    http://www.subsonic.org/pages/api.jsp#search3
+    """
+    def search3(self, query, artist_count=20, artist_offset=0, album_count=20,
+                album_offset=0, song_count=20, song_offset=0,
+                music_folder_id=None):
+        params = self.search3_params(query, artist_count, artist_offset,
+                                     album_count, album_offset, song_count,
+                                     song_offset, music_folder_id)
+        return self.__get("search3", Search3Response, params)
+
+    """
+    Search for artists, albums and songs asynchronously.
+    """
+    def search3_async(self, complete_cb, query, artist_count=20,
+                      artist_offset=0, album_count=20, album_offset=0,
+                      song_count=20, song_offset=0, music_folder_id=None,
+                      priority=0, failure_cb=None):
+        params = self.search3_params(query, artist_count, artist_offset,
+                                     album_count, album_offset, song_count,
+                                     song_offset, music_folder_id)
+        self.__get_async("search3", Search3Response, complete_cb,
+                         params, priority, failure_cb)
+
+    """
+    Search for artists, albums and songs with asyncio.
+    """
+    async def search3_aio(self, query, artist_count=20, artist_offset=0,
+                          album_count=20, album_offset=0, song_count=20,
+                          song_offset=0, music_folder_id=None):
+        params = self.search3_params(query, artist_count, artist_offset,
+                                     album_count, album_offset, song_count,
+                                     song_offset, music_folder_id)
+        return await self.__get_aio("search3", Search3Response, params)
+
+    """
+    Search for songs, incrementally.
+
+    Takes the same parameters as search3(), but only songs are requested.
+    Yields each song as it arrives.
+    """
+    def iter_search3_songs(self, query, song_count=20, song_offset=0,
+                           music_folder_id=None):
+        params = self.search3_params(query, 0, 0, 0, 0, song_count,
+                                     song_offset, music_folder_id)
+
+        for key, song in self.__stream("search3", ("searchResult3.song",),
+                                        params):
+            yield song
+
+    """
+    Search for songs asynchronously and incrementally.
+
+    song_cb is called with each song as it arrives, then complete_cb is called
+    with no arguments.
+    """
+    def search3_songs_stream_async(self, song_cb, complete_cb, query,
+                                   song_count=20, song_offset=0,
+                                   music_folder_id=None, priority=0,
+                                   failure_cb=None):
+        params = self.search3_params(query, 0, 0, 0, 0, song_count,
+                                     song_offset, music_folder_id)
+        self.__stream_async("search3", lambda key, song: song_cb(song),
+                            complete_cb, ("searchResult3.song",), params,
+                            priority, failure_cb)
+
+    """
+    Normalise search3 parameters.
+    """
+    def search3_params(self, query, artist_count, artist_offset, album_count,
+                       album_offset, song_count, song_offset,
+                       music_folder_id):
+        params = {
+            "query":        query,
+            "artistCount":  artist_count,
+            "artistOffset": artist_offset,
+            "albumCount":   album_count,
+            "albumOffset":  album_offset,
+            "songCount":    song_count,
+            "songOffset":   song_offset,
+        }
+
+        if music_folder_id is not None:
+            params["musicFolderId"] = music_folder_id
+
+        return params
+
+    """
+    Query the Subsonic server's licensing status.
+
+    Note that this method's responses may be unreliable/inconsistent with
+    community-maintained forks of Subsonic.
+
+    http://www.subsonic.org/pages/api.jsp#getLicense
+    """
+    def get_license(self):
+        return self.__get("getLicense", GetLicenseResponse)
+
+    """
+    Get genres.
+
+    http://www.subsonic.org/pages/api.jsp#getGenres
+    """
+    def get_genres(self):
+        return self.__get("getGenres", GetGenresResponse)
+
+    """
+    Get a listing of all files in a directory.
+
+    http://www.subsonic.org/pages/api.jsp#getMusicDirectory
+    """
+    def get_music_directory(self, id):
+        params = self.get_music_directory_params(id)
+        return self.__get("getMusicDirectory", GetMusicDirectoryResponse,
+                          params)
+
+    """
+    Get a listing of all files in a directory asynchronously.
+    """
+    def get_music_directory_async(self, complete_cb, id, priority=0,
+                                  failure_cb=None):
+        params = self.get_music_directory_params(id)
+        self.__get_async("getMusicDirectory", GetMusicDirectoryResponse,
+                         complete_cb, params, priority, failure_cb)
+
+    """
+    Get a listing of all files in a directory with asyncio.
+    """
+    async def get_music_directory_aio(self, id):
+        params = self.get_music_directory_params(id)
+        return await self.__get_aio("getMusicDirectory",
+                                    GetMusicDirectoryResponse, params)
+
+    """
+    Get a listing of all files in a directory, incrementally.
+
+    Yields each child as it arrives.
+    """
+    def iter_music_directory(self, id):
+        params = self.get_music_directory_params(id)
+
+        for key, child in self.__stream("getMusicDirectory",
+                                        ("directory.child",), params):
+            yield child
+
+    """
+    Get a listing of all files in a directory asynchronously and
+    incrementally.
+
+    child_cb is called with each child as it arrives, then complete_cb is
+    called with no arguments.
+    """
+    def get_music_directory_stream_async(self, child_cb, complete_cb, id,
+                                         priority=0, failure_cb=None):
+        params = self.get_music_directory_params(id)
+        self.__stream_async("getMusicDirectory",
+                            lambda key, child: child_cb(child), complete_cb,
+                            ("directory.child",), params, priority,
+                            failure_cb)
+
+    """
+    Normalise getMusicDirectory parameters.
+    """
+    def get_music_directory_params(self, id):
+        return {
+            "id": id,
+        }
+
+    """
+    Get configured music folders.
+
+    http://www.subsonic.org/pages/api.jsp#getMusicFolders
+    """
+    def get_music_folders(self):
+        return self.__get("getMusicFolders", GetMusicFoldersResponse)
+
+    """
+    Get configured music folders asynchronously.
+    """
+    def get_music_folders_async(self, complete_cb, priority=0,
+                                failure_cb=None):
+        self.__get_async("getMusicFolders", GetMusicFoldersResponse,
+                         complete_cb, priority=priority,
+                         failure_cb=failure_cb)
+
+    """
+    Get configured music folders with asyncio.
+    """
+    async def get_music_folders_aio(self):
+        return await self.__get_aio("getMusicFolders",
+                                    GetMusicFoldersResponse)
+
+    """
+    Get the URL a song is streamed from.
+
+    max_bit_rate caps the bit rate, in Kbps, transcoding if need be; 0 leaves it
+    uncapped. format names the format to transcode to, or "raw" to disable
+    transcoding altogether. The URL embeds the credentials, so don't log it.
+
+    Servers can't seek within transcoded streams with Range requests; instead
+    they can be asked to start time_offset seconds in. Transcoded streams are
+    sent with an estimated Content-Length, so that players can seek within
+    them.
+
+    http://www.subsonic.org/pages/api.jsp#stream
+    """
+    def get_stream_url(self, id, max_bit_rate=0, format=None, time_offset=0):
+        params = self.get_stream_params(id, max_bit_rate, format, time_offset)
+        return self.__url(self.__key("stream", params))
+
+    """
+    Normalise stream parameters.
+    """
+    def get_stream_params(self, id, max_bit_rate, format, time_offset):
+        params = {
+            "id":                    id,
+            "estimateContentLength": "true",
+        }
+
+        if max_bit_rate:
+            params["maxBitRate"] = max_bit_rate
+        if format:
+            params["format"] = format
+        if time_offset:
+            params["timeOffset"] = time_offset
+
+        return params
+
+    """
+    Verify connectivity with the server.
+
+    Perform a ping to get an empty response. Ideal for checking authentication
+    credentials.
+
+    http://www.subsonic.org/pages/api.jsp#ping
+    """
+    def ping(self):
+        return self.__get("ping", PingResponse)
+
+    """
+    Verify connectivity with the server with asyncio.
+    """
+    async def ping_aio(self):
+        return await self.__get_aio("ping", PingResponse)
+
+
+"""
+Incremental Content-Encoding decoder.
+
+Decompresses a response body sent with the named Content-Encoding (gzip or
+deflate) as it arrives, a chunk at a time; bodies without one pass through
+untouched. Deflate bodies are accepted both zlib wrapped, as the standard
+requires, and raw, as some servers send them. ValueError is raised for
+unsupported encodings and corrupt bodies.
+
+Pass each chunk to decode() and finish with flush(); both return the decoded
+bytes.
+"""
+class ContentDecoder:
+    # Value of the Accept-Encoding header for the encodings we can decode
+    ACCEPT_ENCODING = "gzip, deflate"
+
+    # Magic number opening gzip streams
+    GZIP_MAGIC = b"\x1f\x8b"
+
+    # zlib decompressor, or None until the deflate variant is known or for
+    # bodies without an encoding
+    __decompressor = None
+
+    # Content-Encoding being decoded
+    __encoding = None
+
+    # Start of a deflate body held back until its variant is known
+    __pending = b""
+
+    """
+    Initialiser.
+    """
+    def __init__(self, encoding=None):
+        encoding = (encoding or "identity").strip().lower()
+
+        if encoding in ("gzip", "x-gzip"):
+            self.__decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding not in ("deflate", "identity"):
+            raise ValueError("unsupported content encoding: %s" %encoding)
+
+        self.__encoding = encoding
+
+    """
+    Get a decoder for a body whose encoding is unknown, from its first chunk.
+
+    For transports which don't expose the response headers: gzip streams are
+    recognised by their magic number, and anything else is passed through.
+    """
+    def sniff(data):
+        if data[:2] == ContentDecoder.GZIP_MAGIC:
+            return ContentDecoder("gzip")
+
+        return ContentDecoder()
+
+    """
+    Decode a chunk of the body.
+    """
+    def decode(self, data):
+        if self.__encoding == "identity" or not data:
+            return data
+
+        if self.__decompressor is None:
+            data, self.__pending = self.__pending + data, b""
+            if len(data) < 2:
+                self.__pending = data
+                return b""
+            self.__start_deflate(data)
+
+        try:
+            return self.__decompressor.decompress(data)
+        except zlib.error as e:
+            raise ValueError("corrupt %s body: %s" %(self.__encoding, e))
+
+    """
+    Decode whatever remains of the body once it has all arrived.
+
+    Raises ValueError if the compressed stream stops short of its end.
+    """
+    def flush(self):
+        data, self.__pending = self.__pending, b""
+        if data:
+            self.__start_deflate(data)
+
+        if self.__decompressor is None:
+            return b""
+
+        try:
+            data = self.__decompressor.decompress(data) \
+                    + self.__decompressor.flush()
+        except zlib.error as e:
+            raise ValueError("corrupt %s body: %s" %(self.__encoding, e))
+
+        if not self.__decompressor.eof:
+            raise ValueError("truncated %s body" %self.__encoding)
+
+        return data
+
+    """
+    Create the decompressor for a deflate body, from its first bytes.
+    """
+    def __start_deflate(self, data):
+        # zlib streams open with a header checksummed to a multiple of 31
+        wrapped = len(data) >= 2 and data[0] & 0x0f == 8 \
+                and (data[0] << 8 | data[1]) % 31 == 0
+        self.__decompressor = zlib.decompressobj(
+                zlib.MAX_WBITS if wrapped else -zlib.MAX_WBITS)
+
+
+"""
+Transfer byte counter.
+
+Counts the bytes of response bodies as they were received, which may have been
+compressed, and once decoded, so that the savings of compression can be seen.
+Instances are thread safe.
+"""
+class TransferCounter:
+    # Bytes decoded and received so far
+    __decoded  = None
+    __received = None
+
+    # Guards the counts
+    __lock = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self):
+        self.__decoded  = 0
+        self.__received = 0
+
+        self.__lock = threading.Lock()
+
+    """
+    Count the bytes of a chunk of a response body, as received and decoded.
+    """
+    def add(self, received, decoded):
+        with self.__lock:
+            self.__received += received
+            self.__decoded  += decoded
+
+    """
+    Get the numbers of bytes received and decoded so far.
+    """
+    def get_counts(self):
+        with self.__lock:
+            return self.__received, self.__decoded
+
+
 """
-class Server:
-    API_URL_FORMAT = "%s/rest/%s.view?%s"
+urllib.request fetcher class.
 
-    __address       = None
-    __username      = None
-    __password      = None
-    __client_name   = None
-    __fetcher       = None
-    __async_fetcher = None
+Make HTTP requests via urllib.request. Compressed responses are asked for, and
+decompressed as they arrive; the bytes transferred are counted by the
+TransferCounter returned by get_transfer().
+"""
+class UrllibRequestFetcher:
+    # Bytes received and decoded by all requests
+    __transfer = TransferCounter()
+
+    def get(url):
+        data = b"".join(UrllibRequestFetcher.get_chunks(url))
+
+        return json.loads(data.decode("utf-8"))
 
     """
-    Get an instance with the designated address, username and password.
+    Fetch a URL, yielding the decoded response body in chunks as it arrives.
     """
-    def __init__(self, address, username, password, client_name, fetcher=None,
-                 async_fetcher=None):
-        self.__address     = address
-        self.__username    = username
-        self.__password    = password
-        self.__client_name = client_name
+    def get_chunks(url, chunk_size=65536):
+        transfer = UrllibRequestFetcher.__transfer
+
+        request = urllib.request.Request(url, headers={
+            "Accept-Encoding": ContentDecoder.ACCEPT_ENCODING,
+        })
+        with urllib.request.urlopen(request) as response:
+            decoder = ContentDecoder(response.headers.get("Content-Encoding"))
+
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+
+                data = decoder.decode(chunk)
+                transfer.add(len(chunk), len(data))
+                if data:
+                    yield data
+
+            data = decoder.flush()
+            transfer.add(0, len(data))
+            if data:
+                yield data
 
-        if fetcher is None:
-            fetcher = UrllibRequestFetcher
-        self.__fetcher = fetcher
+    """
+    Get the counter of the bytes transferred by all requests.
+    """
+    def get_transfer():
+        return UrllibRequestFetcher.__transfer
 
-        self.__async_fetcher = async_fetcher
+
+"""
+Pooled HTTP fetcher class.
+
+Make HTTP requests over persistent connections, kept alive and reused between
+requests to the same host. This saves a TCP connection, and over HTTPS a TLS
+handshake, on every request.
+
+Instances are thread safe. Up to pool_size idle connections are kept per host;
+connections which have been idle for longer than idle_timeout seconds are
+closed rather than reused, since the server has probably given up on them.
+Compressed responses are asked for and decompressed, and the bytes transferred
+counted as for UrllibRequestFetcher.
+"""
+class HTTPConnectionPoolFetcher:
+    # Errors indicating that the server closed a kept-alive connection
+    STALE_CONNECTION_ERRORS = (http.client.BadStatusLine, BrokenPipeError,
+                               ConnectionResetError,
+                               ConnectionAbortedError)
+
+    # Idle connections by (scheme, host, port), as [(connection, last_used)]
+    __idle = None
+
+    # Seconds after which idle connections are discarded
+    __idle_timeout = None
+
+    # Guards __idle
+    __lock = None
+
+    # Maximum number of idle connections kept per host
+    __pool_size = None
+
+    # Socket timeout, in seconds
+    __timeout = None
+
+    # Bytes received and decoded
+    __transfer = None
 
     """
-    Perform a request to the API.
+    Initialiser.
+    """
+    def __init__(self, pool_size=4, idle_timeout=60, timeout=30):
+        self.__pool_size    = pool_size
+        self.__idle_timeout = idle_timeout
+        self.__timeout      = timeout
+
+        self.__idle     = {}
+        self.__lock     = threading.Lock()
+        self.__transfer = TransferCounter()
 
-    Guess the URL within the API based on our format string, the specified
-    address and the name of the method called; make a request to that URL and
-    return a resp object representing the decoded JSON response string.
     """
-    def __get(self, method, params={}):
-        return self.__fetcher.get(self.__url(method, params))
+    Close all idle connections.
+    """
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+
+        for connections in idle.values():
+            for connection, last_used in connections:
+                connection.close()
 
     """
-    Perform a request to the API asynchronously.
+    Fetch a URL and decode its JSON response.
+    """
+    def get(self, url):
+        return json.loads(self.get_raw(url).decode("utf-8"))
 
-    Behaviour is identical to __get(), but we instead use the __async_fetcher to
-    retreive the URL and call the specified complete_cb with the result upon its
-    retreival.
     """
-    def __get_async(self, method, complete_cb, params={}):
-        return self.__async_fetcher.get(self.__url(method, params),
-                                        complete_cb)
+    Fetch a URL, yielding the decoded response body in chunks as it arrives.
 
+    The connection is only returned to the pool if the body is read in full.
     """
-    Guess the URL of an API method from its name.
+    def get_chunks(self, url, chunk_size=65536):
+        key, connection, response = self.__open(url)
 
-    urllib requires that we also handle parameters here, so we'll also merge
-    method-specific parameters with the credentials required for all methods
-    (to facilitate authentication, client identification and API versioning).
+        complete = False
+        try:
+            decoder = ContentDecoder(response.getheader("Content-Encoding"))
+
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+
+                data = decoder.decode(chunk)
+                self.__transfer.add(len(chunk), len(data))
+                if data:
+                    yield data
+
+            data = decoder.flush()
+            self.__transfer.add(0, len(data))
+            if data:
+                yield data
+
+            complete = True
+        finally:
+            if complete and not response.will_close:
+                self.__release(key, connection)
+            else:
+                connection.close()
+
+    """
+    Fetch a URL and return the decoded response body.
     """
-    def __url(self, method, params={}):
-        params["c"] = self.__client_name
-        params["f"] = "json"
-        params["v"] = "1.10.1"
-        params["u"] = self.__username
-        params["p"] = self.__password
+    def get_raw(self, url):
+        key, connection, response = self.__open(url)
 
-        params = urllib.parse.urlencode(params)
-        return self.API_URL_FORMAT %(self.__address, method, params)
+        try:
+            data = response.read()
+        except:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.__release(key, connection)
+
+        decoder = ContentDecoder(response.getheader("Content-Encoding"))
+        body    = decoder.decode(data) + decoder.flush()
+        self.__transfer.add(len(data), len(body))
+
+        return body
 
     """
-    Get the server's address.
+    Get the counter of the bytes transferred.
     """
-    def get_address(self):
-        return self.__address
+    def get_transfer(self):
+        return self.__transfer
 
     """
-    Get indexed structure of all artists.
+    Get a connection to a host, reusing an idle one if possible.
 
-    http://www.subsonic.org/pages/api.jsp#getIndexes
+    Returns the connection and whether it was reused.
     """
-    def get_indexes(self, music_folder_id=None, if_modified_since=None):
-        params = self.get_indexes_params(music_folder_id, if_modified_since)
+    def __acquire(self, key, fresh=False):
+        now = time.monotonic()
+
+        with self.__lock:
+            connections = self.__idle.get(key, [])
+            while connections and not fresh:
+                connection, last_used = connections.pop()
+                if now - last_used < self.__idle_timeout:
+                    return connection, True
+                connection.close()
 
-        return GetIndexesResponse(self.__get("getIndexes", params))
+        scheme, host, port = key
+        if scheme == "https":
+            connection_class = http.client.HTTPSConnection
+        else:
+            connection_class = http.client.HTTPConnection
+
+        return connection_class(host, port, timeout=self.__timeout), False
 
     """
-    Get indexed structure of all artists asynchronously.
+    Send a request and read the response headers.
+
+    Requests which fail on a reused connection are retried once on a fresh one,
+    since the server may have closed it in the meantime. Returns the pool key,
+    connection and response, the body of which is yet to be read.
+    """
+    def __open(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        key    = (parsed.scheme, parsed.hostname, parsed.port)
+        path   = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+
+        connection, reused = self.__acquire(key)
+        try:
+            response = self.__request(connection, path)
+        except self.STALE_CONNECTION_ERRORS:
+            connection.close()
+            if not reused:
+                raise
+
+            connection, reused = self.__acquire(key, fresh=True)
+            try:
+                response = self.__request(connection, path)
+            except:
+                connection.close()
+                raise
+        except:
+            connection.close()
+            raise
+
+        if response.status != 200:
+            connection.close()
+            raise urllib.error.HTTPError(url, response.status,
+                                         response.reason, response.headers,
+                                         None)
+
+        return key, connection, response
+
     """
-    def get_indexes_async(self, complete_cb, music_folder_id=None, if_modified_since=None):
-        def real_complete_cb(resp):
-            complete_cb(GetIndexesResponse(resp))
+    Return a connection to the pool, or close it if the pool is full.
+    """
+    def __release(self, key, connection):
+        with self.__lock:
+            connections = self.__idle.setdefault(key, [])
+            if len(connections) < self.__pool_size:
+                connections.append((connection, time.monotonic()))
+                return
 
-        params = self.get_indexes_params(music_folder_id, if_modified_since)
-        self.__get_async("getIndexes", real_complete_cb, params)
+        connection.close()
 
     """
-    Normalise parameters for the getIndexes method.
+    Send a request over a connection and read the response headers.
     """
-    def get_indexes_params(self, music_folder_id, if_modified_since):
-        params = {}
+    def __request(self, connection, path):
+        connection.request("GET", path, headers={
+            "Accept-Encoding": ContentDecoder.ACCEPT_ENCODING,
+        })
+        return connection.getresponse()
 
-        if music_folder_id is not None:
-            params["musicFolderId"] = music_folder_id
 
-        if if_modified_since is not None:
-            params["ifModifiedSince"] = if_modified_since
+"""
+asyncio stream fetcher class.
+
+Make HTTP requests with asyncio streams for the coroutine methods of the Server
+class, over persistent connections kept alive and reused between requests to
+the same host.
+
+At most max_connections requests are in flight at once and the rest wait their
+turn, so any number of coroutines can be started without overwhelming the
+server. Attempts which fail with a network error, or a server error worth
+retrying, are retried up to max_attempts times in all, after an exponential
+backoff starting at backoff_base seconds. Connections which have been idle for
+longer than idle_timeout seconds are closed rather than reused. Compressed
+responses are asked for and decompressed, and the bytes transferred counted as
+for UrllibRequestFetcher.
+
+Instances must only be used from one event loop.
+"""
+class AsyncioStreamFetcher:
+    # Errors indicating that the server closed a kept-alive connection
+    STALE_CONNECTION_ERRORS = (asyncio.IncompleteReadError, BrokenPipeError,
+                               ConnectionResetError,
+                               ConnectionAbortedError)
 
-        return params
+    # HTTP status codes worth retrying
+    TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+
+    # Seconds to wait before the first retry
+    __backoff_base = None
+
+    # Idle connections by (scheme, host, port), as [(reader, writer,
+    # last_used)]
+    __idle = None
+
+    # Seconds after which idle connections are discarded
+    __idle_timeout = None
+
+    # Maximum number of attempts per request
+    __max_attempts = None
+
+    # Maximum number of requests in flight, and the semaphore enforcing it
+    __max_connections = None
+    __semaphore       = None
+
+    # Timeout per attempt, in seconds
+    __timeout = None
+
+    # Bytes received and decoded
+    __transfer = None
 
     """
-    Query the Subsonic server's licensing status.
+    Initialiser.
+    """
+    def __init__(self, max_connections=16, idle_timeout=60, timeout=30,
+                 max_attempts=3, backoff_base=0.5):
+        self.__max_connections = max(1, max_connections)
+        self.__idle_timeout    = idle_timeout
+        self.__timeout         = timeout
+        self.__max_attempts    = max(1, max_attempts)
+        self.__backoff_base    = backoff_base
 
-    Note that this method's responses may be unreliable/inconsistent with
-    community-maintained forks of Subsonic.
+        self.__idle     = {}
+        self.__transfer = TransferCounter()
 
-    http://www.subsonic.org/pages/api.jsp#getLicense
     """
-    def get_license(self):
-        return GetLicenseResponse(self.__get("getLicense"))
+    Close all idle connections.
+    """
+    def close(self):
+        idle, self.__idle = self.__idle, {}
+
+        for connections in idle.values():
+            for reader, writer, last_used in connections:
+                writer.close()
 
     """
-    Get genres.
+    Fetch a URL and decode its JSON response.
+    """
+    async def get(self, url):
+        return json.loads((await self.get_raw(url)).decode("utf-8"))
 
-    http://www.subsonic.org/pages/api.jsp#getGenres
     """
-    def get_genres(self):
-        return GetGenresResponse(self.__get("getGenres"))
+    Fetch a URL and return the decoded response body.
 
+    Raises urllib.error.HTTPError for unsuccessful responses, ValueError for
+    corrupt compressed ones, or the last network error once every attempt has
+    failed.
     """
-    Get a listing of all files in a directory.
+    async def get_raw(self, url):
+        # Semaphores belong to the loop they're first used on
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.__max_connections)
+
+        attempt = 1
+        while True:
+            try:
+                async with self.__semaphore:
+                    return await asyncio.wait_for(self.__fetch(url),
+                                                  self.__timeout)
+            except (OSError, asyncio.IncompleteReadError,
+                    asyncio.TimeoutError) as e:
+                if attempt >= self.__max_attempts or not self.__is_transient(e):
+                    raise
+
+            await asyncio.sleep(self.__backoff_base * 2 ** (attempt - 1))
+            attempt += 1
 
-    http://www.subsonic.org/pages/api.jsp#getMusicDirectory
     """
-    def get_music_directory(self, id):
-        params = self.get_music_directory(id)
-        return GetMusicDirectoryResponse(self.__get("getMusicDirectory", params))
+    Get the counter of the bytes transferred.
+    """
+    def get_transfer(self):
+        return self.__transfer
 
     """
-    Get a listing of all files in a directory asynchronously.
+    Get a connection to a host, reusing an idle one if possible.
+
+    Returns the connection's reader and writer, and whether it was reused.
     """
-    def get_music_directory_async(self, complete_cb, id):
-        def real_complete_cb(resp):
-            complete_cb(GetMusicDirectoryResponse(resp))
+    async def __acquire(self, key, fresh=False):
+        now = time.monotonic()
 
-        params = self.get_music_directory_params(id)
-        self.__get_async("getMusicDirectory", real_complete_cb, params)
+        connections = self.__idle.get(key, [])
+        while connections and not fresh:
+            reader, writer, last_used = connections.pop()
+            if now - last_used < self.__idle_timeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+
+        scheme, host, port = key
+        if port is None:
+            port = 443 if scheme == "https" else 80
+
+        reader, writer = await asyncio.open_connection(
+                host, port, ssl=True if scheme == "https" else None)
+        return reader, writer, False
 
     """
-    Normalise getMusicDirectory parameters.
+    Make a request and read the whole response.
+
+    Requests which fail on a reused connection are retried once on a fresh one,
+    since the server may have closed it in the meantime.
     """
-    def get_music_directory_params(self, id):
-        return {
-            "id": id,
-        }
+    async def __fetch(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        key    = (parsed.scheme, parsed.hostname, parsed.port)
+        path   = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+
+        reader, writer, reused = await self.__acquire(key)
+        try:
+            response = await self.__request(reader, writer, parsed.netloc,
+                                            path)
+        except self.STALE_CONNECTION_ERRORS:
+            writer.close()
+            if not reused:
+                raise
+
+            reader, writer, reused = await self.__acquire(key, fresh=True)
+            try:
+                response = await self.__request(reader, writer,
+                                                parsed.netloc, path)
+            except:
+                writer.close()
+                raise
+        except:
+            writer.close()
+            raise
+
+        status, reason, headers, body, will_close = response
+        if will_close:
+            writer.close()
+        else:
+            self.__release(key, reader, writer)
+
+        if status != 200:
+            raise urllib.error.HTTPError(url, status, reason, headers, None)
+
+        decoder = ContentDecoder(headers.get("content-encoding"))
+        data    = decoder.decode(body) + decoder.flush()
+        self.__transfer.add(len(body), len(data))
+
+        return data
 
     """
-    Get configured music folders.
+    Is an error worth retrying?
+    """
+    def __is_transient(self, error):
+        if isinstance(error, urllib.error.HTTPError):
+            return error.code in self.TRANSIENT_STATUSES
+
+        return True
 
-    http://www.subsonic.org/pages/api.jsp#getMusicFolders
     """
-    def get_music_folders(self):
-        return GetMusicFoldersResponse(self.__get("getMusicFolders"))
+    Read a body sent with chunked transfer encoding.
+    """
+    async def __read_chunked(self, reader):
+        chunks = []
+
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if not size:
+                break
+
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+
+        # Skip any trailers
+        while (await reader.readline()).strip():
+            pass
+
+        return b"".join(chunks)
 
     """
-    Verify connectivity with the server.
+    Return a connection to the pool, or close it if the pool is full.
+    """
+    def __release(self, key, reader, writer):
+        connections = self.__idle.setdefault(key, [])
+        if len(connections) < self.__max_connections:
+            connections.append((reader, writer, time.monotonic()))
+            return
 
-    Perform a ping to get an empty response. Ideal for checking authentication
-    credentials.
+        writer.close()
 
-    http://www.subsonic.org/pages/api.jsp#ping
     """
-    def ping(self):
-        return PingResponse(self.__get("ping"))
+    Send a request over a connection and read the response.
+
+    Returns the status, reason, headers (with lower case names) and body of the
+    response, and whether the server will close the connection.
+    """
+    async def __request(self, reader, writer, host, path):
+        writer.write(("GET %s HTTP/1.1\r\nHost: %s\r\n"
+                      "Accept-Encoding: %s\r\n\r\n"
+                      %(path, host, ContentDecoder.ACCEPT_ENCODING))
+                     .encode("latin-1"))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(status_line, None)
+        version, status, reason = (status_line.decode("latin-1").rstrip()
+                                   .split(" ", 2) + [""])[:3]
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get("connection", "").lower()
+        will_close = connection == "close" \
+                or (version == "HTTP/1.0" and connection != "keep-alive")
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            body = await self.__read_chunked(reader)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body       = await reader.read()
+            will_close = True
+
+        return int(status), reason, headers, body, will_close
 
 
 """
-urllib.request fetcher class.
+Incremental JSON item parser.
+
+Extracts the values of specific keys from a JSON document as it arrives, rather
+than decoding the whole document at once. Where a key's value is an array, each
+of its elements is extracted individually, so only one element needs to be held
+in memory at a time; other values are extracted whole. Values which have already
+been extracted aren't searched for further keys.
+
+A key may be qualified by the keys enclosing it, e.g. "index.artist" matches
+"artist" keys within the value of an "index" key, but not "artist" keys within
+songs elsewhere in the document. Arrays without keys of their own, and the
+objects within them, are passed over. Unqualified keys match at any depth.
+
+Feed the document in chunks of bytes to feed() and finish with close(); both
+return the (key, value) pairs completed by the data. ValueError is raised for
+malformed or truncated documents.
+"""
+class JSONItemStream:
+    # Parser states
+    SCANNING = 0 # Looking for a key of interest
+    ITEMS    = 1 # Within an array of interest
+    VALUE    = 2 # Before a single value of interest
+
+    # Consumed characters to accumulate before compacting the buffer
+    COMPACT_THRESHOLD = 65536
+
+    # Characters which may follow a value
+    TERMINATORS = ",]} \t\r\n"
+
+    # Characters opening and closing arrays and objects
+    BRACKETS = re.compile(r"[][{}]")
+
+    # Unconsumed text and our position within it
+    __buffer = None
+    __pos    = None
+
+    # JSONDecoder used for the values of interest
+    __decoder = None
+
+    # Keys of the arrays and objects we're within, or None for those without,
+    # so that keys can be matched by path and truncation detected
+    __path = None
+
+    # The key whose value we're extracting, and those we're interested in,
+    # mapped to the qualified keys and the keys which must enclose them
+    __key  = None
+    __keys = None
+
+    # Whether we've seen anything but whitespace
+    __started = None
+
+    # Parser state
+    __state = None
+
+    # Incremental UTF-8 decoder
+    __text = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self, keys):
+        self.__keys    = {}
+        self.__decoder = json.JSONDecoder()
+        self.__text    = codecs.getincrementaldecoder("utf-8")()
+
+        for qualified in keys:
+            parents = tuple(qualified.split("."))
+            self.__keys.setdefault(parents[-1], []).append((qualified,
+                                                            parents[:-1]))
+
+        self.__buffer  = ""
+        self.__path    = []
+        self.__pos     = 0
+        self.__started = False
+        self.__state   = self.SCANNING
+
+    """
+    Finish parsing the document.
+    """
+    def close(self):
+        self.__buffer += self.__text.decode(b"", True)
+        items = self.__parse(True)
+
+        if not self.__started:
+            raise ValueError("empty JSON document")
+        if self.__state != self.SCANNING or self.__path \
+                or self.__buffer[self.__pos:].strip():
+            raise ValueError("truncated JSON document")
+
+        return items
+
+    """
+    Parse another chunk of the document.
+    """
+    def feed(self, data):
+        self.__buffer += self.__text.decode(data)
+        return self.__parse(False)
+
+    """
+    Find the qualified key matching a key at the current path, if any.
+    """
+    def __match(self, key):
+        candidates = self.__keys.get(key)
+        if candidates is None:
+            return None
+
+        path = None
+        for qualified, parents in candidates:
+            if parents:
+                if path is None:
+                    path = tuple(k for k in self.__path if k is not None)
+                if path[len(path) - len(parents):] != parents:
+                    continue
+
+            return qualified
+
+    """
+    Track the arrays and objects opened and closed by unquoted text.
+
+    Those opened here don't directly follow a key, so are recorded without one.
+    """
+    def __track_path(self, text):
+        for bracket in self.BRACKETS.findall(text):
+            if bracket in "[{":
+                self.__path.append(None)
+            elif self.__path:
+                self.__path.pop()
+            else:
+                raise ValueError("unexpected %r in JSON document" %bracket)
+
+    """
+    Extract what we can from the buffer.
+
+    Unless this is the final call, parsing stops wherever a token might
+    continue into the next chunk.
+    """
+    def __parse(self, final):
+        buffer = self.__buffer
+        pos    = self.__pos
+        items  = []
+
+        if not self.__started and buffer.strip():
+            self.__started = True
+
+        while True:
+            if self.__state == self.SCANNING:
+                quote = buffer.find('"', pos)
+                if quote < 0:
+                    self.__track_path(buffer[pos:])
+                    pos = len(buffer)
+                    break
+
+                self.__track_path(buffer[pos:quote])
+                pos = quote
+
+                end = self.__string_end(buffer, quote)
+                if end < 0:
+                    break
+
+                colon = self.__skip_whitespace(buffer, end + 1)
+                if colon >= len(buffer):
+                    break
+
+                if buffer[colon] != ":":
+                    pos = end + 1
+                    continue
+
+                start = self.__skip_whitespace(buffer, colon + 1)
+                if start >= len(buffer):
+                    break
+
+                key       = buffer[quote + 1:end]
+                qualified = self.__match(key)
+                if qualified is None:
+                    # Note the key of the array or object it opens, if any
+                    if buffer[start] in "[{":
+                        self.__path.append(key)
+                        pos = start + 1
+                    else:
+                        pos = start
+                    continue
+
+                self.__key = qualified
+                if buffer[start] == "[":
+                    self.__state = self.ITEMS
+                    self.__path.append(key)
+                    pos = start + 1
+                else:
+                    self.__state = self.VALUE
+                    pos = start
+            else:
+                if self.__state == self.ITEMS:
+                    pos = self.__skip_whitespace(buffer, pos, ",")
+                    if pos < len(buffer) and buffer[pos] == "]":
+                        self.__state = self.SCANNING
+                        self.__path.pop()
+                        pos += 1
+                        continue
+
+                if pos >= len(buffer):
+                    break
+
+                try:
+                    value, end = self.__decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    break
+
+                # Numbers may continue into the next chunk, so values only
+                # count once we've seen what follows them
+                if end >= len(buffer):
+                    if not final:
+                        break
+                elif buffer[end] not in self.TERMINATORS:
+                    if final:
+                        raise ValueError("unexpected %r in JSON document"
+                                %buffer[end])
+                    break
+
+                items.append((self.__key, value))
+                pos = end
+
+                if self.__state == self.VALUE:
+                    self.__state = self.SCANNING
+
+        if pos > self.COMPACT_THRESHOLD:
+            buffer = buffer[pos:]
+            pos    = 0
+
+        self.__buffer = buffer
+        self.__pos    = pos
+
+        return items
+
+    """
+    Get the position of the first character at or after pos which isn't
+    whitespace or one of the extra characters.
+    """
+    def __skip_whitespace(self, buffer, pos, extra=""):
+        length = len(buffer)
+        while pos < length and (buffer[pos].isspace() or buffer[pos] in extra):
+            pos += 1
+
+        return pos
+
+    """
+    Find the closing quote of the string opening at quote, or -1 if it isn't in
+    the buffer yet.
+    """
+    def __string_end(self, buffer, quote):
+        pos = quote + 1
+
+        while True:
+            end = buffer.find('"', pos)
+            if end < 0:
+                return -1
+
+            # The quote is escaped by an odd number of backslashes
+            escape = end - 1
+            while buffer[escape] == "\\":
+                escape -= 1
+            if (end - 1 - escape) % 2 == 0:
+                return end
+
+            pos = end + 1
+
 
-Make HTTP requests via urllib.request.
 """
-class UrllibRequestFetcher:
-    def get(url):
-        request  = urllib.request.Request(url)
-        response = urllib.request.urlopen(request)
-        data = json.loads(response.read().decode("utf-8"))
-        response.close()
+Subsonic response error.
 
-        return data
+Raised when a response reports a failure or doesn't have the expected shape.
+The code is the Subsonic error code, if the server supplied one.
+"""
+class ResponseError(Exception):
+    # Error codes which won't go away if we try again
+    PERMANENT_CODES = (10, 20, 30, 40, 50, 60, 70)
+
+    code = None
+
+    def __init__(self, message, code=None):
+        super(ResponseError, self).__init__(message)
+        self.code = code
+
+    """
+    Is it worth retrying the request?
+    """
+    def is_transient(self):
+        return self.code not in self.PERMANENT_CODES
 
 
 """
@@ -240,6 +1937,103 @@ class GetLicenseResponse(Response):
         self.valid = resp["valid"]
 
 
+"""
+Subsonic getAlbumList response.
+"""
+class GetAlbumListResponse(Response):
+    albums = None
+
+    def __init__(self, resp):
+        super(GetAlbumListResponse, self).__init__(resp)
+        resp = resp["subsonic-response"]["albumList"]
+
+        self.albums = as_list(resp.get("album"))
+
+
+"""
+Subsonic getAlbumList2 response.
+"""
+class GetAlbumList2Response(Response):
+    albums = None
+
+    def __init__(self, resp):
+        super(GetAlbumList2Response, self).__init__(resp)
+        resp = resp["subsonic-response"]["albumList2"]
+
+        self.albums = as_list(resp.get("album"))
+
+
+"""
+Subsonic getAlbum response.
+"""
+class GetAlbumResponse(Response):
+    artist = None
+    id     = None
+    name   = None
+    songs  = None
+
+    def __init__(self, resp):
+        super(GetAlbumResponse, self).__init__(resp)
+        resp = resp["subsonic-response"]["album"]
+
+        self.id     = resp["id"]
+        self.name   = resp.get("name")
+        self.artist = resp.get("artist")
+        self.songs  = as_list(resp.get("song"))
+
+
+"""
+Subsonic getArtist response.
+"""
+class GetArtistResponse(Response):
+    albums = None
+    id     = None
+    name   = None
+
+    def __init__(self, resp):
+        super(GetArtistResponse, self).__init__(resp)
+        resp = resp["subsonic-response"]["artist"]
+
+        self.id     = resp["id"]
+        self.name   = resp.get("name")
+        self.albums = as_list(resp.get("album"))
+
+
+"""
+Subsonic getArtists response.
+
+As with getIndexes, we flatten the index headings away and return the artists
+as a single list.
+"""
+class GetArtistsResponse(Response):
+    artists          = None
+    ignored_articles = None
+
+    def __init__(self, resp):
+        super(GetArtistsResponse, self).__init__(resp)
+        resp = resp["subsonic-response"]["artists"]
+
+        self.ignored_articles = resp.get("ignoredArticles", "").split()
+        self.artists = [artist for index in as_list(resp.get("index"))
+                               for artist in as_list(index.get("artist"))]
+
+
+"""
+Subsonic getGenres response.
+
+Each genre is a dictionary whose value is its name; newer servers also count
+its songs and albums.
+"""
+class GetGenresResponse(Response):
+    genres = None
+
+    def __init__(self, resp):
+        super(GetGenresResponse, self).__init__(resp)
+        resp = resp["subsonic-response"]["genres"]
+
+        self.genres = as_list(resp.get("genre"))
+
+
 """
 Subsonic getIndexes response.
 
@@ -249,14 +2043,19 @@ headings and dive straight in with the artist list for consistency.
 class GetIndexesResponse(Response):
     ignored_articles = None
     index            = None
+    last_modified    = None
 
     def __init__(self, resp):
         super(GetIndexesResponse, self).__init__(resp)
         resp = resp["subsonic-response"]["indexes"]
 
-        self.ignored_articles = resp["ignoredArticles"].split(" ")
-        self.index = [artist for index in resp["index"]
-                             for artist in index["artist"]]
+        self.ignored_articles = resp.get("ignoredArticles", "").split()
+        self.last_modified    = resp.get("lastModified")
+
+        # The server omits the index entirely if it hasn't changed since the
+        # ifModifiedSince parameter
+        self.index = [artist for index in as_list(resp.get("index"))
+                             for artist in as_list(index.get("artist"))]
 
 
 """
@@ -266,23 +2065,16 @@ class GetMusicDirectoryResponse(Response):
     children = None
     id       = None
     name     = None
+    parent   = None
 
     def __init__(self, resp):
         super(GetMusicDirectoryResponse, self).__init__(resp)
         resp = resp["subsonic-response"]["directory"]
 
-        self.id   = resp["id"]
-        self.name = resp["name"]
-
-        try:
-            if not resp["child"]:
-                self.child = []
-            elif isinstance(resp["child"], dict):
-                self.children = [resp["child"],]
-            else:
-                self.children = resp["child"]
-        except KeyError:
-            self.children = []
+        self.id       = resp["id"]
+        self.name     = resp["name"]
+        self.parent   = resp.get("parent")
+        self.children = as_list(resp.get("child"))
 
 
 """
@@ -293,7 +2085,25 @@ class GetMusicFoldersResponse(Response):
 
     def __init__(self, resp):
         super(GetMusicFoldersResponse, self).__init__(resp)
-        self.music_folders = resp["subsonic-response"]["musicFolders"]["musicFolder"]
+        self.music_folders = as_list(
+                resp["subsonic-response"]["musicFolders"].get("musicFolder"))
+
+
+"""
+Subsonic search3 response.
+"""
+class Search3Response(Response):
+    albums  = None
+    artists = None
+    songs   = None
+
+    def __init__(self, resp):
+        super(Search3Response, self).__init__(resp)
+        resp = resp["subsonic-response"]["searchResult3"]
+
+        self.artists = as_list(resp.get("artist"))
+        self.albums  = as_list(resp.get("album"))
+        self.songs   = as_list(resp.get("song"))
 
 
 """
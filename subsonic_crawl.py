@@ -0,0 +1,236 @@
+"""
+Subsonic library crawler
+
+Crawls a Subsonic server's library without Rhythmbox, using the asyncio API of
+subsonic.Server to make many requests at once, and dumps its songs as JSON
+lines. Handy for warming a server's caches, and for benchmarking servers.
+
+    $ python3 subsonic_crawl.py http://localhost:4040 admin secret \
+              --concurrency 32 --output library.jsonl
+
+A summary, including the bytes received against what they decoded to, is
+written to stderr once the crawl completes. The exit status is 1 if any
+requests failed, in which case the dump is incomplete.
+
+Copyright (c) 2013 Luke Carrier
+Released under the terms of the GPLv3
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import subsonic
+
+# Songs requested per search3 page
+SEARCH3_PAGE_SIZE = 500
+
+"""
+Subsonic library crawler.
+
+Walks the library by folder, by ID3 tags or by paging through search3, starting
+every request it can; the fetcher limits how many are in flight at once.
+"""
+class Crawler:
+    # Number of requests which failed, and were made in all
+    failures = None
+    requests = None
+
+    # Number of songs dumped
+    songs = None
+
+    # The Subsonic server instance
+    __server = None
+
+    # File the songs are dumped to
+    __output = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self, server, output):
+        self.__server = server
+        self.__output = output
+
+        self.failures = 0
+        self.requests = 0
+        self.songs    = 0
+
+    """
+    Crawl the library by folder.
+    """
+    async def crawl_folders(self, music_folder_id=None):
+        resp = await self.__request(self.__server.get_indexes_aio,
+                                    music_folder_id)
+        if resp is not None:
+            await asyncio.gather(*(self.__walk_directory(artist["id"])
+                                   for artist in resp.index))
+
+    """
+    Crawl the library by ID3 tags.
+    """
+    async def crawl_id3(self, music_folder_id=None):
+        resp = await self.__request(self.__server.get_artists_aio,
+                                    music_folder_id)
+        if resp is not None:
+            await asyncio.gather(*(self.__walk_artist(artist["id"])
+                                   for artist in resp.artists))
+
+    """
+    Crawl the library by paging through the songs matched by an empty search3
+    query.
+
+    Pages are requested concurrency at a time, until one comes up short.
+    """
+    async def crawl_search3(self, music_folder_id=None, concurrency=16):
+        offset = 0
+
+        while True:
+            pages = await asyncio.gather(*(
+                    self.__request(self.__server.search3_aio, "", 0, 0, 0, 0,
+                                   SEARCH3_PAGE_SIZE,
+                                   offset + i * SEARCH3_PAGE_SIZE,
+                                   music_folder_id)
+                    for i in range(concurrency)))
+            offset += concurrency * SEARCH3_PAGE_SIZE
+
+            for resp in pages:
+                if resp is not None:
+                    self.__dump(resp.songs)
+
+            if any(resp is not None and len(resp.songs) < SEARCH3_PAGE_SIZE
+                   for resp in pages):
+                break
+
+            if all(resp is None for resp in pages):
+                break
+
+    """
+    Dump songs to the output.
+    """
+    def __dump(self, songs):
+        for song in songs:
+            self.__output.write(json.dumps(song, separators=(",", ":")))
+            self.__output.write("\n")
+
+        self.songs += len(songs)
+
+    """
+    Make a request, counting it and reporting its failure.
+
+    Returns the response, or None if the request failed.
+    """
+    async def __request(self, method, *args):
+        self.requests += 1
+
+        try:
+            return await method(*args)
+        except (OSError, ValueError, asyncio.IncompleteReadError,
+                subsonic.ResponseError) as e:
+            self.failures += 1
+            print("%s%r failed: %s" %(method.__name__, args, e),
+                  file=sys.stderr)
+
+    """
+    Walk an artist's albums, by ID3 tags.
+    """
+    async def __walk_artist(self, id):
+        resp = await self.__request(self.__server.get_artist_aio, id)
+        if resp is not None:
+            await asyncio.gather(*(self.__walk_album(album["id"])
+                                   for album in resp.albums))
+
+    """
+    Dump an album's songs, by ID3 tags.
+    """
+    async def __walk_album(self, id):
+        resp = await self.__request(self.__server.get_album_aio, id)
+        if resp is not None:
+            self.__dump(resp.songs)
+
+    """
+    Walk a directory and its subdirectories, dumping their songs.
+    """
+    async def __walk_directory(self, id):
+        resp = await self.__request(self.__server.get_music_directory_aio, id)
+        if resp is None:
+            return
+
+        self.__dump([child for child in resp.children
+                     if not child.get("isDir")])
+        await asyncio.gather(*(self.__walk_directory(child["id"])
+                               for child in resp.children
+                               if child.get("isDir")))
+
+
+async def crawl(args, output):
+    fetcher = subsonic.AsyncioStreamFetcher(args.concurrency,
+                                            timeout=args.timeout,
+                                            max_attempts=args.attempts)
+    server  = subsonic.Server(args.address, args.username, args.password,
+                              "rhythmsub-crawl", cache_size=0,
+                              asyncio_fetcher=fetcher)
+    crawler = Crawler(server, output)
+
+    try:
+        if args.crawl_mode == "id3":
+            await crawler.crawl_id3(args.music_folder)
+        elif args.crawl_mode == "search3":
+            await crawler.crawl_search3(args.music_folder, args.concurrency)
+        else:
+            await crawler.crawl_folders(args.music_folder)
+    finally:
+        fetcher.close()
+
+    return crawler, fetcher.get_transfer()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("address", help="base URL of the server")
+    parser.add_argument("username")
+    parser.add_argument("password")
+    parser.add_argument("--crawl-mode", default="folders",
+                        choices=("folders", "id3", "search3"),
+                        help="how to crawl the library (default: %(default)s)")
+    parser.add_argument("--music-folder", metavar="ID",
+                        help="only crawl one music folder")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="requests in flight at once (default: %(default)s)")
+    parser.add_argument("--attempts", type=int, default=3,
+                        help="attempts per request (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="seconds to allow each attempt "
+                             "(default: %(default)s)")
+    parser.add_argument("--output", default="-", metavar="FILE",
+                        help="file to dump songs to (default: stdout)")
+    args = parser.parse_args()
+
+    if args.output == "-":
+        output = sys.stdout
+    else:
+        output = open(args.output, "w")
+
+    start = time.monotonic()
+    try:
+        crawler, transfer = asyncio.run(crawl(args, output))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    wall = time.monotonic() - start
+
+    received, decoded = transfer.get_counts()
+    print("%d songs, %d requests (%d failed) in %.2fs, %.1f requests/s, "
+          "%.1f MiB received (%.1f MiB decoded)"
+            %(crawler.songs, crawler.requests, crawler.failures, wall,
+              crawler.requests / wall if wall else 0, received / 2**20,
+              decoded / 2**20),
+          file=sys.stderr)
+
+    return 1 if crawler.failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,30 @@
+"""
+Rhythmsub test support
+
+Puts the plugin's modules on the path and installs the Rhythmbox stand-ins from
+bench/rhythmbox_stubs.py in place of gi.repository and rb, so that the tests
+run without Rhythmbox. Import this before any of the plugin's modules.
+
+Copyright (c) 2013 Luke Carrier
+Released under the terms of the GPLv3
+"""
+
+import os
+import sys
+import tempfile
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR  = os.path.dirname(TESTS_DIR)
+
+sys.path[:0] = [ROOT_DIR, os.path.join(ROOT_DIR, "bench")]
+
+import rhythmbox_stubs
+
+# Directory returned by the stand-ins' user_cache_dir() functions
+CACHE_DIR = tempfile.TemporaryDirectory(prefix="rhythmsub-tests-")
+
+if "rb" not in sys.modules:
+    rhythmbox_stubs.install(CACHE_DIR.name)
+
+# The stand-in main loop
+LOOP = rhythmbox_stubs.LOOP
@@ -0,0 +1,649 @@
+"""
+Tests for the plugin's fetching, request scheduling, retries and updates
+
+Copyright (c) 2013 Luke Carrier
+Released under the terms of the GPLv3
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import support
+
+import rb
+import rhythmbox_stubs
+import rhythmsub
+import subsonic_server
+
+from rhythmsub import RhythmboxLoaderAsyncFetcher, RhythmsubCache, \
+                      RhythmsubCacheQueue, RhythmsubDBEntryType, \
+                      RhythmsubRequestScheduler
+from rhythmsub_store import RhythmsubStore
+from subsonic import JSONItemStream, ResponseError, Server
+
+"""
+Asynchronous fetcher which holds on to its requests until told to complete or
+fail them.
+"""
+class FakeFetcher:
+    # Requests made, as (url, complete_cb, failure_cb) tuples in order
+    requests = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self):
+        self.requests = []
+
+    """
+    Complete the oldest outstanding request for a URL.
+    """
+    def complete(self, url, *args):
+        self.__pop(url)[1](*args)
+
+    """
+    Fail the oldest outstanding request for a URL.
+    """
+    def fail(self, url, error):
+        self.__pop(url)[2](error, 1)
+
+    """
+    Make a request.
+    """
+    def get(self, url, complete_cb, failure_cb=None, priority=None,
+            parse_cb=None):
+        self.requests.append((url, complete_cb, failure_cb))
+
+    """
+    Make a streamed request.
+    """
+    def get_stream(self, url, keys, item_cb, complete_cb, failure_cb=None,
+                   priority=None):
+        self.requests.append((url, complete_cb, failure_cb))
+
+    """
+    Get the URLs of the outstanding requests, in the order they were made.
+    """
+    def get_urls(self):
+        return [request[0] for request in self.requests]
+
+    """
+    Remove the oldest outstanding request for a URL.
+    """
+    def __pop(self, url):
+        for i, request in enumerate(self.requests):
+            if request[0] == url:
+                return self.requests.pop(i)
+
+        raise AssertionError("no request for %s" %url)
+
+
+"""
+Cache stand-in for queues, counting the idle handler's activations.
+"""
+class FakeCache:
+    # Number of times the idle handler was activated
+    activations = 0
+
+    def ensure_idle_handler_active(self):
+        self.activations += 1
+
+
+"""
+Request scheduler tests.
+"""
+class RhythmsubRequestSchedulerTest(unittest.TestCase):
+    """
+    Create a scheduler in front of a fake fetcher.
+    """
+    def setUp(self):
+        self.fetcher   = FakeFetcher()
+        self.scheduler = RhythmsubRequestScheduler(self.fetcher, 2)
+        self.completed = []
+
+    """
+    Schedule a request, recording its completion.
+    """
+    def get(self, url, priority=RhythmsubRequestScheduler.PRIORITY_DEFAULT):
+        self.scheduler.get(url, lambda resp: self.completed.append(url),
+                           priority=priority)
+
+    """
+    No more than the maximum number of requests are in flight.
+    """
+    def test_max_in_flight(self):
+        for url in ("a", "b", "c", "d"):
+            self.get(url)
+
+        self.assertEqual(self.fetcher.get_urls(), ["a", "b"])
+        self.assertEqual(self.scheduler.get_in_flight(), 2)
+        self.assertEqual(self.scheduler.get_waiting(), 2)
+
+        self.fetcher.complete("b", {})
+        self.assertEqual(self.completed, ["b"])
+        self.assertEqual(self.fetcher.get_urls(), ["a", "c"])
+
+        self.fetcher.complete("a", {})
+        self.fetcher.complete("c", {})
+        self.fetcher.complete("d", {})
+        self.assertEqual(self.completed, ["b", "a", "c", "d"])
+        self.assertTrue(self.scheduler.is_idle())
+
+    """
+    Waiting requests are dispatched by priority, then in the order they were
+    made.
+    """
+    def test_priority(self):
+        self.get("busy 1")
+        self.get("busy 2")
+        self.get("low", RhythmsubRequestScheduler.PRIORITY_LOW)
+        self.get("default 1")
+        self.get("high", RhythmsubRequestScheduler.PRIORITY_HIGH)
+        self.get("default 2")
+
+        dispatched = []
+        while self.fetcher.requests:
+            url = self.fetcher.get_urls()[0]
+            self.fetcher.complete(url, {})
+            dispatched.append(url)
+
+        self.assertEqual(dispatched, ["busy 1", "busy 2", "high", "default 1",
+                                      "default 2", "low"])
+
+    """
+    Raising the limit dispatches waiting requests straight away.
+    """
+    def test_set_max_in_flight(self):
+        for url in ("a", "b", "c", "d"):
+            self.get(url)
+
+        self.scheduler.set_max_in_flight(3)
+        self.assertEqual(self.fetcher.get_urls(), ["a", "b", "c"])
+
+        self.scheduler.set_max_in_flight(1)
+        self.fetcher.complete("a", {})
+        self.fetcher.complete("b", {})
+        self.assertEqual(self.fetcher.get_urls(), ["c"])
+
+    """
+    Drain callbacks are called once the backlog falls below the limit.
+    """
+    def test_drain_cb(self):
+        drained = []
+        for url in ("a", "b", "c", "d"):
+            self.get(url)
+
+        self.scheduler.add_drain_cb(lambda: drained.append(True))
+        self.assertEqual(drained, [])
+
+        self.fetcher.complete("a", {})
+        self.assertEqual(drained, [True])
+        self.fetcher.complete("b", {})
+        self.assertEqual(drained, [True])
+
+        self.scheduler.add_drain_cb(lambda: drained.append(False))
+        self.assertEqual(drained, [True, False])
+
+    """
+    Metrics reflect the requests in flight and waiting.
+    """
+    def test_metrics(self):
+        for url in ("a", "b", "c"):
+            self.get(url)
+        self.fetcher.complete("a", {})
+
+        metrics = self.scheduler.get_metrics()
+        self.assertEqual(metrics["in_flight"], 2)
+        self.assertEqual(metrics["waiting"], 0)
+        self.assertEqual(metrics["dead_letters"], 0)
+        self.assertEqual(metrics["latency"].get_count(), 1)
+        self.assertEqual(metrics["received_bytes"], 0)
+
+
+"""
+Retry and dead-letter tests.
+
+Requests are made through a Subsonic server, as the cache makes them, and
+retried after backoffs of a few milliseconds on the stand-in main loop.
+"""
+class RhythmsubDeadLetterTest(unittest.TestCase):
+    """
+    Create a server, scheduler and queue in front of a fake fetcher.
+    """
+    def setUp(self):
+        self.fetcher   = FakeFetcher()
+        self.scheduler = RhythmsubRequestScheduler(self.fetcher, 4,
+                                                   max_attempts=3,
+                                                   backoff_base=1,
+                                                   backoff_max=4)
+        self.server    = Server("http://subsonic.invalid", "user", "secret",
+                                "rhythmsub-tests", async_fetcher=self.scheduler,
+                                cache_size=0)
+        self.queue     = RhythmsubCacheQueue("song", FakeCache(), self.server)
+        self.completed = []
+        self.failures  = []
+
+    """
+    Fetch a directory as an album queue would, settling a refresh of the queue.
+
+    Returns the refresh.
+    """
+    def fetch(self, id):
+        refresh = self.queue.refreshing()
+
+        def complete_cb(resp):
+            self.completed.append(id)
+            self.queue.refreshed(refresh)
+
+        failure_cb = self.queue.failure_cb(self.queue, id, refresh)
+        self.server.get_music_directory_async(complete_cb, id,
+                                              failure_cb=failure_cb)
+        return refresh
+
+    """
+    Fail the outstanding request until the scheduler gives up on it.
+    """
+    def exhaust(self, error=None):
+        for attempt in range(3):
+            self.fetcher.fail(self.fetcher.get_urls()[0],
+                              error or IOError("failed"))
+            support.LOOP.run(5)
+
+    """
+    Failed attempts are retried after a backoff, and succeed.
+    """
+    def test_retry(self):
+        self.fetch("1")
+        self.fetcher.fail(self.fetcher.get_urls()[0], IOError("failed"))
+        self.assertEqual(self.fetcher.requests, [])
+        self.assertEqual(self.scheduler.get_waiting(), 1)
+
+        support.LOOP.run(5)
+        self.assertEqual(len(self.fetcher.requests), 1)
+
+        self.fetcher.complete(self.fetcher.get_urls()[0], None)
+        self.assertEqual(self.completed, ["1"])
+        self.assertFalse(self.queue.is_refreshing())
+        self.assertEqual(self.scheduler.get_dead_letters(), [])
+
+    """
+    Responses rejected by their callbacks count as failed attempts.
+    """
+    def test_rejected_response(self):
+        def complete_cb(resp):
+            if not self.completed:
+                self.completed.append("rejected")
+                raise ResponseError("malformed response")
+            self.completed.append("accepted")
+
+        self.server.get_music_directory_async(complete_cb, "1")
+        self.fetcher.complete(self.fetcher.get_urls()[0], None)
+        support.LOOP.run(5)
+        self.fetcher.complete(self.fetcher.get_urls()[0], None)
+
+        self.assertEqual(self.completed, ["rejected", "accepted"])
+        self.assertTrue(self.scheduler.is_idle())
+
+    """
+    Requests which exhaust their attempts are dead-lettered, and the queue
+    stops waiting for them but counts them as failed.
+    """
+    def test_dead_letter(self):
+        self.fetch("1")
+        self.exhaust()
+
+        self.assertEqual(len(self.scheduler.get_dead_letters()), 1)
+        self.assertEqual(self.scheduler.get_dead_letters()[0].attempts, 3)
+        self.assertFalse(self.queue.is_refreshing())
+        self.assertEqual(self.queue.get_failed(), 1)
+
+    """
+    Permanent errors aren't retried.
+    """
+    def test_permanent_error(self):
+        self.fetch("1")
+        self.fetcher.fail(self.fetcher.get_urls()[0],
+                          ResponseError("not found", 70))
+
+        self.assertEqual(self.scheduler.get_dead_letters()[0].attempts, 1)
+        self.assertTrue(self.scheduler.is_idle())
+
+    """
+    Failures handled by every caller aren't dead-lettered.
+    """
+    def test_handled_failure(self):
+        self.server.get_music_directory_async(
+                self.completed.append, "1",
+                failure_cb=lambda error, attempts: self.failures.append(
+                        attempts) or True)
+        self.exhaust()
+
+        self.assertEqual(self.failures, [3])
+        self.assertEqual(self.scheduler.get_dead_letters(), [])
+
+    """
+    A resubmitted dead letter settles its queue's refresh once, whatever else
+    is in flight, however many times its callbacks are called.
+    """
+    def test_resubmitted_settles_once(self):
+        self.fetch("1")
+        self.exhaust()
+        self.fetch("2")
+
+        self.assertEqual(self.scheduler.retry_dead_letters(), 1)
+        self.queue.resubmitted()
+        self.assertEqual(self.queue.get_metrics()["in_flight"], 2)
+
+        dead_url, other_url = self.fetcher.get_urls()[::-1]
+        self.fetcher.complete(dead_url, None)
+        self.assertEqual(self.completed, ["1"])
+        self.assertEqual(self.queue.get_failed(), 0)
+        self.assertTrue(self.queue.is_refreshing())
+        self.assertEqual(self.queue.get_metrics()["in_flight"], 1)
+
+        self.fetcher.complete(other_url, None)
+        self.assertFalse(self.queue.is_refreshing())
+        self.assertEqual(self.queue.get_metrics()["in_flight"], 0)
+
+    """
+    Settling a refresh a second time has no effect.
+    """
+    def test_settle_twice(self):
+        refresh = self.queue.refreshing()
+        other   = self.queue.refreshing()
+
+        self.queue.failed(refresh)
+        self.queue.refreshed(refresh)
+        self.queue.refreshed(refresh)
+        self.assertTrue(self.queue.is_refreshing())
+        self.assertEqual(self.queue.get_failed(), 0)
+
+        self.queue.resubmitted()
+        self.assertEqual(self.queue.get_metrics()["in_flight"], 1)
+
+        self.queue.refreshed(other)
+        self.assertFalse(self.queue.is_refreshing())
+
+    """
+    Resubmitted dead letters get a fresh set of attempts, and deliver to
+    their callbacks if they succeed.
+    """
+    def test_retry_dead_letters(self):
+        self.fetch("1")
+        self.exhaust()
+        self.scheduler.retry_dead_letters()
+        self.queue.resubmitted()
+
+        self.assertEqual(self.scheduler.get_dead_letters(), [])
+        self.exhaust()
+        self.assertEqual(self.scheduler.get_dead_letters()[0].attempts, 3)
+        self.assertEqual(self.queue.get_failed(), 1)
+        self.assertFalse(self.queue.is_refreshing())
+
+        self.scheduler.retry_dead_letters()
+        self.queue.resubmitted()
+        self.fetcher.complete(self.fetcher.get_urls()[0], None)
+        self.assertEqual(self.completed, ["1"])
+        self.assertEqual(self.queue.get_failed(), 0)
+        self.assertFalse(self.queue.is_refreshing())
+
+    """
+    A fresh request for a resubmitted dead letter takes over its callbacks, so
+    that they're called once and it's only dead-lettered once.
+    """
+    def test_fresh_request_for_dead_letter(self):
+        self.fetch("1")
+        self.exhaust()
+        self.scheduler.retry_dead_letters()
+        self.queue.resubmitted()
+        self.fetch("1")
+
+        urls = self.fetcher.get_urls()
+        self.assertEqual(len(urls), 2)
+        self.assertEqual(urls[0], urls[1])
+
+        # The resubmitted copy has nothing left to deliver to
+        self.exhaust()
+        self.assertEqual(self.completed, [])
+        self.exhaust()
+        self.assertEqual(len(self.scheduler.get_dead_letters()), 1)
+        self.assertEqual(self.queue.get_failed(), 2)
+
+        self.scheduler.retry_dead_letters()
+        self.queue.resubmitted()
+        self.fetcher.complete(self.fetcher.get_urls()[0], None)
+        self.assertEqual(self.completed, ["1", "1"])
+        self.assertEqual(self.queue.get_failed(), 0)
+        self.assertFalse(self.queue.is_refreshing())
+
+
+
+"""
+rb.ChunkLoader stand-in, handing over a document in small chunks from the main
+loop, one per iteration.
+"""
+class FakeChunkLoader:
+    # Document to hand over, and the size of its chunks
+    document   = None
+    chunk_size = 10
+
+    # Has the transfer been cancelled?
+    cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def get_url_chunks(self, url, chunk_size, want_size, callback, *args):
+        chunks = [self.document[i:i + self.chunk_size]
+                  for i in range(0, len(self.document), self.chunk_size)]
+        chunks.append(None)
+
+        def next_chunk():
+            if not self.cancelled:
+                callback(chunks.pop(0), 0, *args)
+            return bool(chunks) and not self.cancelled
+
+        support.LOOP.idle_add(next_chunk)
+
+
+"""
+JSONItemStream which notes the threads it's fed on.
+"""
+class ThreadRecordingStream(JSONItemStream):
+    # Names of the threads which fed chunks
+    threads = set()
+
+    def feed(self, data):
+        self.threads.add(threading.current_thread().name)
+        return super(ThreadRecordingStream, self).feed(data)
+
+
+"""
+Rhythmbox loader fetcher tests.
+
+Responses are handed over by a stand-in chunk loader, and parsed on the
+fetcher's worker pool.
+"""
+class RhythmboxLoaderAsyncFetcherTest(unittest.TestCase):
+    # getIndexes response listing 50 artists
+    INDEXES = json.dumps({"subsonic-response": {
+        "status":  "ok",
+        "version": "1.10.1",
+        "indexes": {"index": [{"name": "A", "artist": [
+            {"id": i, "name": "Artist %d" %i} for i in range(50)]}]},
+    }}).encode("utf-8")
+
+    """
+    Stream a document, returning the items, completions and failures as they
+    reached the callbacks, with the threads they reached them on.
+    """
+    def stream(self, document, item_cb=None):
+        events = []
+
+        def real_item_cb(key, value):
+            events.append(("item", value["id"],
+                           threading.current_thread().name))
+            if item_cb is not None:
+                item_cb(value)
+
+        loader = FakeChunkLoader()
+        loader.document = document
+
+        with unittest.mock.patch.object(rb, "ChunkLoader", lambda: loader), \
+                unittest.mock.patch.object(rhythmsub, "JSONItemStream",
+                                           ThreadRecordingStream):
+            RhythmboxLoaderAsyncFetcher.get_stream(
+                    "http://subsonic.invalid/rest/getIndexes.view",
+                    ("index.artist",), real_item_cb,
+                    lambda: events.append(("complete",
+                                           threading.current_thread().name)),
+                    lambda error, attempts: events.append(("failed", error)))
+
+            self.assertTrue(support.LOOP.run(10, lambda: events and
+                                             events[-1][0] != "item"))
+
+        return events, loader
+
+    """
+    Items reach the main loop in order, once every chunk has been parsed on a
+    worker.
+    """
+    def test_items_in_order(self):
+        ThreadRecordingStream.threads = set()
+        events, loader = self.stream(self.INDEXES)
+
+        main = threading.current_thread().name
+        self.assertEqual(events, [("item", i, main) for i in range(50)]
+                                 + [("complete", main)])
+        self.assertNotIn(main, ThreadRecordingStream.threads)
+        self.assertFalse(loader.cancelled)
+
+    """
+    Malformed documents fail the request and stop the transfer.
+    """
+    def test_malformed(self):
+        events, loader = self.stream(self.INDEXES[:-20] + b"]]]]]]]]]]]]")
+
+        self.assertEqual(events[-1][0], "failed")
+        self.assertIsInstance(events[-1][1], ValueError)
+        self.assertEqual(sum(1 for event in events if event[0] == "failed"), 1)
+        self.assertNotIn("complete", [event[0] for event in events])
+
+    """
+    Items the callback can't handle fail the request and stop the transfer.
+    """
+    def test_item_cb_error(self):
+        def item_cb(artist):
+            if artist["id"] == 10:
+                raise KeyError("id")
+
+        with self.assertLogs("rhythmsub", "ERROR"):
+            events, loader = self.stream(self.INDEXES, item_cb)
+
+        self.assertEqual([event[1] for event in events[:-1]],
+                         list(range(11)))
+        self.assertIsInstance(events[-1][1], KeyError)
+        self.assertTrue(loader.cancelled)
+
+
+"""
+Synthetic library whose new albums don't say where they are.
+"""
+class OrphanedAlbumLibrary(subsonic_server.SyntheticLibrary):
+    def album_folder(self, artist, album):
+        folder = super(OrphanedAlbumLibrary, self).album_folder(artist, album)
+        if album >= self.albums:
+            del folder["parent"]
+
+        return folder
+
+
+"""
+Update tests.
+
+The cache synchronises with a synthetic server on a background thread, through
+the Rhythmbox stand-ins.
+"""
+class RhythmsubCacheUpdateTest(unittest.TestCase):
+    """
+    Serve a library of four artists with two albums of three songs each, and
+    synchronise with it once.
+
+    The albums predate the index, so that only those added later are new.
+    """
+    def synchronise(self, library):
+        library.last_modified = int(time.time() * 1000)
+
+        server = subsonic_server.SyntheticServer(("127.0.0.1", 0), library)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        self.addCleanup(server.server_close)
+
+        directory = tempfile.TemporaryDirectory(prefix="rhythmsub-update-")
+        self.addCleanup(directory.cleanup)
+        store = RhythmsubStore(os.path.join(directory.name, "state.sqlite"))
+        self.addCleanup(store.close)
+
+        self.server    = server
+        self.db        = rhythmbox_stubs.RhythmDB()
+        self.scheduler = RhythmsubRequestScheduler(RhythmboxLoaderAsyncFetcher,
+                                                   4)
+        self.cache     = RhythmsubCache(self.db, RhythmsubDBEntryType(),
+                                        Server(server.get_address(), "user",
+                                               "secret", "rhythmsub-tests",
+                                               async_fetcher=self.scheduler),
+                                        self.scheduler, store)
+
+        self.update()
+        self.assertEqual(len(self.db.entries), 24)
+
+    """
+    Run an update to completion.
+    """
+    def update(self):
+        requests = self.server.requests
+
+        self.cache.update()
+        self.assertTrue(support.LOOP.run(30, self.scheduler.is_idle))
+        self.assertEqual(self.scheduler.get_dead_letters(), [])
+
+        return self.server.requests - requests
+
+    """
+    New albums beneath folders between them and their artists are found by
+    climbing to the artists.
+    """
+    def test_new_albums_beneath_year_folders(self):
+        library = subsonic_server.SyntheticLibrary(4, 2, 3, year_folders=True)
+        self.synchronise(library)
+
+        library.touch(2)
+        requests = self.update()
+        self.assertEqual(len(self.db.entries), 30)
+
+        # The index, newest albums, new albums' year folders (fetched once
+        # climbing, and then served from the server's response cache),
+        # touched artists and new albums
+        self.assertEqual(requests, 1 + 1 + 2 + 2 + 2)
+
+    """
+    Every artist is crawled if new albums can't be placed.
+    """
+    def test_new_albums_without_parents(self):
+        library = OrphanedAlbumLibrary(4, 2, 3, year_folders=True)
+        self.synchronise(library)
+
+        library.touch(2)
+        self.update()
+        self.assertEqual(len(self.db.entries), 30)
+
+
+if __name__ == "__main__":
+    unittest.main()
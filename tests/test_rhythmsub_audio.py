@@ -0,0 +1,183 @@
+"""
+Tests for the audio cache's range maps and sparse files
+
+Copyright (c) 2013 Luke Carrier
+Released under the terms of the GPLv3
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+import support
+
+from rhythmsub_audio import RhythmsubAudioCache, RhythmsubRangeMap
+
+"""
+Byte range map tests.
+"""
+class RhythmsubRangeMapTest(unittest.TestCase):
+    """
+    Disjoint ranges are kept apart, in order.
+    """
+    def test_disjoint(self):
+        ranges = RhythmsubRangeMap([(50, 60), (0, 10), (20, 30)])
+
+        self.assertEqual(ranges.to_list(), [[0, 10], [20, 30], [50, 60]])
+        self.assertEqual(ranges.get_size(), 30)
+
+    """
+    Ranges which touch or overlap are merged, however many they bridge.
+    """
+    def test_merge(self):
+        for added, expected in (((10, 20), [[0, 30], [50, 60]]),
+                                ((5, 25),  [[0, 30], [50, 60]]),
+                                ((30, 40), [[0, 10], [20, 40], [50, 60]]),
+                                ((40, 50), [[0, 10], [20, 30], [40, 60]]),
+                                ((25, 55), [[0, 10], [20, 60]]),
+                                ((0, 60),  [[0, 60]]),
+                                ((-5, 70), [[-5, 70]]),
+                                ((22, 28), [[0, 10], [20, 30], [50, 60]]),
+                                ((70, 80), [[0, 10], [20, 30], [50, 60],
+                                            [70, 80]])):
+            with self.subTest(added=added):
+                ranges = RhythmsubRangeMap([(0, 10), (20, 30), (50, 60)])
+                ranges.add(*added)
+
+                self.assertEqual(ranges.to_list(), expected)
+                self.assertEqual(ranges.get_size(),
+                                 sum(end - start for start, end in expected))
+
+    """
+    Empty and inverted ranges are ignored.
+    """
+    def test_empty(self):
+        ranges = RhythmsubRangeMap([(0, 10)])
+        ranges.add(20, 20)
+        ranges.add(40, 30)
+
+        self.assertEqual(ranges.to_list(), [[0, 10]])
+
+    """
+    Lookups at, within and either side of the ranges' edges.
+    """
+    def test_lookups(self):
+        ranges = RhythmsubRangeMap([(10, 20), (30, 40)])
+
+        self.assertIsNone(ranges.get_filled_end(9))
+        self.assertEqual(ranges.get_filled_end(10), 20)
+        self.assertEqual(ranges.get_filled_end(19), 20)
+        self.assertIsNone(ranges.get_filled_end(20))
+        self.assertEqual(ranges.get_filled_end(35), 40)
+
+        self.assertEqual(ranges.get_next_start(0), 10)
+        self.assertEqual(ranges.get_next_start(10), 30)
+        self.assertEqual(ranges.get_next_start(25), 30)
+        self.assertIsNone(ranges.get_next_start(30))
+
+        self.assertTrue(ranges.is_filled(10, 20))
+        self.assertTrue(ranges.is_filled(12, 18))
+        self.assertTrue(ranges.is_filled(25, 25))
+        self.assertFalse(ranges.is_filled(10, 21))
+        self.assertFalse(ranges.is_filled(15, 35))
+        self.assertFalse(ranges.is_filled(0, 5))
+
+
+"""
+Audio cache tests.
+
+Nothing here reaches the network: songs are filled in by hand, and the stream
+URL function fails the test if it's asked for.
+"""
+class RhythmsubAudioCacheTest(unittest.TestCase):
+    """
+    Create a cache directory.
+    """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="rhythmsub-audio-")
+        self.addCleanup(self.directory.cleanup)
+
+    """
+    Stream URL function for songs which mustn't be fetched.
+    """
+    def stream_url(self, time_offset):
+        self.fail("fetched from the server")
+
+    """
+    Fill in a range of a song, as a reader would.
+    """
+    def fill(self, cache, key, start, data):
+        with open(cache.get_file(key), "r+b") as f:
+            f.seek(start)
+            f.write(data)
+
+        cache.add_range(key, start, start + len(data))
+
+    """
+    Cached ranges are read from disk, and survive between sessions.
+    """
+    def test_sparse_file(self):
+        cache  = RhythmsubAudioCache(self.directory.name, 2**20)
+        reader = cache.open("song", self.stream_url)
+        cache.set_length("song", 1000, True)
+        self.fill(cache, "song", 100, b"a" * 100)
+        self.fill(cache, "song", 600, b"b" * 400)
+
+        self.assertEqual(b"".join(reader.read(150, 200)), b"a" * 50)
+        self.assertEqual(b"".join(reader.read(600)), b"b" * 400)
+        self.assertIsNone(cache.get_path("song"))
+        reader.close()
+
+        with open(cache.get_file("song") + cache.RANGES_SUFFIX) as f:
+            self.assertEqual(json.load(f), {"length":   1000,
+                                            "ranges":   [[100, 200],
+                                                         [600, 1000]],
+                                            "seekable": True})
+
+        cache  = RhythmsubAudioCache(self.directory.name, 2**20)
+        reader = cache.open("song", self.stream_url)
+        self.assertEqual(cache.get_length("song"), 1000)
+        self.assertTrue(cache.is_seekable("song"))
+        self.assertEqual(cache.get_filled_end("song", 150), 200)
+        self.assertEqual(cache.get_next_start("song", 200), 600)
+
+        self.fill(cache, "song", 0, b"c" * 100)
+        self.fill(cache, "song", 200, b"d" * 400)
+        reader.close()
+
+        self.assertEqual(cache.get_path("song"), cache.get_file("song"))
+        self.assertFalse(os.path.exists(cache.get_file("song")
+                                        + cache.RANGES_SUFFIX))
+
+    """
+    The least recently used songs are evicted, unless they're open.
+    """
+    def test_eviction(self):
+        cache = RhythmsubAudioCache(self.directory.name, 250)
+
+        for key in ("one", "two"):
+            reader = cache.open(key, self.stream_url)
+            cache.set_length(key, 100)
+            self.fill(cache, key, 0, b"x" * 100)
+            reader.close()
+
+        reader = cache.open("three", self.stream_url)
+        cache.set_length("three", 300)
+        self.fill(cache, "three", 0, b"x" * 100)
+        self.assertIsNone(cache.get_path("one"))
+        self.assertIsNotNone(cache.get_path("two"))
+
+        # Open files are passed over
+        self.fill(cache, "three", 100, b"x" * 100)
+        self.assertIsNone(cache.get_path("two"))
+        self.fill(cache, "three", 200, b"x" * 100)
+        self.assertTrue(os.path.exists(cache.get_file("three")))
+        reader.close()
+
+        self.assertFalse(os.path.exists(cache.get_file("three")))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
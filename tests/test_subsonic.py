@@ -0,0 +1,382 @@
+"""
+Tests for the Subsonic client's response parsing
+
+Copyright (c) 2013 Luke Carrier
+Released under the terms of the GPLv3
+"""
+
+import gzip
+import json
+import unittest
+import zlib
+
+import support
+
+import subsonic
+
+# getIndexes response exercising the parser: keys at several depths, a single
+# artist in place of an array, and strings full of JSON syntax and multi-byte
+# characters
+INDEXES = json.dumps({"subsonic-response": {
+    "status":  "ok",
+    "indexes": {
+        "lastModified": 1234567890123,
+        "index": [
+            {"name": "A", "artist": [
+                {"id": 1, "name": "A [b] {c} \"q\" \\ , é"},
+                {"id": 2, "name": "Zoë", "artist": {"id": 9}},
+            ]},
+            {"name": "B", "artist": {"id": 3, "name": "♫"}},
+        ],
+    },
+}}, ensure_ascii=False).encode("utf-8")
+
+# Items the parser should extract from INDEXES
+INDEXES_ITEMS = [
+    ("lastModified", 1234567890123),
+    ("artist",       {"id": 1, "name": "A [b] {c} \"q\" \\ , é"}),
+    ("artist",       {"id": 2, "name": "Zoë", "artist": {"id": 9}}),
+    ("artist",       {"id": 3, "name": "♫"}),
+]
+
+# getIndexes response with songs alongside the index, whose artists are names
+INDEXES_WITH_SONGS = json.dumps({"subsonic-response": {
+    "status":  "ok",
+    "version": "1.10.1",
+    "indexes": {
+        "lastModified": 1234567890123,
+        "index": [
+            {"name": "A", "artist": [{"id": 1, "name": "Artist"}]},
+        ],
+        "child": [
+            {"id": 10, "title": "Song", "artist": "Artist", "isDir": False},
+            {"id": 11, "title": "Song", "artist": "Other", "isDir": False},
+        ],
+    },
+}}).encode("utf-8")
+
+"""
+Incremental JSON item parser tests.
+"""
+class JSONItemStreamTest(unittest.TestCase):
+    """
+    Parse a document fed in the specified chunks.
+    """
+    def parse(self, chunks, keys=("artist", "lastModified")):
+        stream = subsonic.JSONItemStream(keys)
+
+        items = []
+        for chunk in chunks:
+            items += stream.feed(chunk)
+        items += stream.close()
+
+        return items
+
+    """
+    The whole document at once.
+    """
+    def test_whole_document(self):
+        self.assertEqual(self.parse([INDEXES]), INDEXES_ITEMS)
+
+    """
+    Tokens, strings and multi-byte characters split between two chunks.
+    """
+    def test_every_split(self):
+        for i in range(1, len(INDEXES)):
+            with self.subTest(split=i):
+                self.assertEqual(self.parse([INDEXES[:i], INDEXES[i:]]),
+                                 INDEXES_ITEMS)
+
+    """
+    A byte at a time.
+    """
+    def test_single_bytes(self):
+        self.assertEqual(self.parse([INDEXES[i:i + 1]
+                                     for i in range(len(INDEXES))]),
+                         INDEXES_ITEMS)
+
+    """
+    Items are returned as soon as they're complete.
+    """
+    def test_items_as_they_arrive(self):
+        stream = subsonic.JSONItemStream(("artist",))
+        split  = INDEXES.index(b'{"id": 2')
+
+        self.assertEqual(stream.feed(INDEXES[:split]), [INDEXES_ITEMS[1]])
+        self.assertEqual(stream.feed(INDEXES[split:]), INDEXES_ITEMS[2:])
+        self.assertEqual(stream.close(), [])
+
+    """
+    Qualified keys only match within their enclosing keys.
+    """
+    def test_qualified_keys(self):
+        self.assertEqual(self.parse([INDEXES_WITH_SONGS],
+                                    ("index.artist", "indexes.lastModified")),
+                         [("indexes.lastModified", 1234567890123),
+                          ("index.artist", {"id": 1, "name": "Artist"})])
+        self.assertEqual(self.parse([INDEXES_WITH_SONGS], ("child.artist",)),
+                         [("child.artist", "Artist"),
+                          ("child.artist", "Other")])
+        self.assertEqual(self.parse([INDEXES], ("index.artist",)),
+                         [("index.artist", value)
+                          for key, value in INDEXES_ITEMS[1:]])
+
+    """
+    Keys which don't appear.
+    """
+    def test_no_matches(self):
+        self.assertEqual(self.parse([INDEXES], ("error",)), [])
+
+    """
+    Empty, truncated and malformed documents.
+    """
+    def test_invalid_documents(self):
+        for document in (b"", b"  \n", INDEXES[:-1],
+                         INDEXES[:INDEXES.index(b'{"id": 2') + 4],
+                         b'{"artist": [1, }'):
+            with self.subTest(document=document):
+                with self.assertRaises(ValueError):
+                    self.parse([document])
+
+
+"""
+Fetcher serving a single document, in chunks of a few bytes.
+"""
+class FakeFetcher:
+    # Document to serve
+    document = None
+
+    """
+    Initialiser.
+    """
+    def __init__(self, document):
+        self.document = document
+
+    """
+    Get the decoded document.
+    """
+    def get(self, url):
+        return json.loads(self.document.decode("utf-8"))
+
+    """
+    Get the chunks of the document.
+    """
+    def get_chunks(self, url, chunk_size=7):
+        for i in range(0, len(self.document), chunk_size):
+            yield self.document[i:i + chunk_size]
+
+    """
+    Parse the document incrementally, as the plugin's fetcher does.
+    """
+    def get_stream(self, url, keys, item_cb, complete_cb, failure_cb=None,
+                   priority=None):
+        stream = subsonic.JSONItemStream(keys)
+
+        try:
+            for chunk in self.get_chunks(url):
+                for key, value in stream.feed(chunk):
+                    item_cb(key, value)
+            for key, value in stream.close():
+                item_cb(key, value)
+        except (ValueError, subsonic.ResponseError) as e:
+            failure_cb(e, 1)
+        else:
+            complete_cb()
+
+
+"""
+Streamed server method tests.
+"""
+class ServerStreamTest(unittest.TestCase):
+    """
+    Create a server in front of a fetcher serving the document.
+    """
+    def server(self, document):
+        fetcher = FakeFetcher(document)
+        return subsonic.Server("http://subsonic.invalid", "user", "secret",
+                               "rhythmsub-tests", fetcher=fetcher,
+                               async_fetcher=fetcher)
+
+    """
+    Songs alongside the index aren't taken for artists.
+    """
+    def test_indexes_with_songs(self):
+        server = self.server(INDEXES_WITH_SONGS)
+        self.assertEqual(list(server.iter_indexes()),
+                         [{"id": 1, "name": "Artist"}])
+
+        artists, completed = [], []
+        server.get_indexes_stream_async(artists.append, completed.append)
+        self.assertEqual(artists, [{"id": 1, "name": "Artist"}])
+        self.assertEqual(completed, [1234567890123])
+
+    """
+    Errors reported by the server are raised.
+    """
+    def test_error(self):
+        server = self.server(json.dumps({"subsonic-response": {
+            "status":  "failed",
+            "version": "1.10.1",
+            "error":   {"code": 70, "message": "Not found"},
+        }}).encode("utf-8"))
+
+        with self.assertRaises(subsonic.ResponseError) as context:
+            list(server.iter_music_directory(1))
+        self.assertEqual(context.exception.code, 70)
+
+        failures = []
+        server.get_music_directory_stream_async(None, None, 1,
+                failure_cb=lambda error, attempts: failures.append(error))
+        self.assertEqual([error.code for error in failures], [70])
+
+
+"""
+Content-Encoding decoder tests.
+"""
+class ContentDecoderTest(unittest.TestCase):
+    # Body to compress
+    BODY = INDEXES * 20
+
+    """
+    Compress BODY as raw deflate, without the zlib wrapper.
+    """
+    def raw_deflate(self):
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        return compressor.compress(self.BODY) + compressor.flush()
+
+    """
+    Decode a body fed in chunks of the specified size.
+    """
+    def decode(self, decoder, data, size):
+        decoded = b"".join(decoder.decode(data[i:i + size])
+                           for i in range(0, len(data), size))
+        return decoded + decoder.flush()
+
+    """
+    gzip and both variants of deflate, whole and in chunks of every size up to
+    a few bytes, so that the deflate variant must be told from a short start.
+    """
+    def test_encodings(self):
+        for encoding, data in (("gzip",     gzip.compress(self.BODY)),
+                               ("x-gzip",   gzip.compress(self.BODY)),
+                               ("deflate",  zlib.compress(self.BODY)),
+                               ("deflate",  self.raw_deflate()),
+                               ("identity", self.BODY),
+                               (None,       self.BODY)):
+            for size in (1, 2, 3, 7, len(data)):
+                with self.subTest(encoding=encoding, variant=data[:2],
+                                  size=size):
+                    decoder = subsonic.ContentDecoder(encoding)
+                    self.assertEqual(self.decode(decoder, data, size),
+                                     self.BODY)
+
+    """
+    A raw deflate body shorter than the zlib header.
+    """
+    def test_tiny_raw_deflate(self):
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        data       = compressor.compress(b"") + compressor.flush()
+
+        decoder = subsonic.ContentDecoder("deflate")
+        self.assertEqual(decoder.decode(data[:1]), b"")
+        self.assertEqual(decoder.decode(data[1:]) + decoder.flush(), b"")
+
+    """
+    Bodies whose encoding isn't known are sniffed from their first chunk.
+    """
+    def test_sniff(self):
+        data = gzip.compress(self.BODY)
+        self.assertEqual(self.decode(subsonic.ContentDecoder.sniff(data),
+                                     data, 4096),
+                         self.BODY)
+        self.assertEqual(self.decode(subsonic.ContentDecoder.sniff(self.BODY),
+                                     self.BODY, 4096),
+                         self.BODY)
+
+    """
+    Unsupported encodings, and corrupt and truncated bodies.
+    """
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            subsonic.ContentDecoder("br")
+
+        with self.assertRaises(ValueError):
+            self.decode(subsonic.ContentDecoder("gzip"), self.BODY, 4096)
+
+        for encoding, data in (("gzip",    gzip.compress(self.BODY)),
+                               ("deflate", zlib.compress(self.BODY)),
+                               ("deflate", self.raw_deflate())):
+            with self.subTest(encoding=encoding, variant=data[:2]):
+                with self.assertRaises(ValueError):
+                    self.decode(subsonic.ContentDecoder(encoding),
+                                data[:len(data) // 2], 4096)
+
+
+"""
+Transfer byte counter tests.
+"""
+class TransferCounterTest(unittest.TestCase):
+    """
+    Counts accumulate.
+    """
+    def test_counts(self):
+        counter = subsonic.TransferCounter()
+        self.assertEqual(counter.get_counts(), (0, 0))
+
+        counter.add(10, 100)
+        counter.add(5, 0)
+        self.assertEqual(counter.get_counts(), (15, 100))
+
+
+"""
+Response class tests.
+"""
+class ResponseTest(unittest.TestCase):
+    """
+    Wrap a getMusicDirectory response.
+    """
+    def directory(self, directory):
+        return {"subsonic-response": {"status": "ok", "version": "1.10.1",
+                                      "directory": directory}}
+
+    """
+    Directories with no children, one child and several.
+    """
+    def test_music_directory_children(self):
+        for children, expected in ((None, []), ([], []),
+                                   ({"id": 1}, [{"id": 1}]),
+                                   ([{"id": 1}, {"id": 2}],
+                                    [{"id": 1}, {"id": 2}])):
+            directory = {"id": 5, "name": "Album"}
+            if children is not None:
+                directory["child"] = children
+
+            with self.subTest(children=children):
+                resp = subsonic.GetMusicDirectoryResponse(
+                        self.directory(directory))
+                self.assertEqual(resp.children, expected)
+
+    """
+    Genres, as fetched by the server.
+    """
+    def test_genres(self):
+        genres = [{"value": "Rock", "songCount": 12, "albumCount": 1},
+                  {"value": "Jazz", "songCount": 3, "albumCount": 1}]
+
+        for genre, expected in ((None, []), (genres[0], genres[:1]),
+                                (genres, genres)):
+            document = {"status": "ok", "version": "1.10.1", "genres": {}}
+            if genre is not None:
+                document["genres"]["genre"] = genre
+
+            with self.subTest(genre=genre):
+                fetcher = FakeFetcher(json.dumps(
+                        {"subsonic-response": document}).encode("utf-8"))
+                server  = subsonic.Server("http://subsonic.invalid", "user",
+                                          "secret", "rhythmsub-tests",
+                                          fetcher=fetcher, cache_size=0)
+                self.assertEqual(server.get_genres().genres, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()